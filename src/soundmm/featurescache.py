@@ -0,0 +1,124 @@
+"""
+Persistent, content-addressed cache for per-file audio features.
+"""
+
+import hashlib
+import json
+import pathlib
+import sqlite3
+import time
+from typing import Optional, Sequence, List, Dict, Any, Union
+
+
+def audio_content_hash(audio_file: Union[str, pathlib.Path], block_size=2**20):
+    """ Returns the SHA-256 hex digest of an audio file's content (file name and timestamps are ignored). """
+    h = hashlib.sha256()
+    with open(audio_file, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class FeaturesCache:
+    def __init__(self, cache_file: Union[str, pathlib.Path], max_entries=1_000_000, timeout=60.0,
+                 last_access_resolution=3600.0, eviction_period=1000):
+        """
+        On-disk cache of features (dicts of floats), stored in a SQLite database. Entries are keyed by a hash of
+        the audio content, the extractor's name and version, and the extraction parameters (see make_key).
+        The least recently used entries are evicted when the cache contains more than max_entries items. To keep
+        cache hits read-only and inserts cheap, access times are approximate (see last_access_resolution) and the
+        size of the cache is checked every eviction_period inserts only.
+
+        Several processes can safely read from and write to the same cache file (SQLite handles the locking).
+        A FeaturesCache instance itself should not be shared between processes, though.
+
+        :param cache_file: Path to the database file, created if it does not exist.
+        :param max_entries: Maximum number of cached items (i.e. number of audio files x extractors).
+        :param timeout: Max duration (seconds) to wait for a lock held by another process.
+        :param last_access_resolution: The access time of a hit entry is updated only if it is older than this
+            duration (seconds), so that most hits don't write to the database.
+        :param eviction_period: Number of inserted entries between two evictions of the least recently used entries.
+            The cache may temporarily contain up to (max_entries + eviction_period) items. The first insert always
+            checks the size of the cache (other processes may have filled it).
+        """
+        self.cache_file, self.max_entries = pathlib.Path(cache_file).expanduser(), max_entries
+        self.last_access_resolution, self.eviction_period = last_access_resolution, eviction_period
+        self._n_inserts_since_eviction = eviction_period
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(str(self.cache_file), timeout=timeout)
+        # Write-Ahead Logging: readers don't block writers (and the other way around)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS features "
+                                     "(key TEXT PRIMARY KEY, value TEXT NOT NULL, last_access REAL NOT NULL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS features_last_access ON features (last_access)")
+
+    @staticmethod
+    def make_key(audio_hash: str, extractor_name: str, extractor_version: str, params: Dict[str, Any]):
+        """ Builds a cache key from an audio content hash, and a description of the extractor (incl. its params). """
+        params_str = json.dumps(params, sort_keys=True)
+        return hashlib.sha256(f'{audio_hash}|{extractor_name}|{extractor_version}|{params_str}'.encode()).hexdigest()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM features").fetchone()[0]
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self.get_many([key])[0]
+
+    def get_many(self, keys: Sequence[str]) -> List[Optional[Dict[str, Any]]]:
+        """ :returns: The list of cached features (None for keys that are not in the cache) """
+        values, last_accesses = dict(), dict()
+        # SQLite limits the number of variables in a single query
+        for i in range(0, len(keys), 500):
+            keys_chunk = list(keys[i:i+500])
+            rows = self._connection.execute(
+                f"SELECT key, value, last_access FROM features WHERE key IN ({','.join('?' * len(keys_chunk))})",
+                keys_chunk)
+            for k, v, last_access in rows:
+                values[k] = v
+                last_accesses[k] = last_access
+        # LRU: hit entries become the most recently used (unless they were already accessed recently)
+        now = time.time()
+        outdated_keys = [k for k, last_access in last_accesses.items()
+                         if last_access < now - self.last_access_resolution]
+        if len(outdated_keys) > 0:
+            with self._connection:
+                self._connection.executemany(
+                    "UPDATE features SET last_access = ? WHERE key = ?", [(now, k) for k in outdated_keys])
+        return [(json.loads(values[k]) if k in values else None) for k in keys]
+
+    def put(self, key: str, features: Dict[str, Any]):
+        self.put_many([key], [features])
+
+    def put_many(self, keys: Sequence[str], features: Sequence[Dict[str, Any]]):
+        assert len(keys) == len(features)
+        now = time.time()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO features (key, value, last_access) VALUES (?, ?, ?)",
+                [(k, json.dumps(f), now) for k, f in zip(keys, features)])
+            self._n_inserts_since_eviction += len(keys)
+            if self._n_inserts_since_eviction >= self.eviction_period:
+                self._evict()
+                self._n_inserts_since_eviction = 0
+
+    def _evict(self):
+        """ Removes the least recently used entries, if needed (must be called inside a transaction). """
+        n_entries = self._connection.execute("SELECT COUNT(*) FROM features").fetchone()[0]
+        if n_entries > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM features WHERE key IN (SELECT key FROM features ORDER BY last_access ASC LIMIT ?)",
+                (n_entries - self.max_entries, ))
+
+    def clear(self):
+        with self._connection:
+            self._connection.execute("DELETE FROM features")
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
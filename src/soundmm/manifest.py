@@ -0,0 +1,68 @@
+"""
+Per-directory manifests, which store the features of already-analyzed audio files.
+"""
+
+import json
+import os
+import pathlib
+from typing import Optional, Dict, Any, Sequence
+
+
+class MorphingManifest:
+    file_name = '.soundmm_manifest.json'
+
+    def __init__(self, morphing_dir: pathlib.Path, extraction_params: Dict[str, Any]):
+        """
+        Manifest of a morphing directory: for each audio file, stores its size, modification time and feature
+        values (one dict per type of features, e.g. 'ac' or 'tt'). Features are considered up-to-date only if the
+        file's size and modification time did not change, and if the same extraction parameters are used.
+
+        :param morphing_dir: The directory which contains the audio files and the manifest.
+        :param extraction_params: JSON-serializable dict of parameters (e.g. extractor versions). If they
+            differ from the parameters stored in the manifest, all stored features are discarded.
+        """
+        self.morphing_dir = morphing_dir
+        self.extraction_params = json.loads(json.dumps(extraction_params))  # tuples -> lists, etc.
+        self.files = dict()
+        try:
+            with open(self.path, 'r') as f:
+                manifest_data = json.load(f)
+            if manifest_data['extraction_params'] == self.extraction_params:
+                self.files = manifest_data['files']
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass  # Missing or corrupted manifest: all files will be analyzed again
+
+    @property
+    def path(self):
+        return self.morphing_dir.joinpath(self.file_name)
+
+    @staticmethod
+    def _file_stat(audio_file: pathlib.Path):
+        stat = audio_file.stat()
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def get(self, audio_file: pathlib.Path, features_type: str) -> Optional[Dict[str, Any]]:
+        """ :returns: The stored features if they're up-to-date, None otherwise """
+        entry = self.files.get(audio_file.name)
+        if entry is None or features_type not in entry:
+            return None
+        if {k: entry[k] for k in ('size', 'mtime_ns')} != self._file_stat(audio_file):
+            return None
+        return entry[features_type]
+
+    def set(self, audio_file: pathlib.Path, features_type: str, features: Optional[Dict[str, Any]]):
+        file_stat = self._file_stat(audio_file)
+        entry = self.files.get(audio_file.name)
+        if entry is None or {k: entry[k] for k in ('size', 'mtime_ns')} != file_stat:
+            entry = dict(file_stat)  # New or modified file: other types of features are outdated
+            self.files[audio_file.name] = entry
+        entry[features_type] = features
+
+    def save(self, audio_files: Sequence[pathlib.Path]):
+        """ Writes the manifest (atomically), keeping only the given audio files (e.g. discards deleted files). """
+        audio_file_names = set(a.name for a in audio_files)
+        self.files = {k: v for k, v in self.files.items() if k in audio_file_names}
+        temp_path = self.path.with_name(self.file_name + f'.{os.getpid()}.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump({'extraction_params': self.extraction_params, 'files': self.files}, f)
+        os.replace(temp_path, self.path)
@@ -1,6 +1,11 @@
+import contextlib
+import functools
+import multiprocessing
+import multiprocessing.pool
+import os
 import warnings
 from pathlib import Path
-from typing import Union, Sequence, Optional
+from typing import Union, Sequence, Optional, List, Dict, Iterator, Tuple, Callable
 import tempfile
 
 import pandas as pd
@@ -8,7 +13,467 @@ import numpy as np
 
 from . import timbral_models
 from . import timbrefeatures
-from .timbretoolbox import TimbreToolboxProcess, TimbreToolboxResults
+from . import timbretoolboxstats
+from . import timbretoolboxnumpy
+from .featurescache import FeaturesCache, audio_content_hash
+from .manifest import MorphingManifest
+from .timbretoolbox import TimbreToolboxProcess, TimbreToolboxResults, TimbreToolboxWorkerPool, \
+    TimbreToolboxTimeoutError, write_options_file, make_eval_config, get_tt_cache_key, resume_files_list
+
+
+metrics_names = ('nonsmoothness', 'nonlinearity')
+
+# Parameters given to timbral_extractor (also used to build the features cache keys)
+_ac_extractor_params = {'exclude_reverb': True, 'phase_correction': False, 'clip_output': False}
+
+
+def _extract_ac_features(audio_file: str):
+    """ Computes AudioCommons features of a single audio file (top-level function, to be sent to worker processes) """
+    ac_features = timbral_models.Extractor.timbral_extractor(audio_file, **_ac_extractor_params)
+    return {f'ac_{k}': v for k, v in ac_features.items()}
+
+
+# Audio arrays shared with worker processes (inherited without any copy when processes are forked)
+_shared_audio_arrays: Optional[Sequence[Sequence[np.ndarray]]] = None
+
+
+def _set_shared_audio_arrays(audio_arrays: Sequence[Sequence[np.ndarray]]):
+    global _shared_audio_arrays
+    _shared_audio_arrays = audio_arrays
+
+
+def _extract_ac_features_from_shared_array(indices: Tuple[int, int, int]):
+    """ Computes AudioCommons features of the audio array at (morphing_index, audio_index), sampled at fs. """
+    morphing_index, audio_index, fs = indices
+    ac_features = timbral_models.Extractor.timbral_extractor(
+        _shared_audio_arrays[morphing_index][audio_index], fs=fs, **_ac_extractor_params)
+    return {f'ac_{k}': v for k, v in ac_features.items()}
+
+
+def _resolve_n_jobs(n_jobs: int):
+    return os.cpu_count() if n_jobs == -1 else n_jobs
+
+
+def _get_features_cache(features_cache: Optional[Union[str, Path, FeaturesCache]]):
+    if features_cache is None or isinstance(features_cache, FeaturesCache):
+        return features_cache
+    return FeaturesCache(features_cache)
+
+
+def _compute_ac_features(audio_files_path: List[List[Path]], n_jobs=1, features_cache: Optional[FeaturesCache] = None,
+                         known_features: Optional[List[List[Optional[dict]]]] = None,
+                         pool: Optional[multiprocessing.pool.Pool] = None):
+    """
+    Computes AudioCommons Timbral Models features for all audio files, serially or using a pool of processes.
+    If a cache is provided, only files whose features were not cached yet will be analyzed.
+
+    :param known_features: Optional 2D list (same shape as audio_files_path) of already-computed features,
+        with None values for the files that must be analyzed.
+    :param pool: Optional pool of n_jobs processes, to be reused over successive calls (a temporary pool of
+        processes is created otherwise).
+    :returns: A 2D list (morphing_index, audio_index) of dicts (one dict of features per audio file)
+    """
+    flat_audio_files = [str(a) for audio_files in audio_files_path for a in audio_files]
+    if known_features is not None:
+        flat_ac_features = [features for features_1d in known_features for features in features_1d]
+    else:
+        flat_ac_features = [None for _ in flat_audio_files]
+    if features_cache is not None:
+        unknown_indices = [i for i, features in enumerate(flat_ac_features) if features is None]
+        cache_keys = {
+            i: FeaturesCache.make_key(audio_content_hash(flat_audio_files[i]), 'timbral_extractor',
+                                      timbral_models.Extractor.timbral_extractor_version, _ac_extractor_params)
+            for i in unknown_indices
+        }
+        for i, features in zip(unknown_indices, features_cache.get_many([cache_keys[i] for i in unknown_indices])):
+            flat_ac_features[i] = features
+    else:
+        cache_keys = None
+    missing_indices = [i for i, features in enumerate(flat_ac_features) if features is None]
+    missing_audio_files = [flat_audio_files[i] for i in missing_indices]
+
+    n_jobs = min(_resolve_n_jobs(n_jobs), len(missing_audio_files))
+    if n_jobs > 1:
+        # Several small tasks per process, for the load to remain balanced (extraction times depend on durations)
+        chunksize = max(1, len(missing_audio_files) // (n_jobs * 8))
+        if pool is not None:
+            missing_ac_features = pool.map(_extract_ac_features, missing_audio_files, chunksize=chunksize)
+        else:
+            with multiprocessing.Pool(n_jobs) as p:
+                missing_ac_features = p.map(_extract_ac_features, missing_audio_files, chunksize=chunksize)
+    else:
+        missing_ac_features = [_extract_ac_features(a) for a in missing_audio_files]
+    for i, features in zip(missing_indices, missing_ac_features):
+        flat_ac_features[i] = features
+    if features_cache is not None and len(missing_indices) > 0:
+        features_cache.put_many([cache_keys[i] for i in missing_indices], missing_ac_features)
+    # Build the 2D list of results (map preserves the order of files)
+    all_ac_features, flat_index = list(), 0
+    for audio_files in audio_files_path:
+        all_ac_features.append(flat_ac_features[flat_index:flat_index + len(audio_files)])
+        flat_index += len(audio_files)
+    return all_ac_features
+
+
+def _run_tt_process(timbre_toolbox_path: Path, files_list_file: Path, process_index: int, verbose: bool,
+                    options_file: Optional[Path], file_timeout: Optional[float], job_timeout: Optional[float]):
+    """ Runs a Matlab TimbreToolbox process on the given files list file. Raises a TimbreToolboxTimeoutError if the
+    process has been killed by its watchdog. """
+    tt_process = TimbreToolboxProcess(timbre_toolbox_path, files_list_file, verbose=verbose,
+                                      process_index=process_index, options_file=options_file,
+                                      file_timeout=file_timeout, job_timeout=job_timeout)
+    tt_process.run()
+    if tt_process.killed:
+        raise TimbreToolboxTimeoutError(f"Matlab #{process_index} has been killed by the watchdog",
+                                        tt_process.processed_files, tt_process.current_file,
+                                        tt_process.timed_out_file)
+
+
+def _run_tt_files_list(run_job: Callable[[Path], None], files_list_file: Path, output_mode: str):
+    """ Runs TimbreToolbox jobs (Matlab processes or workers, to be run in its own thread) until all files of the
+    list have been analyzed: after a timeout, the next job resumes the analysis from the next file. """
+    while True:
+        try:
+            return run_job(files_list_file)
+        except TimbreToolboxTimeoutError as e:
+            warnings.warn(str(e))
+            if resume_files_list(files_list_file, e, output_mode) == 0:
+                return
+
+
+def _compute_tt_features(timbre_toolbox_path: Optional[Path], morphing_directories: List[Path],
+                         audio_files_path: List[List[Path]], verbose=False, n_workers=1,
+                         worker_pool: Optional[TimbreToolboxWorkerPool] = None, output_mode='sound',
+                         descriptors: Optional[Sequence[str]] = None, file_timeout: Optional[float] = None,
+                         job_timeout: Optional[float] = None):
+    """
+    Runs TimbreToolbox on the given audio files of all given morphing directories (lists of files are given to
+    Matlab). Directories are split into n_workers shards, and each shard is processed by its own Matlab instance
+    (a single instance uses only 1 CPU). If a pool of Matlab workers is given, shards are sent to these (already
+    running) workers instead.
+
+    :param output_mode: How Matlab writes results, see timbretoolbox.write_options_file
+    :param descriptors: If given, only these TimbreToolbox descriptors (and their dependencies) are evaluated.
+    :param file_timeout: If the analysis of a single file lasts longer (seconds), Matlab is killed (or the worker
+        is restarted), the file becomes an 'Evaluation Error' and the analysis resumes from the next file.
+    :param job_timeout: Maximum duration (seconds) of a Matlab job. If it expires, the analysis resumes from the
+        file being analyzed (which becomes an 'Evaluation Error' if no file could be analyzed during the job).
+
+    :returns: A 2D list (morphing_index, audio_index) of dicts (one dict of 'tt_' features per audio file)
+    """
+    n_workers = worker_pool.n_workers if worker_pool is not None else n_workers
+    shards_indices = [list(a) for a in np.array_split(np.arange(len(morphing_directories)), n_workers) if len(a) > 0]
+    # Prepare directories for results storage (matlab will store results as .csv in those dirs)
+    tt_results_shards = [
+        TimbreToolboxResults([morphing_directories[i] for i in indices], [audio_files_path[i] for i in indices])
+        for indices in shards_indices
+    ]
+    for tt_results in tt_results_shards:
+        tt_results.clean_stats_files()
+    with contextlib.ExitStack() as exit_stack:
+        options_file = exit_stack.enter_context(tempfile.NamedTemporaryFile('w', suffix='.json'))
+        # Temporary directories of Matlab processes are removed even if Matlab is killed
+        scratch_directory = exit_stack.enter_context(tempfile.TemporaryDirectory(prefix='tt_scratch_'))
+        write_options_file(Path(options_file.name), output_mode=output_mode, input_mode='files',
+                           eval_config=(make_eval_config(descriptors) if descriptors is not None else None),
+                           scratch_directory=Path(scratch_directory))
+        # build files that contain all audio files to be analyzed by a single Matlab instance
+        matlab_input_files = list()
+        for tt_results in tt_results_shards:
+            matlab_input_files.append(exit_stack.enter_context(tempfile.NamedTemporaryFile('w')))
+            # Absolute paths required (the matlab script will cd)
+            for audio_files_1d in tt_results.audio_files:
+                matlab_input_files[-1].writelines([str(a.resolve()) + "\n" for a in audio_files_1d])
+            matlab_input_files[-1].flush()
+        if worker_pool is not None:
+            run_jobs = [functools.partial(worker_pool.run_job, options_file=Path(options_file.name),
+                                          timeout=job_timeout, file_timeout=file_timeout)
+                        for _ in matlab_input_files]
+        else:
+            run_jobs = [functools.partial(_run_tt_process, timbre_toolbox_path, process_index=process_index,
+                                          verbose=verbose, options_file=Path(options_file.name),
+                                          file_timeout=file_timeout, job_timeout=job_timeout)
+                        for process_index in range(len(matlab_input_files))]
+        with multiprocessing.pool.ThreadPool(len(matlab_input_files)) as p:
+            p.starmap(_run_tt_files_list, [(run_job, Path(f.name), output_mode)
+                                           for run_job, f in zip(run_jobs, matlab_input_files)])
+    # Retrieve results (shards are contiguous: concatenated results keep the original order) and clean temp .csv files
+    #     Values of files that could not be evaluated by TimbreToolbox are NaNs
+    all_tt_features = list()
+    for tt_results in tt_results_shards:
+        values, descr_names, _ = tt_results.read_matrix()
+        tt_cols = [f'tt_{descr_name}' for descr_name in descr_names]
+        row = 0
+        for audio_files_1d in tt_results.audio_files:
+            all_tt_features.append([dict(zip(tt_cols, values[row + j, :].tolist())) for j in range(len(audio_files_1d))])
+            row += len(audio_files_1d)
+        tt_results.clean_stats_files()
+    return all_tt_features
+
+
+def _get_cached_tt_features(audio_files_path: List[List[Path]], known_tt_features: List[List[Optional[dict]]],
+                            features_cache: Optional[FeaturesCache], descriptors: Optional[Sequence[str]],
+                            tt_engine='matlab'):
+    """ Retrieves cached TimbreToolbox features of the files whose features are still unknown (known_tt_features is
+    modified in-place).
+
+    :returns: The 2D list of cache keys (None if no cache is used, or for the files that were already known)
+    """
+    if features_cache is None:
+        return None
+    if tt_engine == 'numpy':
+        def get_cache_key(audio_file: Path):
+            return timbretoolboxnumpy.get_cache_key(audio_content_hash(audio_file), descriptors)
+    else:
+        eval_config = make_eval_config(descriptors) if descriptors is not None else None
+
+        def get_cache_key(audio_file: Path):
+            return get_tt_cache_key(audio_content_hash(audio_file), eval_config)
+    cache_keys = [[(get_cache_key(a) if features is None else None)
+                   for a, features in zip(audio_files, tt_features_1d)]
+                  for audio_files, tt_features_1d in zip(audio_files_path, known_tt_features)]
+    flat_indices = [(i, j) for i, keys_1d in enumerate(cache_keys) for j, key in enumerate(keys_1d) if key is not None]
+    cached_features = features_cache.get_many([cache_keys[i][j] for i, j in flat_indices])
+    for (i, j), features in zip(flat_indices, cached_features):
+        if features is not None:  # Cached values are raw TimbreToolbox descriptors
+            known_tt_features[i][j] = {f'tt_{k}': v for k, v in features.items()}
+    return cache_keys
+
+
+def _put_tt_features_in_cache(all_tt_features: List[List[dict]], cache_keys: List[List[Optional[str]]],
+                              missing_indices: List[List[int]], features_cache: FeaturesCache):
+    """ Stores the newly computed TimbreToolbox features into the cache (except evaluation errors: NaN values). """
+    keys, values = list(), list()
+    for i, missing_indices_1d in enumerate(missing_indices):
+        for j in missing_indices_1d:
+            features = all_tt_features[i][j]
+            if len(features) > 0 and not np.all(np.isnan(list(features.values()))):
+                keys.append(cache_keys[i][j])
+                values.append({k.replace('tt_', '', 1): v for k, v in features.items()})
+    if len(keys) > 0:
+        features_cache.put_many(keys, values)
+
+
+def _list_audio_files(morphing_directories: List[Path], sort_function=sorted):
+    """ Retrieves and sorts all audio files that should be analyzed, for each morphing directory. """
+    audio_files_types = ('.wav', )  # TODO improve, soundfile does not support .mp3
+    audio_files_path = [list() for _ in morphing_directories]
+    for i, morphing_dir in enumerate(morphing_directories):
+        audio_files = sort_function([f for f in morphing_dir.glob('*') if (f.suffix in audio_files_types)])
+        assert len(audio_files) >= 3, \
+            f"Morphing directory {morphing_dir} must contain more than 3 audio files ({len(audio_files)} files found)"
+        audio_files_path[i] = audio_files
+    return audio_files_path
+
+
+def _compute_raw_features(
+        morphing_directories: List[Path],
+        audio_files_path: List[List[Path]],
+        timbre_toolbox_path: Optional[Union[str, Path]] = None,
+        verbose=False,
+        n_jobs=1,
+        features_cache: Optional[FeaturesCache] = None,
+        incremental=False,
+        pool: Optional[multiprocessing.pool.Pool] = None,
+        first_morphing_index=0,
+        tt_n_workers=1,
+        tt_worker_pool: Optional[TimbreToolboxWorkerPool] = None,
+        tt_output_mode='sound',
+        features_subset: Optional[Sequence[str]] = None,
+        tt_engine='matlab',
+        tt_file_timeout: Optional[float] = None,
+        tt_job_timeout: Optional[float] = None,
+):
+    """
+    Computes raw AudioCommons and TimbreToolbox features for all given morphing directories
+    (see compute_metrics for the arguments' description).
+
+    :param first_morphing_index: The morphing_index of the first given directory.
+    :returns: A list of dataframes of raw features, one for each morphing sequence
+    """
+    # Requested subset of features, and the TimbreToolbox descriptors it requires (None: all features and descriptors)
+    if features_subset is not None:
+        features_names = set(timbrefeatures.parse_timbre_features_arguments(features_subset))
+        tt_descriptors = sorted(set([timbretoolboxstats.get_descriptor_name(f)
+                                     for f in features_names if f.startswith('tt_')]))
+    else:
+        features_names, tt_descriptors = None, None
+    assert tt_engine in ('matlab', 'numpy'), f"Unknown TimbreToolbox engine '{tt_engine}'"
+    if tt_engine == 'numpy':  # Descriptors that are not implemented by the NumPy engine are not computed
+        tt_descriptors = timbretoolboxnumpy.get_supported_descriptors(tt_descriptors)
+
+    # Already-computed features (up-to-date files only) are loaded from the directories' manifests
+    if incremental:
+        extraction_params = {'timbral_extractor_version': timbral_models.Extractor.timbral_extractor_version,
+                             **_ac_extractor_params}
+        if tt_descriptors is not None:
+            extraction_params['tt_descriptors'] = tt_descriptors
+        if tt_engine == 'numpy':
+            extraction_params['tt_numpy_engine_version'] = timbretoolboxnumpy.engine_version
+        manifests = [MorphingManifest(d, extraction_params) for d in morphing_directories]
+        known_ac_features = [[m.get(a, 'ac') for a in audio_files]
+                             for m, audio_files in zip(manifests, audio_files_path)]
+        known_tt_features = [[m.get(a, 'tt') for a in audio_files]
+                             for m, audio_files in zip(manifests, audio_files_path)]
+    else:
+        manifests, known_ac_features = None, None
+        known_tt_features = [[None for _ in audio_files] for audio_files in audio_files_path]
+
+    # Only the files whose TimbreToolbox features are unknown (not in the manifest, nor in the cache) are analyzed
+    compute_tt_features = (timbre_toolbox_path is not None or tt_worker_pool is not None or tt_engine == 'numpy') \
+        and (tt_descriptors is None or len(tt_descriptors) > 0)
+    if compute_tt_features:
+        tt_cache_keys = _get_cached_tt_features(audio_files_path, known_tt_features, features_cache, tt_descriptors,
+                                                tt_engine)
+        tt_missing_indices = [[j for j, features in enumerate(tt_features_1d) if features is None]
+                              for tt_features_1d in known_tt_features]
+        tt_indices = [i for i, missing_indices in enumerate(tt_missing_indices) if len(missing_indices) > 0]
+    else:
+        tt_cache_keys, tt_missing_indices, tt_indices = None, None, list()
+        if verbose:
+            print("TimbreToolbox path was not provided, so the corresponding audio features won't be computed")
+
+    with contextlib.ExitStack() as exit_stack:
+        n_audio_files = sum([len(audio_files) for audio_files in audio_files_path])
+        run_matlab = len(tt_indices) > 0 and tt_engine == 'matlab'
+        if run_matlab and pool is None and min(_resolve_n_jobs(n_jobs), n_audio_files) > 1:
+            # AudioCommons worker processes are forked before the TimbreToolbox thread is started
+            pool = exit_stack.enter_context(multiprocessing.Pool(min(_resolve_n_jobs(n_jobs), n_audio_files)))
+        # TimbreToolbox (Matlab subprocess) runs in a background thread, while AC features are being computed
+        if run_matlab:
+            tt_thread_pool = exit_stack.enter_context(multiprocessing.pool.ThreadPool(1))
+            tt_async_result = tt_thread_pool.apply_async(
+                _compute_tt_features,
+                (Path(timbre_toolbox_path) if timbre_toolbox_path is not None else None,
+                 [morphing_directories[i] for i in tt_indices],
+                 [[audio_files_path[i][j] for j in tt_missing_indices[i]] for i in tt_indices]),
+                {'verbose': verbose, 'n_workers': tt_n_workers, 'worker_pool': tt_worker_pool,
+                 'output_mode': tt_output_mode, 'descriptors': tt_descriptors, 'file_timeout': tt_file_timeout,
+                 'job_timeout': tt_job_timeout}
+            )
+        else:
+            tt_async_result = None
+
+        # compute AudioCommons Timbral Models features
+        if verbose:
+            print("Computing AudioCommons Timbral Models features...")
+        all_ac_features = _compute_ac_features(audio_files_path, n_jobs=n_jobs, features_cache=features_cache,
+                                               known_features=known_ac_features, pool=pool)
+
+        if compute_tt_features:
+            all_tt_features = known_tt_features
+            if tt_async_result is not None:
+                # Waits for the Matlab process to end (and re-raises its exceptions, if any)
+                for i, tt_features_1d in zip(tt_indices, tt_async_result.get()):
+                    for j, features in zip(tt_missing_indices[i], tt_features_1d):
+                        all_tt_features[i][j] = features
+            elif len(tt_indices) > 0:  # NumPy engine: all missing files are analyzed in batches
+                if verbose:
+                    print("Computing TimbreToolbox features (NumPy engine)...")
+                missing_indices = [(i, j) for i in tt_indices for j in tt_missing_indices[i]]
+                missing_tt_features = timbretoolboxnumpy.compute_files_descriptors(
+                    [audio_files_path[i][j] for i, j in missing_indices], tt_descriptors)
+                for (i, j), features in zip(missing_indices, missing_tt_features):
+                    all_tt_features[i][j] = {f'tt_{k}': v for k, v in features.items()}
+            if len(tt_indices) > 0 and features_cache is not None:
+                _put_tt_features_in_cache(all_tt_features, tt_cache_keys, tt_missing_indices, features_cache)
+            if tt_descriptors is not None:  # Discards the descriptors which were evaluated only as dependencies
+                all_tt_features = [[{k: v for k, v in features.items()
+                                     if timbretoolboxstats.get_descriptor_name(k) in tt_descriptors}
+                                    for features in tt_features_1d] for tt_features_1d in all_tt_features]
+        else:
+            all_tt_features = None
+
+    if manifests is not None:
+        for morphing_index, (manifest, audio_files) in enumerate(zip(manifests, audio_files_path)):
+            for audio_index, a in enumerate(audio_files):
+                manifest.set(a, 'ac', all_ac_features[morphing_index][audio_index])
+                if all_tt_features is not None:
+                    manifest.set(a, 'tt', all_tt_features[morphing_index][audio_index])
+            manifest.save(audio_files)
+
+    # Build a dataframe for each morphing sequence (ACTM and TT features in the same rows). Manifests keep all the
+    #     features of the evaluated descriptors, but only the requested features are returned
+    def _select_features(features: Dict[str, float]):
+        return features if features_names is None else {k: v for k, v in features.items() if k in features_names}
+
+    all_raw_features = list()
+    for morphing_index, (morphing_dir, audio_files) in enumerate(zip(morphing_directories, audio_files_path)):
+        all_raw_features.append(pd.DataFrame([
+            {
+                'morphing_index': first_morphing_index + morphing_index,
+                'morphing_name': morphing_dir.name,
+                'morphing_dir': str(morphing_dir),
+                'audio_index': audio_index,
+                'audio_file': str(a),
+                **_select_features(all_ac_features[morphing_index][audio_index]),
+                **(_select_features(all_tt_features[morphing_index][audio_index])
+                   if all_tt_features is not None else dict())
+            }
+            for audio_index, a in enumerate(audio_files)
+        ]))
+    return all_raw_features
+
+
+def _compute_morphing_metrics(timbre_features: timbrefeatures.TimbreFeatures):
+    """
+    Computes the non-smoothness and non-linearity of each feature, for each morphing sequence. All sequences are
+    gathered into a (morphing, step, feature) 3D array (zero-padded if sequences have different lengths), such that
+    metrics are computed for all morphings and features at once.
+
+    :returns: A dataframe with 2 rows for each morphing ('nonsmoothness' and 'nonlinearity' metrics)
+    """
+    postproc_df = timbre_features.postproc_df
+    morphing_description_cols = [c for c in postproc_df.columns if c.startswith('morphing_')]
+    # Rows of a morphing sequence are sorted by step (stable sort: steps of each sequence keep their order)
+    rows_order = np.argsort(postproc_df.morphing_index.values, kind='stable')
+    morphing_indices = postproc_df.morphing_index.values[rows_order]
+    _, first_rows, lengths = np.unique(morphing_indices, return_index=True, return_counts=True)
+    n_morphings, max_length = len(lengths), lengths.max()
+    step_indices = np.arange(len(rows_order)) - np.repeat(first_rows, lengths)
+    features = np.zeros((n_morphings, max_length, len(timbre_features.feature_cols)))
+    features[np.repeat(np.arange(n_morphings), lengths), step_indices, :] \
+        = postproc_df[timbre_features.feature_cols].values[rows_order, :]
+    is_valid_step = np.arange(max_length)[np.newaxis, :] < lengths[:, np.newaxis]  # (morphing, step) mask
+    step_h = 1.0 / (lengths - 1.0)
+
+    # Smoothness: https://proceedings.neurips.cc/paper/2019/file/7d12b66d3df6af8d429c1a357d8b9e1a-Paper.pdf
+    # Second-order central difference (only where the 3 steps are valid), then compute the RMS of the smaller array
+    #   We'll name it "nonsmoothness" here
+    smoothness = (features[:, 2:, :] - 2.0 * features[:, 1:-1, :] + features[:, :-2, :]) \
+        / (step_h ** 2)[:, np.newaxis, np.newaxis]
+    smoothness = np.where(is_valid_step[:, 2:, np.newaxis], smoothness, 0.0)
+    nonsmoothness = np.sqrt((smoothness ** 2).sum(axis=1) / (lengths - 2.0)[:, np.newaxis])
+    # non-linearity, quantified as the RMS of the error vs. the ideal linear curve
+    first_values, last_values = features[:, 0, :], features[np.arange(n_morphings), lengths - 1, :]
+    linear_step = (last_values - first_values) / (lengths - 1.0)[:, np.newaxis]
+    target_linear_values = first_values[:, np.newaxis, :] \
+        + np.arange(max_length)[np.newaxis, :, np.newaxis] * linear_step[:, np.newaxis, :]
+    # Exclude padded steps, and the last step (its target value is the last value itself)
+    is_error_step = is_valid_step & (np.arange(max_length)[np.newaxis, :] < (lengths - 1)[:, np.newaxis])
+    linear_error = np.where(is_error_step[:, :, np.newaxis], features - target_linear_values, 0.0)
+    nonlinearity = np.sqrt((linear_error ** 2).sum(axis=1) / lengths[:, np.newaxis])
+
+    # Build the output dataframe: 2 consecutive rows for each morphing
+    all_morphing_metrics = postproc_df[morphing_description_cols].iloc[rows_order[np.repeat(first_rows, 2)]]
+    all_morphing_metrics = all_morphing_metrics.reset_index(drop=True)
+    all_morphing_metrics['metric'] = np.tile(metrics_names, n_morphings)
+    metrics_values = np.stack((nonsmoothness, nonlinearity), axis=1).reshape(2 * n_morphings, -1)
+    return pd.concat((all_morphing_metrics,
+                      pd.DataFrame(metrics_values, columns=timbre_features.feature_cols)), axis=1)
+
+
+def _finalize_metrics(all_morphing_metrics: pd.DataFrame, feature_cols: List[str], positive_metrics: bool,
+                      metrics_means: Optional[Dict[str, Dict[str, float]]] = None):
+    """ Normalizes metrics using the given means (if not None), then changes their sign if required. """
+    if metrics_means is not None:
+        for m in metrics_names:
+            means = pd.Series(metrics_means[m])[feature_cols]
+            all_morphing_metrics.loc[all_morphing_metrics.metric == m, feature_cols] /= means
+    if not positive_metrics:  # Return smoothness/linearity instead of nonsmoothness/nonlinearity
+        all_morphing_metrics[feature_cols] *= -1.0
+        all_morphing_metrics['metric'] = all_morphing_metrics['metric'].apply(lambda x: x.replace('non', ''))
+    return all_morphing_metrics
 
 
 def compute_metrics(
@@ -18,6 +483,16 @@ def compute_metrics(
         normalize=False,
         verbose=False,
         sort_function=sorted,
+        n_jobs=1,
+        features_cache: Optional[Union[str, Path, FeaturesCache]] = None,
+        incremental=False,
+        tt_n_workers=1,
+        tt_worker_pool: Optional[TimbreToolboxWorkerPool] = None,
+        tt_output_mode='sound',
+        features_subset: Optional[Sequence[str]] = None,
+        tt_engine='matlab',
+        tt_file_timeout: Optional[float] = None,
+        tt_job_timeout: Optional[float] = None,
 ):
     """
     Computes morphing metrics (non-smoothness and non-linearity) for sequences of sounds stored in individual
@@ -34,113 +509,203 @@ def compute_metrics(
         their mean is 1.0.
     :param verbose: bool
     :param sort_function: An optional custom function to sort each morphed sequence of files it its own  directory.
+    :param n_jobs: Number of processes used to compute AudioCommons features (1 file per task). If -1, all
+        available CPUs will be used. Results are identical to the serial (n_jobs=1) computation.
+    :param features_cache: A FeaturesCache instance, or the path to its database file. Features from audio files
+        which have already been analyzed (identical audio content) will be retrieved from this cache.
+    :param incremental: If True, the features of each audio file are stored in a manifest file inside its morphing
+        directory. Later calls will analyze only the new or modified files (TimbreToolbox will analyze only the
+        directories which contain new or modified files).
+    :param tt_n_workers: Number of Matlab instances that run TimbreToolbox in parallel (morphing directories are
+        split between these instances). A Matlab instance uses only 1 CPU.
+    :param tt_worker_pool: An already-running pool of Matlab workers, to be used instead of starting new Matlab
+        instances (timbre_toolbox_path and tt_n_workers are then ignored). See TimbreToolboxWorkerPool.
+    :param tt_output_mode: 'sound' (default): Matlab writes one stats CSV file next to each audio file.
+        'directory': Matlab writes a single consolidated stats file in each morphing directory, which is much faster
+        when many small files are analyzed and/or stored on a network file system.
+    :param features_subset: Optional arguments for timbrefeatures.parse_timbre_features_arguments, e.g.
+        ['ac_*', 'tt_*', '__no_high_corr__']. If given, only these features are returned, and TimbreToolbox
+        evaluates only the descriptors they require, which is much faster. AudioCommons features are always all
+        computed.
+    :param tt_engine: 'matlab' (default): TimbreToolbox features are computed by Matlab (if timbre_toolbox_path or
+        tt_worker_pool is given). 'numpy': the descriptors implemented by the timbretoolboxnumpy module are computed
+        in Python, without Matlab (the other descriptors are not computed). NumPy values are approximations of the
+        TimbreToolbox values, thus the two engines should not be mixed, and NumPy values are not normalized (see
+        timbrefeatures.TimbreFeatures).
+    :param tt_file_timeout: Watchdog: if Matlab's analysis of a single audio file lasts longer (seconds), Matlab
+        is killed (or the worker is restarted) and the analysis resumes from the next file. The features of the
+        timed-out file are considered as an 'Evaluation Error' (they are replaced by the median values).
+    :param tt_job_timeout: Watchdog: maximum duration (seconds) of a Matlab instance (or of a worker's job). If it
+        expires, the analysis resumes from the file being analyzed (which is considered as an 'Evaluation Error' if
+        no file could be analyzed before the timeout).
     :returns: morphing_metrics, timbre_features (Pandas DataFrames)
     """
-    metrics_names = ('nonsmoothness', 'nonlinearity')
-    # Retrieve and sort all audio files that should be analyzed
-    audio_files_types = ('.wav', )  # TODO improve, soundfile does not support .mp3
     morphing_directories = [Path(d) for d in morphing_directories]
-    audio_files_path = [list() for _ in morphing_directories]
-    for i, morphing_dir in enumerate(morphing_directories):
-        audio_files = sort_function([f for f in morphing_dir.glob('*') if (f.suffix in audio_files_types)])
-        assert len(audio_files) >= 3, \
-            f"Morphing directory {morphing_dir} must contain more than 3 audio files ({len(audio_files)} files found)"
-        audio_files_path[i] = audio_files
-
-    # compute AudioCommons Timbral Models features
-    if verbose:
-        print("Computing AudioCommons Timbral Models features...")
-    all_ac_features = list()
-    for morphing_index, (morphing_dir, audio_files) in enumerate(zip(morphing_directories, audio_files_path)):
-        all_ac_features.append(list())
-        for audio_index, a in enumerate(audio_files):
-            ac_features = timbral_models.Extractor.timbral_extractor(str(a), exclude_reverb=True)
-            ac_features = {f'ac_{k}': v for k, v in ac_features.items()}
-            all_ac_features[-1].append({
-                'morphing_index': morphing_index,
-                'morphing_name': morphing_dir.name,
-                'morphing_dir': str(morphing_dir),
-                'audio_index': audio_index,
-                'audio_file': str(a),
-                **ac_features
-            })
-    all_ac_features = [pd.DataFrame(features) for features in all_ac_features]
-
-    if timbre_toolbox_path is not None:
-        # Prepare directories for results storage (matlab will store results as .csv in those dirs)
-        tt_results = TimbreToolboxResults(morphing_directories, audio_files_path)
-        tt_results.clean_stats_files()
-        # build a file that contains all directories to be analyzed in a single Matlab call
-        with tempfile.NamedTemporaryFile('w') as matlab_input_file:
-            # Absolute paths required (the matlab script will cd)
-            for d in morphing_directories:
-                matlab_input_file.write(str(d.resolve()) + "\n")
-            matlab_input_file.flush()
-            # TODO run TT
-            # TODO pre-cleanup
-            tt_process = TimbreToolboxProcess(
-                Path(timbre_toolbox_path), Path(matlab_input_file.name), verbose=verbose, process_index=0)
-            tt_process.run()
-        # Retrieve results and clean temp .csv files
-        all_tt_features = tt_results.read()
-        tt_results.clean_stats_files()
-        # And transform features into proper dataframes (similar to AC dfs)
-        for morphing_index, _ in enumerate(morphing_directories):
-            for j in range(len(all_tt_features[morphing_index])):
-                all_tt_features[morphing_index][j] = \
-                    {f'tt_{k}': v for k, v in all_tt_features[morphing_index][j].items()}
-            all_tt_features[morphing_index] = pd.DataFrame(all_tt_features[morphing_index])
-    else:
-        all_tt_features = None
-        if verbose:
-            print("TimbreToolbox path was not provided, so the corresponding audio features won't be computed")
-
-    # Concatenate all morphing sequences into a long dataframes
-    #     concatenate ACTM and TT features into wider dataframes,
-    all_ac_features = pd.concat(all_ac_features, axis=0)
-    if all_tt_features is not None:
-        all_tt_features = pd.concat(all_tt_features, axis=0)
-        all_raw_features = pd.concat((all_ac_features, all_tt_features), axis=1)
-    else:
-        all_raw_features = all_ac_features
+    audio_files_path = _list_audio_files(morphing_directories, sort_function)
+    # Concatenate all morphing sequences into a long dataframe
+    all_raw_features = pd.concat(_compute_raw_features(
+        morphing_directories, audio_files_path, timbre_toolbox_path, verbose=verbose, n_jobs=n_jobs,
+        features_cache=_get_features_cache(features_cache), incremental=incremental, tt_n_workers=tt_n_workers,
+        tt_worker_pool=tt_worker_pool, tt_output_mode=tt_output_mode, features_subset=features_subset,
+        tt_engine=tt_engine, tt_file_timeout=tt_file_timeout, tt_job_timeout=tt_job_timeout
+    ), axis=0)
 
     # feature values post-processing (log scales, normalizations, ...)
-    timbre_features = timbrefeatures.TimbreFeatures(all_raw_features)
+    timbre_features = timbrefeatures.TimbreFeatures(all_raw_features, tt_engine=tt_engine)
 
     # Compute morphing metrics for each morphing directory, then aggregate results into a dataframe
-    all_morphing_metrics = list()
-    morphing_description_cols = [c for c in all_raw_features.columns if c.startswith('morphing_')]
-    for morphing_index, _ in enumerate(morphing_directories):
-        morphing_features = timbre_features.postproc_df[timbre_features.postproc_df.morphing_index == morphing_index]
-        morphing_metrics = {m: dict() for m in metrics_names}
-        step_h = 1.0 / (len(morphing_features) - 1.0)
-        for feature_name in timbre_features.feature_cols:
-            feature_values = morphing_features[feature_name].values
-            # Smoothness: https://proceedings.neurips.cc/paper/2019/file/7d12b66d3df6af8d429c1a357d8b9e1a-Paper.pdf
-            # Second-order central difference using a conv kernel, then compute the RMS of the smaller array
-            #   We'll name it "nonsmoothness" here
-            smoothness = np.convolve(feature_values, [1.0, -2.0, 1.0], mode='valid') / (step_h ** 2)
-            morphing_metrics['nonsmoothness'][feature_name] = np.sqrt( (smoothness ** 2).mean() )
-            # non-linearity, quantified as the RMS of the error vs. the ideal linear curve
-            target_linear_values = np.linspace(feature_values[0], feature_values[-1], num=feature_values.shape[0]).T
-            morphing_metrics['nonlinearity'][feature_name] = np.sqrt( ((feature_values - target_linear_values) ** 2).mean() )
-        for m in metrics_names:
-            all_morphing_metrics.append({
-                **dict(morphing_features[morphing_description_cols].iloc[0]),
-                'metric': m,
-                **morphing_metrics[m]
-            })
-    all_morphing_metrics = pd.DataFrame(all_morphing_metrics)
+    all_morphing_metrics = _compute_morphing_metrics(timbre_features)
 
     # Normalization, if required
     if normalize:
-        for m in metrics_names:
-            means = all_morphing_metrics[all_morphing_metrics.metric == m][timbre_features.feature_cols].mean()
-            all_morphing_metrics.loc[all_morphing_metrics.metric == m, timbre_features.feature_cols] /= means
-    if not positive_metrics:  # Return smoothness/linearity instead of nonsmoothness/nonlinearity
-        all_morphing_metrics[timbre_features.feature_cols] *= -1.0
-        all_morphing_metrics['metric'] = all_morphing_metrics['metric'].apply(lambda x: x.replace('non', ''))
+        metrics_means = {m: all_morphing_metrics[all_morphing_metrics.metric == m][timbre_features.feature_cols].mean()
+                         for m in metrics_names}
+    else:
+        metrics_means = None
+    all_morphing_metrics = _finalize_metrics(
+        all_morphing_metrics, timbre_features.feature_cols, positive_metrics, metrics_means)
 
     return all_morphing_metrics, timbre_features.postproc_df
 
 
+def iter_metrics(
+        morphing_directories: Sequence[Union[str, Path]],
+        timbre_toolbox_path: Optional[Union[str, Path]] = None,
+        positive_metrics=False,
+        metrics_means: Optional[Dict[str, Dict[str, float]]] = None,
+        verbose=False,
+        sort_function=sorted,
+        n_jobs=1,
+        features_cache: Optional[Union[str, Path, FeaturesCache]] = None,
+        incremental=False,
+        batch_size: Optional[int] = None,
+        tt_n_workers=1,
+        tt_worker_pool: Optional[TimbreToolboxWorkerPool] = None,
+        tt_output_mode='sound',
+        features_subset: Optional[Sequence[str]] = None,
+        tt_engine='matlab',
+        tt_file_timeout: Optional[float] = None,
+        tt_job_timeout: Optional[float] = None,
+) -> Iterator[Tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    Generator version of compute_metrics: directories are analyzed in small batches, and the metrics of each
+    morphing are yielded as soon as its batch has been analyzed. Memory usage does not depend on the number of
+    morphing directories.
+
+    Features are post-processed independently for each morphing sequence, using the frozen (pre-computed)
+    normalization statistics. The only difference with compute_metrics is that invalid feature values are replaced
+    by the median value of their own sequence (instead of the median value of all sequences).
+
+    See compute_metrics for the arguments that are not described below.
+
+    :param metrics_means: Frozen normalization values (the mean of each non-smoothness and non-linearity, for each
+        feature) e.g. computed from a reference set of morphings. Must be a dict with 'nonsmoothness' and
+        'nonlinearity' keys, whose values are {feature_name: mean_value} dicts. If None, metrics are not normalized.
+    :param batch_size: Number of morphing directories that are analyzed together. Defaults to the number of
+        processes used to compute AudioCommons features.
+    :returns: An iterator of (morphing_metrics, timbre_features) dataframes, one tuple for each morphing
+    """
+    morphing_directories = [Path(d) for d in morphing_directories]
+    n_jobs = _resolve_n_jobs(n_jobs)
+    batch_size = batch_size if batch_size is not None else max(1, n_jobs)
+    features_cache = _get_features_cache(features_cache)
+    pool = multiprocessing.Pool(n_jobs) if n_jobs > 1 else None
+    try:
+        for first_morphing_index in range(0, len(morphing_directories), batch_size):
+            batch_directories = morphing_directories[first_morphing_index:first_morphing_index + batch_size]
+            batch_audio_files_path = _list_audio_files(batch_directories, sort_function)
+            batch_raw_features = _compute_raw_features(
+                batch_directories, batch_audio_files_path, timbre_toolbox_path, verbose=verbose, n_jobs=n_jobs,
+                features_cache=features_cache, incremental=incremental, pool=pool,
+                first_morphing_index=first_morphing_index, tt_n_workers=tt_n_workers, tt_worker_pool=tt_worker_pool,
+                tt_output_mode=tt_output_mode, features_subset=features_subset, tt_engine=tt_engine,
+                tt_file_timeout=tt_file_timeout, tt_job_timeout=tt_job_timeout
+            )
+            for raw_features in batch_raw_features:
+                timbre_features = timbrefeatures.TimbreFeatures(raw_features, tt_engine=tt_engine)
+                morphing_metrics = _finalize_metrics(
+                    _compute_morphing_metrics(timbre_features), timbre_features.feature_cols, positive_metrics,
+                    metrics_means
+                )
+                yield morphing_metrics, timbre_features.postproc_df
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def compute_metrics_from_arrays(audio: np.ndarray, fs: int, positive_metrics=False, normalize=False, n_jobs=1,
+                                tt_engine: Optional[str] = None):
+    """
+    Computes morphing metrics (AudioCommons features, and optionally TimbreToolbox features) for sequences of sounds
+    given as a single 3D array, without writing any audio file. See compute_metrics_from_array_list for the other
+    arguments.
+
+    :param audio: Array of mono audio samples, with shape (n_morphings, n_steps, n_samples).
+    """
+    assert len(audio.shape) == 3, f"audio must be a 3D array (n_morphings, n_steps, n_samples), got {audio.shape}"
+    # Indexing the 3D array returns views (not copies) of each 1D audio signal
+    return compute_metrics_from_array_list(audio, fs, positive_metrics=positive_metrics, normalize=normalize,
+                                           n_jobs=n_jobs, tt_engine=tt_engine)
+
+
+def compute_metrics_from_array_list(audio: Sequence[Sequence[np.ndarray]], fs: int, positive_metrics=False,
+                                    normalize=False, n_jobs=1, tt_engine: Optional[str] = None):
+    """
+    Computes morphing metrics (AudioCommons features, and optionally TimbreToolbox features) for sequences of sounds
+    given as arrays of audio samples, without writing any audio file. Sequences can have different lengths, and
+    sounds different durations.
+
+    :param audio: A list of morphing sequences, each sequence being a list of mono audio arrays. Arrays are given
+        directly to the timbral extractor, and are not copied (when n_jobs > 1, worker processes inherit the arrays
+        if they are forked - the default on Linux - otherwise arrays are sent to the processes).
+    :param fs: Sampling rate of all audio arrays.
+    :param positive_metrics: see compute_metrics
+    :param normalize: see compute_metrics
+    :param n_jobs: see compute_metrics
+    :param tt_engine: If 'numpy', TimbreToolbox features are also computed by the NumPy engine (see
+        compute_metrics). Arrays of equal length are analyzed together, in batches. If None, only AudioCommons
+        features are computed.
+    :returns: morphing_metrics, timbre_features (Pandas DataFrames)
+    """
+    assert tt_engine in (None, 'numpy'), f"TimbreToolbox engine '{tt_engine}' cannot be used with audio arrays"
+    for morphing_index, audio_sequence in enumerate(audio):
+        assert len(audio_sequence) >= 3, \
+            f"Morphing {morphing_index} must contain more than 3 audio arrays ({len(audio_sequence)} arrays found)"
+    indices = [(morphing_index, audio_index, fs)
+               for morphing_index, audio_sequence in enumerate(audio) for audio_index in range(len(audio_sequence))]
+    n_jobs = min(_resolve_n_jobs(n_jobs), len(indices))
+    if n_jobs > 1:
+        chunksize = max(1, len(indices) // (n_jobs * 8))
+        with multiprocessing.Pool(n_jobs, initializer=_set_shared_audio_arrays, initargs=(audio, )) as p:
+            flat_ac_features = p.map(_extract_ac_features_from_shared_array, indices, chunksize=chunksize)
+    else:
+        _set_shared_audio_arrays(audio)
+        try:
+            flat_ac_features = [_extract_ac_features_from_shared_array(i) for i in indices]
+        finally:
+            _set_shared_audio_arrays(None)
+    if tt_engine == 'numpy':
+        flat_tt_features = [{f'tt_{k}': v for k, v in features.items()} for features in
+                            timbretoolboxnumpy.compute_descriptors([audio[i][j] for i, j, _ in indices], fs)]
+    else:
+        flat_tt_features = [dict() for _ in indices]
+
+    all_raw_features, flat_index = list(), 0
+    for morphing_index, audio_sequence in enumerate(audio):
+        all_raw_features.append(pd.DataFrame([
+            {'morphing_index': morphing_index, 'audio_index': audio_index, **flat_ac_features[flat_index + audio_index],
+             **flat_tt_features[flat_index + audio_index]}
+            for audio_index in range(len(audio_sequence))
+        ]))
+        flat_index += len(audio_sequence)
+    all_raw_features = pd.concat(all_raw_features, axis=0)
+    timbre_features = timbrefeatures.TimbreFeatures(all_raw_features, tt_engine=tt_engine or 'matlab')
+    all_morphing_metrics = _compute_morphing_metrics(timbre_features)
+    if normalize:
+        metrics_means = {m: all_morphing_metrics[all_morphing_metrics.metric == m][timbre_features.feature_cols].mean()
+                         for m in metrics_names}
+    else:
+        metrics_means = None
+    all_morphing_metrics = _finalize_metrics(
+        all_morphing_metrics, timbre_features.feature_cols, positive_metrics, metrics_means)
+    return all_morphing_metrics, timbre_features.postproc_df
@@ -20,6 +20,10 @@ from . import timbral_util, timbral_hardness, timbral_depth, timbral_brightness,
     timbral_sharpness, timbral_booming, timbral_reverb
 
 
+# Must be increased when a modification changes the extracted values (used to invalidate cached features)
+timbral_extractor_version = '0.4'
+
+
 def timbral_extractor(fname, fs=0, dev_output=False, phase_correction=False, clip_output=False,
                       exclude_reverb=False, output_type='dictionary'):
     """
@@ -73,16 +77,16 @@ def timbral_extractor(fname, fs=0, dev_output=False, phase_correction=False, cli
         # read audio file only once and pass arrays to algorithms
         try:
             audio_samples, fs = sf.read(fname)
-            # making an array again for copying purposes
-            multi_channel_audio = np.array(audio_samples)
+            # making an array again for copying purposes (multi-channel audio is used by the reverb model only)
+            multi_channel_audio = np.array(audio_samples) if not exclude_reverb else None
         except:
             print('Soundfile failed to load: ' + str(fname))
             raise TypeError('Unable to read audio file.')
     elif hasattr(fname, 'shape'):
         if fs==0:
             raise ValueError('If giving function an array, \'fs\' must be specified')
-        audio_samples = fname
-        multi_channel_audio = np.array(fname)
+        audio_samples = fname  # The input array is not modified by the following computations: no copy
+        multi_channel_audio = np.array(fname) if not exclude_reverb else None
     else:
         raise ValueError('Input must be either a string or a numpy array.')
 
@@ -102,13 +106,10 @@ def timbral_extractor(fname, fs=0, dev_output=False, phase_correction=False, cli
 
     # Pre-computed audio data, which is going to be used by several individual feature extractors
     windowed_audio = timbral_util.window_audio(audio_samples_2nd_read_pass)  # Original: always 4096 window size
-    # specific_loudness is computed for each windowed audio frame
-    windows_specific_loudness = list()
-    windows_RMS = list()
-    for i in range(windowed_audio.shape[0]):
-        N_entire, N_single = timbral_util.specific_loudness(windowed_audio[i, :], fs=fs)
-        windows_specific_loudness.append((N_entire, N_single, ))
-        windows_RMS.append(np.sqrt(np.mean(windowed_audio[i, :] * windowed_audio[i, :])))
+    # specific_loudness is computed for all windowed audio frames at once (third-octave filters are applied once)
+    windows_N_entire, windows_N_single = timbral_util.specific_loudness_batch(windowed_audio, fs=fs)
+    windows_specific_loudness = list(zip(windows_N_entire, windows_N_single))
+    windows_RMS = np.sqrt(np.mean(windowed_audio * windowed_audio, axis=1))
     # 20Hz highpass audio - run 3 times to get -18dB per octave - unstable filters produced when using a 6th order
     hp20Hz_audio_samples = timbral_util.filter_audio_highpass(audio_samples_2nd_read_pass, crossover=20, fs=fs)
     hp20Hz_audio_samples = timbral_util.filter_audio_highpass(hp20Hz_audio_samples, crossover=20, fs=fs)
@@ -119,7 +120,7 @@ def timbral_extractor(fname, fs=0, dev_output=False, phase_correction=False, cli
         'fs': fs,
         'windowed_audio': windowed_audio,
         'windows_specific_loudness': windows_specific_loudness,
-        'windows_RMS': np.asarray(windows_RMS),
+        'windows_RMS': windows_RMS,
         'hp20Hz_audio_samples': hp20Hz_audio_samples
     }
 
@@ -1,11 +1,17 @@
 from __future__ import division, print_function
+import functools
+import inspect
 import numpy as np
 import librosa
 import soundfile as sf
-from scipy.signal import butter, lfilter, spectrogram
+from scipy.signal import butter, cheby1, lfilter, spectrogram
 import scipy.stats
 import pyloudnorm as pyln
 import six
+try:
+    import numba
+except ImportError:  # Optional: sample_and_hold_envelope_batch then uses its NumPy implementation
+    numba = None
 
 """
   The timbral util is a collection of functions that can be accessed by the individual timbral models.  These can be 
@@ -29,6 +35,49 @@ import six
 """
 
 
+# Filter designs only depend on their arguments (sampling frequency, cut-off frequencies, order, ...) but the
+# timbral models request the same few designs thousands of times per file. All design functions decorated with
+# memoized_filter_design share a single bounded LRU registry.
+FILTER_DESIGN_CACHE_SIZE = 256
+
+
+@functools.lru_cache(maxsize=FILTER_DESIGN_CACHE_SIZE)
+def _cached_filter_design(design_function, args):
+    coefficients = design_function(*args)
+    # Coefficients are shared between all callers: they must not be modified in-place
+    for c in coefficients:
+        c.flags.writeable = False
+    return coefficients
+
+
+def memoized_filter_design(design_function):
+    """ Decorator which memoizes a filter design function in the shared LRU filter design registry.
+    The cache key is the design function and all of its (bound, defaults applied) arguments, such that
+    e.g. f(100, 44100) and f(100, fs=44100, order=2) share the same entry. """
+    signature = inspect.signature(design_function)
+
+    @functools.wraps(design_function)
+    def wrapper(*args, **kwargs):
+        bound_args = signature.bind(*args, **kwargs)
+        bound_args.apply_defaults()
+        try:
+            return _cached_filter_design(design_function, bound_args.args)
+        except TypeError:  # Unhashable arguments (e.g. arrays of frequencies): design without caching
+            return design_function(*bound_args.args)
+
+    return wrapper
+
+
+def filter_design_cache_info():
+    """ Returns the (hits, misses, maxsize, currsize) statistics of the shared filter design registry. """
+    return _cached_filter_design.cache_info()
+
+
+def clear_filter_design_cache():
+    """ Empties the shared filter design registry and resets its hit/miss counters. """
+    _cached_filter_design.cache_clear()
+
+
 class ZeroVolumeError(ValueError):
     def __init__(self, message):
         super().__init__(message)
@@ -100,9 +149,7 @@ def filter_audio_highpass(audio_samples, crossover, fs, order=2):
 
     :return:                filtered array.
     """
-    nyq = 0.5 * fs
-    xfreq = crossover / nyq
-    b, a = butter(order, xfreq, 'high')
+    b, a = butter_highpass(crossover, fs, order=order)
     y = lfilter(b, a, audio_samples)
     return y
 
@@ -117,13 +164,30 @@ def filter_audio_lowpass(audio_samples, crossover, fs, order=2):
 
     :return:                filtered array.
     """
+    b, a = butter_lowpass(crossover, fs, order=order)
+    y = lfilter(b, a, audio_samples)
+    return y
+
+
+@memoized_filter_design
+def butter_highpass(crossover, fs, order=2):
+    """ Design a butterworth high-pass filter, with a -3dB point of crossover """
+    nyq = 0.5 * fs
+    xfreq = crossover / nyq
+    b, a = butter(order, xfreq, 'high')
+    return b, a
+
+
+@memoized_filter_design
+def butter_lowpass(crossover, fs, order=2):
+    """ Design a butterworth low-pass filter, with a -3dB point of crossover """
     nyq = 0.5 * fs
     xfreq = crossover / nyq
     b, a = butter(order, xfreq, 'low')
-    y = lfilter(b, a, audio_samples)
-    return y
+    return b, a
 
 
+@memoized_filter_design
 def butter_bandpass(lowcut, highcut, fs, order=2):
     """ Design a butterworth bandpass filter """
     nyq = 0.5 * fs
@@ -259,38 +323,124 @@ def sample_and_hold_envelope_calculation(audio_samples, fs, decay_time=0.2, hold
 
     :return:                envelope of audio_samples
     """
-    # rectify the audio signal
-    abs_samples = abs(audio_samples)
-    envelope = []
-
-    # set parameters for envelope function
-    decay = max(abs_samples) / (decay_time * fs)  # decay rate relative to peak level of audio signal
-    hold_samples = hold_time * fs  # number of samples to hold before decay
-    hold_counter = 0
-    previous_sample = 0.0
-
-    # perform the sample, hold, and decay function to obtain envelope
-    for sample in abs_samples:
-        if sample >= previous_sample:
-            envelope.append(sample)
-            previous_sample = sample
-            hold_counter = 0
+    return sample_and_hold_envelope_batch(np.asarray(audio_samples)[np.newaxis, :], fs,
+                                          decay_time=decay_time, hold_time=hold_time)[0]
+
+
+def sample_and_hold_envelope_batch(audio_samples, fs, decay_time=0.2, hold_time=0.01, use_numba=None):
+    """
+     Batched version of sample_and_hold_envelope_calculation, which returns the same values (bit-identical).
+     Each signal is rectified, then its envelope follows rising samples, holds the last peak
+     during hold_time and finally decays linearly (relative to the peak level of the signal).
+
+    :param audio_samples:   2D array of equal-length audio signals, shape (n_signals, n_samples)
+    :param fs:              sampling frequency
+    :param decay_time:      decay time after peak hold
+    :param hold_time:       hold time when identifying a decay
+    :param use_numba:       use the compiled kernel (requires numba). Defaults to True if numba is installed,
+                            otherwise the NumPy implementation is used.
+
+    :return:                2D array of envelopes, same shape as audio_samples
+    """
+    abs_samples = np.abs(np.asarray(audio_samples, dtype=np.float64))
+    assert abs_samples.ndim == 2, "audio_samples must be a 2D array (n_signals, n_samples)"
+    # decay rates relative to peak level of each audio signal, and number of samples to hold before decay
+    decays = abs_samples.max(axis=1) / (decay_time * fs)
+    hold_samples = hold_time * fs
+    if use_numba is None:
+        use_numba = numba is not None
+    if use_numba:
+        if numba is None:
+            raise ImportError("use_numba=True requires the numba package")
+        envelopes = np.empty_like(abs_samples)
+        _sample_and_hold_envelope_kernel(abs_samples, decays, float(hold_samples), envelopes)
+        return envelopes
+    return np.stack([_sample_and_hold_envelope_numpy(abs_samples[i], decays[i], hold_samples)
+                     for i in range(abs_samples.shape[0])])
+
+
+def _sample_and_hold_envelope_numpy(abs_samples, decay, hold_samples, block_size=1024):
+    """
+     Event-driven implementation of the sample, hold, and decay function for a single rectified signal.
+     The envelope alternates between two phases, each computed over blocks of samples:
+     - peak-hold: the envelope is the running maximum of the samples, as long as new peaks happen within
+       the hold time. It ends when no new peak was found during the hold time.
+     - decay: the envelope decreases by 'decay' at each sample (np.subtract.accumulate performs the same
+       sequence of float subtractions as the original per-sample loop). It ends when a sample rises above
+       the envelope (new peak: peak-hold phase), or restarts from a sample that is above the decayed envelope.
+    """
+    n = abs_samples.shape[0]
+    envelope = np.empty(n)
+    # Number of consecutive samples below the peak that are held before the decay starts
+    hold_length = max(int(np.ceil(hold_samples)), 0)
+    block_size = max(block_size, 2 * (hold_length + 1))
+    decay_steps = np.full(block_size + 1, decay)
+    start, holding = 0, True  # The first (non-negative) sample is always a new peak
+    level = 0.0  # Envelope value before start, during the decay phase
+    while start < n:
+        block = abs_samples[start:start + block_size]
+        if holding:
+            running_max = np.maximum.accumulate(block)
+            peaks = np.flatnonzero(block[1:] >= running_max[:-1]) + 1
+            peaks = np.concatenate(([0], peaks))
+            long_gaps = np.flatnonzero(np.diff(peaks) > hold_length)
+            if len(long_gaps) > 0:
+                decay_start = peaks[long_gaps[0]] + hold_length + 1
+            elif peaks[-1] + hold_length + 1 < len(block):
+                decay_start = peaks[-1] + hold_length + 1
+            elif start + len(block) >= n:
+                decay_start = len(block)
+            else:  # Hold time of the last peak is not entirely inside this block: restart from this peak
+                envelope[start:start + peaks[-1]] = running_max[:peaks[-1]]
+                start += peaks[-1]
+                continue
+            envelope[start:start + decay_start] = running_max[:decay_start]
+            level = running_max[decay_start - 1]
+            start += decay_start
+            holding = False
         else:
-            # check hold length
-            if hold_counter < hold_samples:
-                hold_counter += 1
-                envelope.append(previous_sample)
-            else:
-                out = previous_sample - decay
-                if out > sample:
-                    envelope.append(out)
-                    previous_sample = out
-                else:
-                    envelope.append(sample)
+            decay_steps[0] = level
+            decayed = np.subtract.accumulate(decay_steps[:len(block) + 1])
+            events = np.flatnonzero(block >= decayed[1:])
+            if len(events) == 0:
+                envelope[start:start + len(block)] = decayed[1:]
+                level = decayed[-1]
+                start += len(block)
+                continue
+            i = events[0]
+            envelope[start:start + i] = decayed[1:i + 1]
+            if block[i] >= decayed[i]:  # New peak: the hold time restarts
+                holding = True
+                start += i
+            else:  # The sample is above the decayed envelope, which decays from this sample
+                envelope[start + i] = block[i]
+                level = block[i]
+                start += i + 1
+    return envelope
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _sample_and_hold_envelope_kernel(abs_samples, decays, hold_samples, envelopes):
+        """ Compiled per-sample sample, hold, and decay function (same operations as the original loop). """
+        for i in range(abs_samples.shape[0]):
+            decay = decays[i]
+            hold_counter = 0
+            previous_sample = 0.0
+            for j in range(abs_samples.shape[1]):
+                sample = abs_samples[i, j]
+                if sample >= previous_sample:
                     previous_sample = sample
-
-    # convert to numpy array
-    return np.array(envelope)
+                    hold_counter = 0
+                elif hold_counter < hold_samples:
+                    hold_counter += 1
+                else:
+                    out = previous_sample - decay
+                    if out > sample:
+                        previous_sample = out
+                    else:
+                        previous_sample = sample
+                envelopes[i, j] = previous_sample
 
 
 def get_spectral_features(audio, fs, lf_limit=20, scale='hz', cref=27.5, power=2, window_type='none',
@@ -1153,6 +1303,7 @@ def log_sum(array):
     return logsum
 
 
+@memoized_filter_design
 def filter_design2(Fc, fs, N):
     """
       Design Butterworth 2nd-order one-third-octave filter.
@@ -1170,6 +1321,15 @@ def filter_design2(Fc, fs, N):
     return b, a
 
 
+@memoized_filter_design
+def antialiasing_filter_design(N=2, rp=0.1, Wn=0.4):
+    """
+      Design the Chebyshev type I anti-aliasing low-pass filter of the multirate third-octave filter bank.
+    """
+    C, D = cheby1(N, rp, Wn)
+    return C, D
+
+
 def midbands(Fmin, Fmax, fs):
     """
       Divides the frequency range into third octave bands using filters
@@ -1212,13 +1372,34 @@ def filter_third_octaves_downsample(x, Pref, fs, Fmin, Fmax, N):
      Fs is the sampling frequency
      N is the filter order
     """
+    Ptotal, P, F = filter_third_octaves_downsample_batch(x[np.newaxis, :], Pref, fs, Fmin, Fmax, N)
+    return Ptotal[0], P[0], F
+
+
+def third_octave_band_levels(y, m):
+    """
+      Levels (dB) of the rows of a 2D array of filtered audio frames, -inf if all values of a row are <= 0.
+      m is the number of samples used for the RMS computation.
+    """
+    with np.errstate(divide='ignore'):
+        return np.where(np.max(y, axis=1) > 0, 20 * np.log10(np.sqrt(np.sum(y ** 2.0, axis=1) / m)), -1.0 * np.inf)
+
+
+def filter_third_octaves_downsample_batch(x, Pref, fs, Fmin, Fmax, N):
+    """
+     Batched version of filter_third_octaves_downsample: x is a 2D array of audio frames (one frame per row, e.g.
+     from window_audio). Each filter is designed once and applied to all frames at once (along axis 1), which
+     returns the same values as filtering each frame separately.
+
+     Returns Ptotal (1D array, one value per frame), P (2D array of band levels, one row per frame), F
+    """
     # identify midband frequencies
     [ff, F, j] = midbands(Fmin, Fmax, fs)
 
     # apply filters
-    P = np.zeros(len(j))
+    P = np.zeros((x.shape[0], len(j)))
     k = np.where(j == 7)[0][0] # Determines where downsampling will commence (5000 Hz and below)
-    m = len(x)
+    m = x.shape[1]
 
     # For frequencies of 6300 Hz or higher, direct implementation of filters.
     for i in range(len(j)-1, k, -1):
@@ -1232,54 +1413,35 @@ def filter_third_octaves_downsample(x, Pref, fs, Fmin, Fmax, N):
         if i == k + 1:  # Lower 1/3-oct. band in last octave.
             Bl = B;
             Al = A;
-        y = scipy.signal.lfilter(B, A, x);
-        if np.max(y) > 0:
-            P[i] = 20 * np.log10(np.sqrt(np.sum(y ** 2.0) / m)) # Convert to decibels.
-        else:
-            P[i] = -1.0 * np.inf
+        y = scipy.signal.lfilter(B, A, x, axis=1);
+        P[:, i] = third_octave_band_levels(y, m) # Convert to decibels.
 
     # 5000 Hz or lower, multirate filter implementation.
     try:
         for i in range(k, 1, -3): #= k:-3:1;
             # Design anti-aliasing filter (IIR Filter)
-            Wn = 0.4
-            C, D = scipy.signal.cheby1(2, 0.1, Wn)
+            C, D = antialiasing_filter_design()
             # Filter
-            x = scipy.signal.lfilter(C, D, x)
+            x = scipy.signal.lfilter(C, D, x, axis=1)
             # Downsample
-            idx = np.arange(1, len(x), 2)
-            x = x[idx]
+            x = x[:, 1::2]
             fs = fs / 2.0
-            m = len(x)
+            m = x.shape[1]
             # Performs the filtering
-            y = scipy.signal.lfilter(Bu, Au, x)
-            if np.max(y) > 0:
-                P[i] = 20 * np.log10(np.sqrt(np.sum(y ** 2.0)/m))
-            else:
-                P[i] = -1.0 * np.inf
-            y = scipy.signal.lfilter(Bc, Ac, x)
-            if np.max(y) > 0:
-                P[i-1] = 20 * np.log10(np.sqrt(np.sum(y ** 2.0)/m))
-            else:
-                P[i-1] = -1.0 * np.inf
-            y = scipy.signal.lfilter(Bl, Al, x)
-            if np.max(y) > 0:
-                P[i - 2] = 20 * np.log10(np.sqrt(np.sum(y ** 2.0) / m))
-            else:
-                P[i-2] = -1.0 * np.inf
+            P[:, i] = third_octave_band_levels(scipy.signal.lfilter(Bu, Au, x, axis=1), m)
+            P[:, i-1] = third_octave_band_levels(scipy.signal.lfilter(Bc, Ac, x, axis=1), m)
+            P[:, i-2] = third_octave_band_levels(scipy.signal.lfilter(Bl, Al, x, axis=1), m)
     except:
-        P = P[1:len(j)]
+        P = P[:, 1:len(j)]
 
     # "calibrate" the readings based from Pref, chosen as 100 in most uses
     P = P + Pref
 
     # log transformation
     Plog = 10 ** (P / 10.0)
-    Ptotal = np.sum(Plog)
-    if Ptotal > 0:
-        Ptotal = 10 * np.log10(Ptotal)
-    else:
-        Ptotal = -1.0 * np.inf
+    Ptotal = np.sum(Plog, axis=1)
+    with np.errstate(divide='ignore'):
+        Ptotal = np.where(Ptotal > 0, 10 * np.log10(Ptotal), -1.0 * np.inf)
 
     return Ptotal, P, F
 
@@ -1309,15 +1471,46 @@ def specific_loudness(x, fs, Pref=100.0, Mod=0):
     # P211 Psychoacoustics: Facts and Models, E.Zwicker and H.Fastl
     # (A filter order of 4 gives approx this result)
 
+    N_entire, N_single = specific_loudness_batch(x[np.newaxis, :], fs, Pref=Pref, Mod=Mod)
+    return N_entire[0], N_single[0]
+
+
+def specific_loudness_batch(x, fs, Pref=100.0, Mod=0):
+    """
+      Batched version of specific_loudness: x is a 2D array of audio windows (one window per row, e.g. from
+      window_audio). The third-octave filters are applied once to all windows.
+
+        Returns
+        N_entire = entire loudness[sone], 1D array (one value per window)
+        N_single = partial loudness[sone / Bark], 2D array with shape (n_windows, 240)
+    """
     # set default
     Fmin = 25
     Fmax = 12500
     order = 4
     # filter the audio
-    Ptotal, P, F = filter_third_octaves_downsample(x, Pref, fs, Fmin, Fmax, order);
+    Ptotal, P, F = filter_third_octaves_downsample_batch(x, Pref, fs, Fmin, Fmax, order)
+
+    return specific_loudness_from_levels(P, Mod=Mod)
 
 
-    # set more defaults for perceptual filters
+def specific_loudness_from_levels(P, Mod=0):
+    """
+      Calculates loudness from the levels of 3rd octave bands (see specific_loudness), for many windows at once.
+      The masking slopes of the original state machine (0.1 Bark steps over 21 critical bands) are built for all
+      windows simultaneously: each window keeps its own state (position, loudness, slope index, output index) in
+      arrays, and the windows that are still inside the current critical band are advanced together.
+        P = levels of the 3rd octave bands [dB], from filter_third_octaves_downsample_batch (one row per window)
+        Mod = 0 for free field
+        Mod = 1 for diffuse field
+
+        Returns
+        N_entire = entire loudness[sone], 1D array (one value per window)
+        N_single = partial loudness[sone / Bark], 2D array with shape (n_windows, 240)
+    """
+    P = np.atleast_2d(P)
+    n_windows = P.shape[0]
+    # set defaults for perceptual filters
 
     # Centre frequencies of 1 / 3 Oct bands(FR)
     FR = np.array([25, 31.5, 40, 50, 63, 80, 100, 125, 160, 200, 250, 315, 400, 500, 630, 800, 1000, 1250, 1600,
@@ -1382,159 +1575,104 @@ def specific_loudness(x, fs, Pref=100.0, Mod=0):
                     [0.09, 0.08, 0.07, 0.06, 0.06, 0.06, 0.06, 0.05],
                     [0.06, 0.05, 0.03, 0.02, 0.02, 0.02, 0.02, 0.02]])
 
-    # apply weighting factors
-    Xp = np.zeros(11)
-    Ti = np.zeros(11)
-    for i in range(11):
-        j = 0
-        while (P[i] > (RAP[j] - DLL[j, i])) & (j < 7):
-            j += 1
-        Xp[i] = P[i] + DLL[j, i]
-        Ti[i] = 10.0 ** (Xp[i] / 10.0)
+    # apply weighting factors: for each band, j is the first range for which the level is not above RAP - DLL
+    #     (at most 7)
+    is_above_range = P[:, np.newaxis, 0:11] > (RAP[:, np.newaxis] - DLL)[np.newaxis, :, :]  # (window, j, band)
+    j = np.where(is_above_range[:, 0:7, :].all(axis=1), 7, np.argmax(~is_above_range[:, 0:7, :], axis=1))
+    Xp = P[:, 0:11] + DLL[j, np.arange(11)]
+    Ti = 10.0 ** (Xp / 10.0)
 
     # Intensity values in first three critical bands calculated
-    Gi = np.zeros(3)
-    Gi[0] = np.sum(Ti[0:6]) # Gi(1) is the first critical band (sum of two octaves(25Hz to 80Hz))
-    Gi[1] = np.sum(Ti[6:9]) # Gi(2) is the second critical band (sum of octave(100Hz to 160Hz))
-    Gi[2] = np.sum(Ti[9:11]) # Gi(3) is the third critical band (sum of two third octave bands(200Hz to 250Hz))
-
-    if np.max(Gi) > 0.0:
-        FNGi = 10 * np.log10(Gi)
-    else:
-        FNGi = -1.0 * np.inf
-    LCB = np.zeros_like(Gi)
-    for i in range(3):
-        if Gi[i] > 0:
-            LCB[i] = FNGi[i]
-        else:
-            LCB[i] = 0
+    Gi = np.zeros((n_windows, 3))
+    Gi[:, 0] = np.sum(Ti[:, 0:6], axis=1) # Gi(1) is the first critical band (sum of two octaves(25Hz to 80Hz))
+    Gi[:, 1] = np.sum(Ti[:, 6:9], axis=1) # Gi(2) is the second critical band (sum of octave(100Hz to 160Hz))
+    Gi[:, 2] = np.sum(Ti[:, 9:11], axis=1) # Gi(3) is the third critical band (sum of two third octave bands(200Hz to 250Hz))
+    with np.errstate(divide='ignore'):
+        LCB = np.where(Gi > 0, 10 * np.log10(Gi), 0)
 
     # Calculate the main loudness in each critical band
-    Le = np.ones(20)
-    Lk = np.ones_like(Le)
-    Nm = np.ones(21)
-    for i in range(20):
-        Le[i] = P[i+8]
-        if i <= 2:
-            Le[i] = LCB[i]
-        Lk[i] = Le[i] - A0[i]
-        Nm[i] = 0
-        if Mod == 1:
-            Le[i] = Le[i] + DDF[i]
-        if Le[i] > LTQ[i]:
-            Le[i] = Lk[i] - DCB[i]
-            S = 0.25
-            MP1 = 0.0635 * 10.0 ** (0.025 * LTQ[i])
-            MP2 = (1 - S + S * 10 ** (0.1 * (Le[i] - LTQ[i]))) ** 0.25 - 1
-            Nm[i] = MP1 * MP2;
-            if Nm[i] <= 0:
-                Nm[i] = 0
-    Nm[20] = 0
-
-    KORRY = 0.4 + 0.32 * Nm[0] ** 0.2
-    if KORRY > 1:
-        KORRY = 1
-
-    Nm[0] = Nm[0] * KORRY
+    Le = np.array(P[:, 8:28])
+    Le[:, 0:3] = LCB
+    Lk = Le - A0
+    if Mod == 1:
+        Le = Le + DDF
+    is_audible = Le > LTQ
+    Le = Lk - DCB
+    S = 0.25
+    MP1 = 0.0635 * 10.0 ** (0.025 * LTQ)
+    MP2 = (1 - S + S * 10 ** (0.1 * (Le - LTQ))) ** 0.25 - 1
+    Nm = np.zeros((n_windows, 21))
+    Nm[:, 0:20] = np.where(is_audible, MP1 * MP2, 0)
+    Nm[:, 0:20] = np.where(Nm[:, 0:20] <= 0, 0, Nm[:, 0:20])
+
+    KORRY = np.minimum(0.4 + 0.32 * Nm[:, 0] ** 0.2, 1)
+    Nm[:, 0] = Nm[:, 0] * KORRY
 
     # Add masking curves to the main loudness in each third octave band
-    N = 0
-    z1 = 0  # critical band rate starts at 0
-    n1 = 0  # loudness level starts at 0
-    j = 17
-    iz = 0
-    z = 0.1
-    ns = []
+    # State of each window: loudness sum, current critical band rate and loudness, slope index, index of the next
+    #     output value, next output critical band rate (and the last one)
+    N = np.zeros(n_windows)
+    z1 = np.zeros(n_windows)
+    n1 = np.zeros(n_windows)
+    j = np.full(n_windows, 17)
+    iz = np.zeros(n_windows, dtype=int)
+    z = np.full(n_windows, 0.1)
+    k_last = np.zeros(n_windows)
+    ns = np.zeros((n_windows, int(round(ZUP[-1] * 10)) + 10))
+    # Slope index to be used for each main loudness value: first index at which Nm is greater than (or equal to) RNS
+    j_from_Nm = np.sum(RNS[np.newaxis, np.newaxis, :] > Nm[:, :, np.newaxis], axis=2)
 
     for i in range(21):
-        # Determines where to start on the slope
-        ig = i-1
-        if ig > 7:
-            ig = 7
-        control = 1
-        while (z1 < ZUP[i]) | (control == 1):  # ZUP is the upper limit of the approximated critical band
+        # Determines where to start on the slope (i = 0: -1 is the last column of USL)
+        ig = min(i - 1, 7)
+        is_active = np.ones(n_windows, dtype=bool)  # The first step is always computed
+        while is_active.any():  # ZUP is the upper limit of the approximated critical band
+            w = np.flatnonzero(is_active)
+            Nm_w, n1_w, z1_w, z_w = Nm[w, i], n1[w], z1[w], z[w]
             # Determines which of the slopes to use
-            if n1 < Nm[i]: # Nm is the main loudness level
-                j = 0
-                while RNS[j] > Nm[i]:  # the value of j is used below to build a slope
-                    j += 1  # j becomes the index at which Nm(i) is first greater than RNS
-
-            # The flat portions of the loudness graph
-            if n1 <= Nm[i]:
-                z2 = ZUP[i]  # z2 becomes the upper limit of the critical band
-                n2 = Nm[i]
-                N = N + n2 * (z2 - z1) # Sums the output(N_entire)
-                for k in np.arange(z, z2+0.01, 0.1):
-                    if not ns:
-                        ns.append(n2)
-                    else:
-                        if iz == len(ns):
-                            ns.append(n2)
-                        elif iz < len(ns):
-                            ns[iz] = n2
-
-                    if k < (z2 - 0.05):
-                        iz += 1
-                z = k # z becomes the last value of k
-                z = round(z * 10) * 0.1
-
-            # The sloped portions of the loudness graph
-            if n1 > Nm[i]:
-                n2 = RNS[j]
-                if n2 < Nm[i]:
-                    n2 = Nm[i]
-                dz = (n1 - n2) / USL[j, ig]  # USL = slopes
-                dz = round(dz * 10) * 0.1
-                if dz == 0:
-                    dz = 0.1
-                z2 = z1 + dz
-                if z2 > ZUP[i]:
-                    z2 = ZUP[i]
-                    dz = z2 - z1
-                    n2 = n1 - dz * USL[j, ig]  # USL = slopes
-                N = N + dz * (n1 + n2) / 2.0  # Sums the output(N_entire)
-                for k in np.arange(z, z2+0.01, 0.1):
-                    if not ns:
-                        ns.append(n1 - (k - z1) * USL[j, ig])
-                    else:
-                        if iz == len(ns):
-                            ns.append(n1 - (k - z1) * USL[j, ig])
-                        elif iz < len(ns):
-                            ns[iz] = n1 - (k - z1) * USL[j, ig]
-                    if k < (z2 - 0.05):
-                        iz += 1
-                z = k
-                z = round(z * 10) * 0.1
-            if n2 == RNS[j]:
-                j += 1
-            if j > 17:
-                j = 17
-            n1 = n2
-            z1 = z2
-            z1 = round(z1 * 10) * 0.1
-            control += 1
-
-    if N < 0:
-        N = 0
-
-    if N <= 16:
-        N = np.floor(N * 1000 + 0.5) / 1000.0
-    else:
-        N = np.floor(N * 100 + .05) / 100.0
-
-    LN = 40.0 * (N + 0.0005) ** 0.35
-
-    if LN < 3:
-        LN = 3
-
-    if N >= 1:
-        LN = 10 * np.log10(N) / np.log10(2) + 40;
-
-    N_single = np.zeros(240)
-    for i in range(240):
-        N_single[i] = ns[i]
+            j_w = np.where(n1_w < Nm_w, j_from_Nm[w, i], j[w])
+            slope = USL[j_w, ig]
+            is_flat = n1_w <= Nm_w
+            # The flat portions of the loudness graph: z2 becomes the upper limit of the critical band
+            # The sloped portions of the loudness graph: rounded to 0.1 Bark, and limited to the critical band
+            n2_w = np.where(is_flat, Nm_w, np.maximum(RNS[j_w], Nm_w))
+            dz = np.round((n1_w - n2_w) / slope * 10) * 0.1
+            dz = np.where(dz == 0, 0.1, dz)
+            z2_w = np.where(is_flat, ZUP[i], z1_w + dz)
+            is_clipped = ~is_flat & (z2_w > ZUP[i])
+            z2_w = np.where(is_clipped, ZUP[i], z2_w)
+            dz = np.where(is_clipped, z2_w - z1_w, dz)
+            n2_w = np.where(is_clipped, n1_w - dz * slope, n2_w)
+            N[w] = N[w] + np.where(is_flat, n2_w * (z2_w - z1_w), dz * (n1_w + n2_w) / 2.0)  # Sums the output(N_entire)
+
+            # Output values at 0.1 Bark steps, computed as np.arange(z, z2 + 0.01, 0.1) would: the output index is
+            #     not increased for the last step if it reaches the end of this portion
+            n_steps = np.maximum(np.ceil((z2_w + 0.01 - z_w) / 0.1), 0).astype(int)
+            steps = np.arange(n_steps.max())
+            k = z_w[:, np.newaxis] + steps[np.newaxis, :] * ((z_w + 0.1) - z_w)[:, np.newaxis]
+            if len(steps) > 1:
+                k[:, 1] = z_w + 0.1
+            is_step = steps[np.newaxis, :] < n_steps[:, np.newaxis]
+            values = np.where(is_flat[:, np.newaxis], n2_w[:, np.newaxis], n1_w[:, np.newaxis]
+                              - (k - z1_w[:, np.newaxis]) * slope[:, np.newaxis])
+            rows = np.broadcast_to(w[:, np.newaxis], k.shape)
+            ns[rows[is_step], (iz[w, np.newaxis] + steps[np.newaxis, :])[is_step]] = values[is_step]
+            iz[w] += np.sum(is_step & (k < (z2_w - 0.05)[:, np.newaxis]), axis=1)
+            if len(steps) > 0:
+                k_last[w] = np.where(n_steps > 0, k[np.arange(len(w)), np.maximum(n_steps - 1, 0)], k_last[w])
+            z[w] = np.round(k_last[w] * 10) * 0.1 # z becomes the last value of k
+
+            j_w = np.minimum(np.where(n2_w == RNS[j_w], j_w + 1, j_w), 17)
+            j[w] = j_w
+            n1[w] = n2_w
+            z1[w] = np.round(z2_w * 10) * 0.1
+            is_active[w] = z1[w] < ZUP[i]
+
+    N = np.where(N < 0, 0, N)
+    N = np.where(N <= 16, np.floor(N * 1000 + 0.5) / 1000.0, np.floor(N * 100 + .05) / 100.0)
 
     N_entire = N
+    N_single = ns[:, 0:240]
     return N_entire, N_single
 
 
@@ -9,11 +9,16 @@ from . import timbretoolboxstats
 
 
 class TimbreFeatures:
-    def __init__(self, raw_df: pd.DataFrame):
+    def __init__(self, raw_df: pd.DataFrame, tt_engine='matlab'):
         """
         Class for post-processing raw timbre features from AudioCommons (ac) Timbral Models and Timbre Toolbox (tt).
+
+        :param tt_engine: The engine which computed the TimbreToolbox features (see metrics.compute_metrics).
+            Normalization statistics were computed from Matlab values, thus TimbreToolbox features computed by the
+            'numpy' engine are not normalized (only log scales are applied).
         """
-        self.raw_df = raw_df
+        assert tt_engine in ('matlab', 'numpy'), f"Unknown TimbreToolbox engine '{tt_engine}'"
+        self.raw_df, self.tt_engine = raw_df, tt_engine
         # Build subsets of columns
         self.non_feature_cols = [c for c in self.raw_df if not (c.startswith("ac_") or c.startswith("tt_"))]
         self.raw_ac_cols = [c for c in self.raw_df if c.startswith("ac_")]
@@ -86,8 +91,9 @@ class TimbreFeatures:
         # Finally: normalize using pre-computed statistics
         #    TODO allow users to provide their own normalization statistics
         mean, std = pd.Series(_post_distorsion_stats['mean']), pd.Series(_post_distorsion_stats['std'])
-        self.postproc_df[self.feature_cols] \
-            = (self.postproc_df[self.feature_cols] - mean[self.feature_cols]) / std[self.feature_cols]
+        normalized_cols = self.feature_cols if self.tt_engine == 'matlab' else self.ac_cols
+        self.postproc_df[normalized_cols] \
+            = (self.postproc_df[normalized_cols] - mean[normalized_cols]) / std[normalized_cols]
 
     @property
     def raw_feature_cols(self):
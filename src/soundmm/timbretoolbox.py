@@ -1,8 +1,12 @@
+import functools
+import hashlib
 import json
 import multiprocessing.pool
 import os
 import queue
+import selectors
 import shutil
+import signal
 import subprocess
 import pathlib
 import tempfile
@@ -10,10 +14,14 @@ import threading
 import time
 import warnings
 from datetime import datetime
-from typing import Optional, Sequence, List
+from typing import Optional, Sequence, List, Dict, Union
 from abc import ABC, abstractmethod
 
 import numpy as np
+import soundfile as sf
+
+from . import timbretoolboxstats
+from .featurescache import FeaturesCache, audio_content_hash
 
 
 class ToolboxLogger(ABC):
@@ -25,9 +33,28 @@ class ToolboxLogger(ABC):
         pass
 
 
+class TimbreToolboxTimeoutError(TimeoutError):
+    def __init__(self, message: str, processed_files: Sequence[str], current_file: Optional[str] = None,
+                 timed_out_file: Optional[str] = None):
+        """
+        Raised when a watchdog has killed Matlab.
+
+        :param processed_files: Names of the audio files analyzed before Matlab was killed (in order).
+        :param current_file: Name of the audio file being analyzed when Matlab was killed, if any.
+        :param timed_out_file: Name of the audio file whose analysis has timed out, or None if the whole job
+            has timed out.
+        """
+        super().__init__(message)
+        self.processed_files, self.current_file, self.timed_out_file = \
+            list(processed_files), current_file, timed_out_file
+
+
 class TimbreToolboxProcess:
     def __init__(self, timbre_toolbox_path: pathlib.Path, directories_list_file: pathlib.Path, verbose=True,
-                 logger: Optional[ToolboxLogger] = None, process_index: Optional[int] = None):
+                 logger: Optional[ToolboxLogger] = None, process_index: Optional[int] = None,
+                 options_file: Optional[pathlib.Path] = None, stop_file: Optional[pathlib.Path] = None,
+                 max_rss_mb: Optional[float] = None, max_processed_files: Optional[int] = None,
+                 file_timeout: Optional[float] = None, job_timeout: Optional[float] = None, monitoring_period=1.0):
         """
         Runs the TimbreToolbox to process folders of audio files (folders' paths given in a separate text file).
         The 'matlab' command must be available system-wide.
@@ -36,36 +63,43 @@ class TimbreToolboxProcess:
                                     Timbre Toolbox must have been properly compiled (see instructions in their readme).
         :param directories_list_file: Text file which contains a list of directories to be analyzed by the toolbox.
         :param verbose:
+        :param options_file: Optional JSON options for the Matlab script, see write_options_file.
+        :param stop_file: The stop file given to the Matlab script (see write_options_file). It is created when
+            the Matlab process exceeds max_rss_mb or max_processed_files, such that Matlab ends gracefully after the
+            current audio file. The list of analyzed files is available in self.processed_files after run().
+        :param max_rss_mb: Maximum memory (Resident Set Size, in MB) of the Matlab process and its children.
+        :param max_processed_files: Maximum number of audio files to be analyzed by the Matlab process.
+        :param file_timeout: Watchdog: if the analysis of a single audio file lasts longer (seconds), Matlab is
+            killed and the file is stored in self.timed_out_file.
+        :param job_timeout: Watchdog: if the Matlab process runs for a longer duration (seconds), it is killed.
+            self.killed indicates whether the watchdog has killed the Matlab process.
+        :param monitoring_period: Duration (seconds) between two memory measurements or watchdog checks.
         """
         self.process_index = process_index
         self.logger = logger
         self.verbose = verbose
+        self.stop_file, self.max_rss_mb, self.max_processed_files = stop_file, max_rss_mb, max_processed_files
+        self.monitoring_period = monitoring_period
+        if (max_rss_mb is not None or max_processed_files is not None) and stop_file is None:
+            raise ValueError("A stop file is required to limit the memory or number of files of a Matlab process")
+        self.file_timeout, self.job_timeout = file_timeout, job_timeout
+        self.processed_files: List[str] = list()
+        self.current_file: Optional[str] = None  # File being analyzed (if the script acknowledges files)
+        self.stop_requested, self.killed, self.timed_out_file = False, False, None
         self.current_path = pathlib.Path(__file__).parent
         self.matlab_commands = "addpath(genpath('{}')); " \
                                "cd '{}'; " \
-                               "tt_features('{}'); " \
+                               "tt_features('{}', '{}'); " \
                                "exit " \
             .format(str(timbre_toolbox_path),
                     str(self.current_path),  # Path to the local timbre.m file
-                    str(directories_list_file)
+                    str(directories_list_file),
+                    str(options_file) if options_file is not None else ''
                     )
-        self.continue_queue_threads = False
 
     def _get_process_str(self):
         return '' if self.process_index is None else ' #{}'.format(self.process_index)
 
-    def _enqueue_std_output(self, std_output, q: queue.Queue):
-        """
-        To be launched as a Thread (contains a blocking readline() call)
-        Related question: https://stackoverflow.com/questions/375427/a-non-blocking-read-on-a-subprocess-pipe-in-python
-
-        :param std_output: std::cout or std::cerr
-        """
-        while self.continue_queue_threads:
-            line = std_output.readline()
-            if line:
-                q.put(line)
-
     def run(self):
 
         # Matlab args From https://arc.umich.edu/software/matlab/
@@ -78,61 +112,311 @@ class TimbreToolboxProcess:
             log_str = '[#{}]'.format(self.process_index) + log_str
         self._log_and_print(log_str)
 
-        # Poll process.stdout to show stdout live
-        # FIXME this seems quite useless.... subprocess.run seems to do exactly this
         proc = subprocess.Popen(proc_args, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-        # Retrieve std::cout and std::cerr from Threads (to raise an exception if any Matlab error happens)
-        std_out_queue, std_err_queue = queue.Queue(), queue.Queue()
-        self.continue_queue_threads = True
-        std_out_thread = threading.Thread(target=self._enqueue_std_output, args=(proc.stdout, std_out_queue))
-        std_err_thread = threading.Thread(target=self._enqueue_std_output, args=(proc.stderr, std_err_queue))
-        std_out_thread.start(), std_err_thread.start()
-
+        # Show std::cout live, and raise an exception if any Matlab error happens (std::cerr output).
+        # The selector blocks until some output is available: no polling. Both outputs reach EOF when
+        # the process ends.
+        selector = selectors.DefaultSelector()
+        selector.register(proc.stdout, selectors.EVENT_READ, data=False)  # data: is_std_err
+        selector.register(proc.stderr, selectors.EVENT_READ, data=True)
+        partial_lines = {False: b'', True: b''}
         matlab_error_time = None
-        # We keep pooling the queues until the process ends, or an error happens
-        keep_running = True
-        while keep_running:
-            while not std_out_queue.empty():  # Does not guarantee get will not block
-                try:
-                    line = std_out_queue.get_nowait()
-                except queue.Empty:
-                    break
-                self._log_and_print('[MATLAB{}] {}'.format(self._get_process_str(), line.decode('utf-8').rstrip()))
-            while not std_err_queue.empty():  # Does not guarantee get will not block
-                try:
-                    line = std_err_queue.get_nowait()
-                except queue.Empty:
-                    break
-                self._log_and_print('[MATLAB{} ERROR] {}'.format(self._get_process_str(),
-                                                                 line.decode('utf-8').rstrip()), force_print=True)
-                if matlab_error_time is None:  # Write this only once
-                    matlab_error_time = datetime.now()
-            time.sleep(0.001)
-
-            if proc.poll() is not None:  # Natural ending (when script has been fully executed)
-                if self.verbose:
-                    print("Matlab process{} has ended by itself.".format(self._get_process_str()))
-                keep_running = False
+        is_monitored = self.max_rss_mb is not None or self.max_processed_files is not None \
+            or self.file_timeout is not None or self.job_timeout is not None
+        self._start_time = self._current_file_start_time = time.monotonic()
+        self._last_rss_check_time = -np.inf
+        # We keep reading outputs until the process ends, or an error happens
+        while len(selector.get_map()) > 0:
             if matlab_error_time is not None:  # Forced ending (after a small delay, to retrieve all std err data)
-                if (datetime.now() - matlab_error_time).total_seconds() > 2.0:
-                    keep_running = False
+                timeout = 2.0 - (time.monotonic() - matlab_error_time)
+                if timeout <= 0.0:
+                    break
+            else:  # If the process is monitored, we also need to wake up periodically
+                timeout = self.monitoring_period if is_monitored else None
+            if is_monitored and not self.stop_requested:
+                self._check_resources(proc.pid)
+            if is_monitored and not self.killed:
+                self._check_timeouts(proc.pid)
+            for key, _ in selector.select(timeout):
+                is_std_err = key.data
+                data = os.read(key.fd, 65536)
+                if len(data) == 0:  # EOF
+                    selector.unregister(key.fileobj)
+                    lines = [partial_lines[is_std_err]] if len(partial_lines[is_std_err]) > 0 else []
+                else:
+                    lines = (partial_lines[is_std_err] + data).split(b'\n')
+                    partial_lines[is_std_err] = lines.pop()  # Incomplete last line (or empty bytes)
+                for line in lines:
+                    if not is_std_err:
+                        line = line.decode('utf-8').rstrip()
+                        self._log_and_print('[MATLAB{}] {}'.format(self._get_process_str(), line))
+                        if line.startswith('tt_features: start '):
+                            self.current_file = line[len('tt_features: start '):]
+                            self._current_file_start_time = time.monotonic()
+                        elif line.startswith('tt_features: done '):
+                            self.processed_files.append(line[len('tt_features: done '):])
+                            self.current_file = None
+                    else:
+                        self._log_and_print('[MATLAB{} ERROR] {}'.format(self._get_process_str(),
+                                                                         line.decode('utf-8').rstrip()), force_print=True)
+                        if matlab_error_time is None:  # Write this only once
+                            matlab_error_time = time.monotonic()
+        selector.close()
+        proc.stdout.close(), proc.stderr.close()
 
         if matlab_error_time is not None:
             raise RuntimeError("Matlab{} has raised an error - please check console outputs above"
                                .format(self._get_process_str()))
-        rc = proc.poll()
-        if rc != 0:
+        # Natural ending (when script has been fully executed), or killed by the watchdog
+        rc = proc.wait()
+        if self.verbose and not self.killed:
+            print("Matlab process{} has ended by itself.".format(self._get_process_str()))
+        if rc != 0 and not self.killed:
             warnings.warn('Matlab{} exit code was {}. Please check console outputs.'
                           .format(self._get_process_str(), rc))
 
-        self.continue_queue_threads = False
-        std_out_thread.join()
-        std_err_thread.join()
-
         self._log_and_print("\n==================== Matlab subprocess{} has ended ========================\n"
                             .format(self._get_process_str()))
 
+    def _check_resources(self, pid: int):
+        """ Creates the stop file if the Matlab process uses too much memory, or has processed too many files. """
+        if len(self.processed_files) == 0:  # Each Matlab process must make progress (Matlab's own memory is large)
+            return
+        if self.max_processed_files is not None and len(self.processed_files) >= self.max_processed_files:
+            reason = '{} files have been analyzed'.format(len(self.processed_files))
+        else:
+            # Scanning the process tree is expensive: memory is measured at most once per monitoring period
+            if self.max_rss_mb is None or time.monotonic() - self._last_rss_check_time < self.monitoring_period:
+                return
+            self._last_rss_check_time = time.monotonic()
+            rss_mb = get_process_tree_rss(pid) / 2**20
+            if rss_mb >= self.max_rss_mb:
+                reason = 'memory usage is {:.0f} MB after {} files'.format(rss_mb, len(self.processed_files))
+            else:
+                return
+        self._log_and_print('[MATLAB{}] Stop requested: {}'.format(self._get_process_str(), reason))
+        self.stop_file.touch()
+        self.stop_requested = True
+
+    def _check_timeouts(self, pid: int):
+        """ Watchdog: kills the Matlab process (and its children) if the current file or the whole job lasts
+        too long. """
+        now = time.monotonic()
+        if self.file_timeout is not None and self.current_file is not None \
+                and now - self._current_file_start_time > self.file_timeout:
+            reason = 'analysis of {} lasts more than {:g}s'.format(self.current_file, self.file_timeout)
+            self.timed_out_file = self.current_file
+        elif self.job_timeout is not None and now - self._start_time > self.job_timeout:
+            reason = 'job lasts more than {:g}s ({} files analyzed)'.format(self.job_timeout,
+                                                                            len(self.processed_files))
+        else:
+            return
+        self._log_and_print('[MATLAB{}] Killed by the watchdog: {}'.format(self._get_process_str(), reason),
+                            force_print=True)
+        kill_process_tree(pid)
+        self.killed = True
+
+    def _log_and_print(self, log_str: str, force_print=False):
+        """ Use the logger attribute if available, otherwise just print """
+        if self.logger is not None:
+            self.logger.log_and_print(log_str, force_print=force_print)
+        elif self.verbose or force_print:
+            print(log_str)
+
+
+def get_process_tree_pids(pid: int):
+    """ Returns the pids of a process and all its descendants (Linux only, uses /proc). The 'matlab' command is a
+    launcher script, and the actual Matlab (and JVM) process is one of its children. """
+    children = dict()  # parent pid -> children pids
+    for stat_file in pathlib.Path('/proc').glob('[0-9]*/stat'):
+        try:
+            stat = stat_file.read_text()
+        except OSError:  # The process has ended
+            continue
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])  # The process name (in parentheses) may contain spaces
+        children.setdefault(ppid, list()).append(int(stat_file.parent.name))
+    tree_pids, pids = list(), [pid]
+    while len(pids) > 0:
+        tree_pids.append(pids.pop())
+        pids += children.get(tree_pids[-1], [])
+    return tree_pids
+
+
+def get_process_tree_rss(pid: int):
+    """ Returns the Resident Set Size (bytes) of a process and all its descendants (Linux only, uses /proc). """
+    rss_pages = 0
+    for tree_pid in get_process_tree_pids(pid):
+        try:
+            rss_pages += int(pathlib.Path(f'/proc/{tree_pid}/statm').read_text().split()[1])
+        except (OSError, IndexError, ValueError):  # The process has ended
+            continue
+    return rss_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def kill_process_tree(pid: int):
+    """ Kills (SIGKILL) a process and all its descendants. """
+    for tree_pid in get_process_tree_pids(pid):
+        try:
+            os.kill(tree_pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+class TimbreToolboxWorker:
+    def __init__(self, timbre_toolbox_path: pathlib.Path, verbose=True, logger: Optional[ToolboxLogger] = None,
+                 worker_index: Optional[int] = None, matlab_executable='matlab', monitoring_period=1.0):
+        """
+        Long-lived Matlab process which runs the TimbreToolbox on successive jobs (see tt_worker.m), such that
+        Matlab's startup and the toolbox's initialization happen only once.
+        Jobs are sent through a spool directory; their completion is acknowledged on Matlab's stdout.
+
+        :param timbre_toolbox_path: Path to the TimbreToolbox https://github.com/VincentPerreault0/timbretoolbox.
+        :param matlab_executable: Name (or path) of the Matlab executable. Can be replaced by any program which
+                                  implements the tt_worker.m protocol (e.g. for testing purposes).
+        :param monitoring_period: Duration (seconds) between two watchdog checks, if a job has a file timeout.
+        """
+        self.worker_index, self.logger, self.verbose = worker_index, logger, verbose
+        self.matlab_executable = matlab_executable
+        self.monitoring_period = monitoring_period
+        self.current_path = pathlib.Path(__file__).parent
+        self.spool_directory = pathlib.Path(tempfile.mkdtemp(prefix='tt_worker_'))
+        self.matlab_commands = "addpath(genpath('{}')); " \
+                               "cd '{}'; " \
+                               "tt_worker('{}'); " \
+                               "exit " \
+            .format(str(timbre_toolbox_path), str(self.current_path), str(self.spool_directory))
+        self.proc: Optional[subprocess.Popen] = None
+        self._reader_threads: List[threading.Thread] = list()
+        self._jobs_status = dict()  # Filled by the stdout reader thread
+        self.processed_files: List[str] = list()  # Files analyzed by the current job (acknowledged on stdout)
+        self.current_file: Optional[str] = None
+        self._current_file_start_time = 0.0
+        self._stdout_closed = False
+        self._jobs_condition = threading.Condition()
+        self._jobs_counter = 0
+
+    def _get_process_str(self):
+        return '' if self.worker_index is None else ' #{}'.format(self.worker_index)
+
+    def start(self):
+        proc_args = [self.matlab_executable, '-nodisplay', '-nodesktop', '-nosplash', '-r', self.matlab_commands]
+        self._log_and_print('============ Launching Matlab worker{} ============\n{}\nSubprocess args: {}\n'
+                            .format(self._get_process_str(), datetime.now().strftime("%Y/%m/%d, %H:%M:%S"), proc_args))
+        self.proc = subprocess.Popen(proc_args, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._stdout_closed = False
+        self._reader_threads = [threading.Thread(target=self._read_std_output, args=(self.proc.stdout, False)),
+                                threading.Thread(target=self._read_std_output, args=(self.proc.stderr, True))]
+        for t in self._reader_threads:
+            t.start()
+
+    def _read_std_output(self, std_output, is_std_err: bool):
+        """ To be launched as a Thread: blocking readline() calls, until the process closes its output. """
+        for line in iter(std_output.readline, b''):
+            line = line.decode('utf-8').rstrip()
+            self._log_and_print('[MATLAB{}{}] {}'.format(self._get_process_str(), ' ERROR' if is_std_err else '',
+                                                         line), force_print=is_std_err)
+            if not is_std_err and line.startswith('tt_worker: job '):
+                job_name, job_status = line.split(' ')[2:4]
+                with self._jobs_condition:
+                    self._jobs_status[job_name] = job_status
+                    self._jobs_condition.notify_all()
+            elif not is_std_err and line.startswith('tt_features: start '):
+                with self._jobs_condition:
+                    self.current_file = line[len('tt_features: start '):]
+                    self._current_file_start_time = time.monotonic()
+            elif not is_std_err and line.startswith('tt_features: done '):
+                with self._jobs_condition:
+                    self.processed_files.append(line[len('tt_features: done '):])
+                    self.current_file = None
+        if not is_std_err:
+            with self._jobs_condition:  # Output closed: the process is ending, waiting jobs can't complete
+                self._stdout_closed = True
+                self._jobs_condition.notify_all()
+
+    def is_alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def run_job(self, directories_list_file: pathlib.Path, options_file: Optional[pathlib.Path] = None,
+                timeout: Optional[float] = None, file_timeout: Optional[float] = None):
+        """
+        Sends a job (same arguments as tt_features.m) to the worker, and blocks until it has been processed.
+
+        :param timeout: If the job lasts longer (seconds), a TimbreToolboxTimeoutError is raised. Matlab is still
+            running the job: the worker must be restarted before it can be reused.
+        :param file_timeout: Same as timeout, for the analysis of a single audio file.
+        """
+        if not self.is_alive():
+            raise RuntimeError("Matlab worker{} is not running".format(self._get_process_str()))
+        job_name = '{:06d}'.format(self._jobs_counter)
+        self._jobs_counter += 1
+        with self._jobs_condition:
+            self.processed_files, self.current_file = list(), None
+        # Atomic creation of the job file, which must not be read by Matlab before it's complete
+        temp_job_file = self.spool_directory.joinpath(job_name + '.tmp')
+        with open(temp_job_file, 'w') as f:
+            f.write(str(directories_list_file.resolve()) + "\n")
+            if options_file is not None:
+                f.write(str(options_file.resolve()) + "\n")
+        os.replace(temp_job_file, self.spool_directory.joinpath(job_name + '.job'))
+        start_time, timeout_message, timed_out_file = time.monotonic(), None, None
+        with self._jobs_condition:
+            while not (job_name in self._jobs_status or self._stdout_closed):
+                now = time.monotonic()
+                if file_timeout is not None and self.current_file is not None \
+                        and now - self._current_file_start_time > file_timeout:
+                    timed_out_file = self.current_file
+                    timeout_message = "analysis of {} did not complete within {}s".format(timed_out_file, file_timeout)
+                    break
+                elif timeout is not None and now - start_time > timeout:
+                    timeout_message = "job {} did not complete within {}s".format(job_name, timeout)
+                    break
+                # Without file timeout, the job's completion or timeout is the only event to wait for
+                self._jobs_condition.wait(self.monitoring_period if file_timeout is not None
+                                          else (timeout - (now - start_time) if timeout is not None else None))
+            job_status = self._jobs_status.pop(job_name, None)
+            processed_files, current_file = list(self.processed_files), self.current_file
+        if timeout_message is not None:
+            raise TimbreToolboxTimeoutError("Matlab worker{}: {}".format(self._get_process_str(), timeout_message),
+                                            processed_files, current_file, timed_out_file)
+        if job_status is None:
+            raise RuntimeError("Matlab worker{} has ended before job {} was completed - please check console outputs "
+                               "above".format(self._get_process_str(), job_name))
+        if job_status != 'done':
+            raise RuntimeError("Matlab worker{} has raised an error during job {} - please check console outputs above"
+                               .format(self._get_process_str(), job_name))
+
+    def stop(self, timeout=60.0):
+        """ Asks the worker to exit after its current job (kills it after the timeout), then cleans the spool dir. """
+        if self.proc is not None:
+            self.spool_directory.joinpath('stop').touch()
+            try:
+                self.proc.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                warnings.warn("Matlab worker{} did not stop by itself, it will be killed".format(self._get_process_str()))
+                self.proc.kill()
+                self.proc.wait()
+            for t in self._reader_threads:
+                t.join()
+            self.proc = None
+        shutil.rmtree(self.spool_directory, ignore_errors=True)
+
+    def restart(self):
+        """ Kills the worker (and its children) without waiting for its current job, then starts a new Matlab
+        instance. Stale jobs and acknowledgements of the previous instance are discarded. """
+        self._log_and_print('[MATLAB{}] Worker restart'.format(self._get_process_str()), force_print=True)
+        if self.proc is not None:
+            kill_process_tree(self.proc.pid)
+            self.proc.wait()
+            for t in self._reader_threads:
+                t.join()
+            self.proc = None
+        for spool_file in self.spool_directory.iterdir():
+            spool_file.unlink(missing_ok=True)
+        with self._jobs_condition:
+            self._jobs_status.clear()
+        self.start()
+
     def _log_and_print(self, log_str: str, force_print=False):
         """ Use the logger attribute if available, otherwise just print """
         if self.logger is not None:
@@ -141,8 +425,71 @@ class TimbreToolboxProcess:
             print(log_str)
 
 
+class TimbreToolboxWorkerPool:
+    def __init__(self, timbre_toolbox_path: pathlib.Path, n_workers=1, verbose=True,
+                 logger: Optional[ToolboxLogger] = None, matlab_executable='matlab', monitoring_period=1.0):
+        """
+        Pool of long-lived Matlab workers (see TimbreToolboxWorker), to be reused across many TimbreToolbox
+        analyses. Should be used as a context manager, e.g.:
+
+            with TimbreToolboxWorkerPool(tt_path, n_workers=8) as tt_pool:
+                for directories in ...:
+                    compute_metrics(directories, tt_worker_pool=tt_pool)
+        """
+        self.timbre_toolbox_path, self.n_workers = pathlib.Path(timbre_toolbox_path), n_workers
+        self.workers = [TimbreToolboxWorker(self.timbre_toolbox_path, verbose=verbose, logger=logger,
+                                            worker_index=i, matlab_executable=matlab_executable,
+                                            monitoring_period=monitoring_period)
+                        for i in range(n_workers)]
+        self._idle_workers = queue.Queue()
+
+    def start(self):
+        for worker in self.workers:  # Matlab instances start (and initialize) in parallel
+            worker.start()
+            self._idle_workers.put(worker)
+
+    def run(self, directories_list_files: Sequence[pathlib.Path], options_file: Optional[pathlib.Path] = None,
+            timeout: Optional[float] = None, file_timeout: Optional[float] = None):
+        """ Runs all jobs (one job = one directories list file) on the idle workers, blocks until all have ended. """
+        with multiprocessing.pool.ThreadPool(self.n_workers) as p:
+            p.map(lambda f: self.run_job(f, options_file, timeout, file_timeout), directories_list_files)
+
+    def run_job(self, directories_list_file: pathlib.Path, options_file: Optional[pathlib.Path] = None,
+                timeout: Optional[float] = None, file_timeout: Optional[float] = None):
+        """ Runs a job on the next idle worker (see TimbreToolboxWorker.run_job). A worker whose job has timed out
+        is restarted before the TimbreToolboxTimeoutError is re-raised. """
+        worker = self._idle_workers.get()
+        try:
+            worker.run_job(directories_list_file, options_file=options_file, timeout=timeout,
+                           file_timeout=file_timeout)
+        except TimeoutError:
+            # Matlab is still running the timed-out job: its next job would wait behind it (or read its stale
+            # acknowledgement) if the worker was reused as-is
+            worker.restart()
+            raise
+        finally:
+            self._idle_workers.put(worker)
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 class TimbreToolboxResults:
+    # Written by the Matlab script in each directory, if the 'directory' output mode is used
+    consolidated_file_name = 'timbretoolbox_stats.csv'
+    consolidated_block_marker = 'TimbreToolboxSound,'
+
     def __init__(self, morphing_directories: List[pathlib.Path], audio_files: List[List[pathlib.Path]]):
+        """ Reads the results written by the Matlab script, in the 'sound' (1 CSV file / audio file) or 'directory'
+        (1 consolidated CSV file / directory) output mode. """
         self.morphing_dirs, self.audio_files = morphing_directories, audio_files
 
     def clean_stats_files(self):
@@ -156,14 +503,59 @@ class TimbreToolboxResults:
 
         :returns: A 2D list the same shape as self.audio_files
         """
-        results_from_csv = list()
+        all_lines, sources = self._read_all_lines()
+        results_from_csv, row = list(), 0
         for audio_files_1d in self.audio_files:
             results_from_csv.append(list())
-            for a in audio_files_1d:
-                csv_file = a.with_name(a.stem + "_stats.csv")
-                results_from_csv[-1].append(self.read_stats_csv(csv_file))
+            for _ in audio_files_1d:
+                results_from_csv[-1].append(self._parse_stats_lines(all_lines[row], sources[row]))
+                row += 1
         return results_from_csv
 
+    def read_matrix(self, n_threads=8):
+        """ Reads descriptors values from stats files corresponding to audio files, using the fast bulk reader.
+
+        :returns: values, descriptors_names, evaluation_errors (see read_stats_csv_bulk) where rows correspond to
+            the flattened self.audio_files 2D list.
+        """
+        return self._parse_stats_lines_bulk(*self._read_all_lines(n_threads))
+
+    def _read_all_lines(self, n_threads=8):
+        """ Reads the stats CSV lines of all audio files (flattened), from the consolidated stats file of each
+        directory if it exists, or from the individual stats files.
+
+        :returns: all_lines, sources (the file corresponding to each list of lines, for warnings and errors) """
+        all_lines, sources = list(), list()
+        for morphing_dir, audio_files_1d in zip(self.morphing_dirs, self.audio_files):
+            consolidated_file = morphing_dir.joinpath(self.consolidated_file_name)
+            if consolidated_file.exists():
+                blocks = self.read_consolidated_stats_csv(consolidated_file)
+                for a in audio_files_1d:
+                    if a.name not in blocks:
+                        raise ValueError("{} does not contain results for {}".format(consolidated_file, a.name))
+                    all_lines.append(blocks[a.name])
+                    sources.append('{} ({})'.format(consolidated_file, a.name))
+            else:
+                csv_files = [a.with_name(a.stem + "_stats.csv") for a in audio_files_1d]
+                with multiprocessing.pool.ThreadPool(n_threads) as p:
+                    all_lines += p.map(TimbreToolboxResults._read_lines, csv_files)
+                sources += csv_files
+        return all_lines, sources
+
+    @staticmethod
+    def read_consolidated_stats_csv(consolidated_file: pathlib.Path):
+        """ :returns: A Dict {audio_file_name: lines} which contains the stats CSV lines of each audio file """
+        blocks, current_block = dict(), None
+        marker = TimbreToolboxResults.consolidated_block_marker
+        for line in TimbreToolboxResults._read_lines(consolidated_file):
+            if line.startswith(marker):
+                current_block = blocks[line[len(marker):]] = list()
+            elif current_block is not None:
+                current_block.append(line)
+        for block in blocks.values():  # Trailing empty lines were added when blocks were written
+            while len(block) > 0 and len(block[-1]) == 0:
+                block.pop()
+        return blocks
 
     @staticmethod
     def _to_float(value: str, csv_file: Optional[pathlib.Path] = None, csv_line: Optional[int] = None):
@@ -178,135 +570,493 @@ class TimbreToolboxResults:
             float_value = np.abs(complex(value.replace('i', 'j')))  # Matlab uses 'i', Python uses 'j'
         return float_value
 
+    @staticmethod
+    def _is_evaluation_error(lines: List[str], csv_file: pathlib.Path):
+        """ :returns: True if the CSV lines correspond to an "Evaluation Error" case (raises if lines are invalid) """
+        # if lines is a single-item array, the CSV is supposed to correspond to an "Evaluation Error" case
+        if len(lines) == 1 or (len(lines) == 2 and len(lines[1]) <= 2):
+            if lines[0] == 'Evaluation Error':
+                warnings.warn("File {} contains 'Evaluation Error' - the Matlab script could not "
+                              "evaluate the associated audio file".format(csv_file))
+                return True
+            else:
+                raise ValueError("{} contains only 1 line: '{}' (should be audio features, or 'Evaluation Error')"
+                                 .format(csv_file, lines[0]))
+        return False
+
+    @staticmethod
+    def _get_stats_lines_plan(lines: List[str]):
+        """
+        Finds where descriptors' values are written in the lines of a stats CSV file.
+
+        :returns: A Dict {descriptor_name: line_index}, in the order descriptors were found
+        """
+        return TimbreToolboxResults._get_stats_lines_plan_and_headers(lines)[0]
+
+    @staticmethod
+    def _get_stats_lines_plan_and_headers(lines: List[str]):
+        """
+        See _get_stats_lines_plan.
+
+        :returns: descr_lines, headers_lines: headers_lines is a Dict {descriptor_name: [line_index, ...]} which
+            contains the indices of the 'Representation,' and 'Descriptor,' lines that own each descriptor value
+        """
+        descr_lines, headers_lines = dict(), dict()
+        # CSVs written by TimbreToolbox are not tabular data, but 1-item-per-line CSVs
+        current_repr, current_descr = None, None
+        repr_line, descr_line = None, None
+        for i, line in enumerate(lines):
+            if len(line) > 0:  # Non-empty line
+                try:
+                    name, value = line.split(',')
+                except ValueError:
+                    continue  # e.g. empty Unit, or STFT has oddly formatted data (single line with 'Minimums,')
+                # First: we look for a new descriptor or representation
+                if name.lower() == 'representation':  # New representation: next fields are related to the
+                    current_repr, repr_line = value, i  # representation, not one of its descriptors
+                    current_descr = None
+                elif name.lower() == 'descriptor':  # Next fields will be related to this descriptor
+                    current_descr, descr_line = value, i
+                else:  # At this point, the line contains a specific field
+                    if current_descr is not None:  # Representation fields (min/max/med/iqr + other fields, params?)
+                        if name.lower() in _stats_fields_suffixes:
+                            # If a descriptor is computed by several representations, the last one is kept
+                            descr_name = current_descr + _stats_fields_suffixes[name.lower()]
+                            descr_lines[descr_name] = i
+                            headers_lines[descr_name] = [j for j in (repr_line, descr_line) if j is not None]
+                        else:  # Other descriptor fields (e.g. unit, parameters) are discarded
+                            pass
+            else:  # Empty line indicates a new descriptor (maybe a new representation)
+                current_descr = None
+        return descr_lines, headers_lines
+
     @staticmethod
     def read_stats_csv(csv_file: pathlib.Path):
         """
         :return: A Dict of descriptors, or None if the Evaluation could not be performed by TimbreToolbox
         """
-        descr_data = dict()
+        return TimbreToolboxResults._parse_stats_lines(TimbreToolboxResults._read_lines(csv_file), csv_file)
+
+    @staticmethod
+    def _parse_stats_lines(lines: List[str], csv_file):
+        if TimbreToolboxResults._is_evaluation_error(lines, csv_file):
+            return None
+        return {descr_name: TimbreToolboxResults._to_float(lines[i].split(',')[1], csv_file, i)
+                for descr_name, i in TimbreToolboxResults._get_stats_lines_plan(lines).items()}
+
+    @staticmethod
+    def read_stats_csv_bulk(csv_files: Sequence[pathlib.Path], n_threads=8):
+        """
+        Reads many stats CSV files (concurrently). All files written by the same TimbreToolbox configuration share
+        the same layout: the layout of the first file is learned once, then values are read directly from the
+        same lines in the other files (files with a different layout are parsed entirely).
+
+        :returns: values, descriptors_names, evaluation_errors: values is a (n_files, n_descriptors) float matrix,
+            and evaluation_errors is a boolean vector which indicates files that contain 'Evaluation Error'
+            (the corresponding rows of values are NaNs).
+        """
+        with multiprocessing.pool.ThreadPool(n_threads) as p:
+            all_lines = p.map(TimbreToolboxResults._read_lines, csv_files)
+        return TimbreToolboxResults._parse_stats_lines_bulk(all_lines, csv_files)
+
+    @staticmethod
+    def _parse_stats_lines_bulk(all_lines: List[List[str]], csv_files: Sequence):
+        """ See read_stats_csv_bulk. csv_files are used only for warnings and error messages. """
+        evaluation_errors = np.asarray([TimbreToolboxResults._is_evaluation_error(lines, csv_file)
+                                        for lines, csv_file in zip(all_lines, csv_files)], dtype=bool)
+        # Learn the lines plan from the first valid file; each line's field name, and the whole 'Representation,'
+        # and 'Descriptor,' lines which own it, are stored to check other files (descriptors may come in another order)
+        lines_plan, field_names, headers = dict(), list(), list()
+        for lines, is_error in zip(all_lines, evaluation_errors):
+            if not is_error:
+                lines_plan, headers_lines = TimbreToolboxResults._get_stats_lines_plan_and_headers(lines)
+                field_names = [lines[i].split(',')[0] + ',' for i in lines_plan.values()]
+                headers = [(j, lines[j]) for j in sorted(set(sum(headers_lines.values(), [])))]
+                break
+        descr_names, descr_lines = list(lines_plan.keys()), list(lines_plan.values())
+        max_line = max(descr_lines + [j for j, _ in headers], default=-1)
+        values = np.full((len(csv_files), len(descr_names)), np.nan)
+        for row, (lines, csv_file, is_error) in enumerate(zip(all_lines, csv_files, evaluation_errors)):
+            if is_error:
+                continue
+            if len(lines) > max_line and all([lines[j] == header for j, header in headers]) \
+                    and all([lines[i].startswith(field_name) for i, field_name in zip(descr_lines, field_names)]):
+                str_values = [lines[i][len(field_name):] for i, field_name in zip(descr_lines, field_names)]
+                try:
+                    values[row, :] = np.asarray(str_values, dtype=float)
+                except ValueError:  # e.g. complex values
+                    values[row, :] = [TimbreToolboxResults._to_float(v, csv_file, i)
+                                      for v, i in zip(str_values, descr_lines)]
+            else:  # Different layout: slow parsing of the whole file
+                file_plan = TimbreToolboxResults._get_stats_lines_plan(lines)
+                missing_descr_names = [n for n in descr_names if n not in file_plan]
+                if len(missing_descr_names) > 0 or len(file_plan) > len(descr_names):
+                    warnings.warn("File {} does not contain the same descriptors as {} (missing: {}, ignored: {})"
+                                  .format(csv_file, csv_files[np.argmin(evaluation_errors)], missing_descr_names,
+                                          [n for n in file_plan if n not in lines_plan]))
+                for col, descr_name in enumerate(descr_names):
+                    if descr_name in file_plan:
+                        i = file_plan[descr_name]
+                        values[row, col] = TimbreToolboxResults._to_float(lines[i].split(',')[1], csv_file, i)
+        return values, descr_names, evaluation_errors
+
+    @staticmethod
+    def _read_lines(csv_file: pathlib.Path):
         with open(csv_file, 'r') as f:
-            lines = [line.rstrip() for line in f.readlines()]
-            # if lines is a single-item array, the CSV is supposed to correspond to an "Evaluation Error" case
-            if len(lines) == 1 or (len(lines) == 2 and len(lines[1]) <= 2):
-                if lines[0] == 'Evaluation Error':
-                    warnings.warn("File {} contains 'Evaluation Error' - the Matlab script could not "
-                                  "evaluate the associated audio file".format(csv_file))
-                    return None
-                else:
-                    raise ValueError("{} contains only 1 line: '{}' (should be audio features, or 'Evaluation Error')"
-                                     .format(csv_file, lines[0]))
-            # Otherwise, usual case: CSVs written by TimbreToolbox are not tabular data, but 1-item-per-line CSVs
-            current_repr, current_descr = None, None
-            for i, line in enumerate(lines):
-                if len(line) > 0:  # Non-empty line
-                    try:
-                        name, value = line.split(',')
-                    except ValueError:
-                        continue  # e.g. empty Unit, or STFT has oddly formatted data (single line with 'Minimums,')
-                    # First: we look for a new descriptor or representation
-                    if name.lower() == 'representation':  # New representation: next fields are related to the
-                        current_repr = value              # representation, not one of its descriptors
-                        current_descr = None
-                    elif name.lower() == 'descriptor':  # Next fields will be related to this descriptor
-                        current_descr = value
-                    else:  # At this point, the line contains a specific field
-                        if current_descr is not None:  # Representation fields (min/max/med/iqr + other fields, params?)
-                            if name.lower() == 'value':  # Global descriptors: single value
-                                descr_data[current_descr] = TimbreToolboxResults._to_float(value, csv_file, i)
-                            elif name.lower() == 'minimum':
-                                descr_data[current_descr + '_min'] = TimbreToolboxResults._to_float(value, csv_file, i)
-                            elif name.lower() == 'maximum':
-                                descr_data[current_descr + '_max'] = TimbreToolboxResults._to_float(value, csv_file, i)
-                            elif name.lower() == 'median':
-                                descr_data[current_descr + '_med'] = TimbreToolboxResults._to_float(value, csv_file, i)
-                            elif name.lower() == 'interquartile range':
-                                descr_data[current_descr + '_IQR'] = TimbreToolboxResults._to_float(value, csv_file, i)
-                            else:  # Other descriptor fields (e.g. unit, parameters) are discarded
-                                pass
-                else:  # Empty line indicates a new descriptor (maybe a new representation)
-                    current_descr = None
-        return descr_data
+            return [line.rstrip() for line in f]
+
+
+def write_options_file(options_file: pathlib.Path, output_mode='sound', eval_config: Optional[Dict] = None,
+                       input_mode='directories', output_directory: Optional[pathlib.Path] = None,
+                       stop_file: Optional[pathlib.Path] = None, scratch_directory: Optional[pathlib.Path] = None):
+    """
+    Writes the JSON options file of the tt_features.m Matlab script.
+
+    :param output_mode: 'sound' (default) writes a <audio_file>_stats.csv file next to each audio file, 'directory'
+        writes a single consolidated TimbreToolboxResults.consolidated_file_name file in each directory (much
+        fewer files to be created, read and deleted - e.g. on network file systems).
+    :param eval_config: TimbreToolbox evalConfig (see make_eval_config). If None, the default evalConfig of
+        tt_features.m is used (all descriptors of all representations are evaluated).
+    :param input_mode: 'directories' (default) if the list file given to Matlab contains directories, or 'files'
+        if it contains audio files. In the latter case, results are written into the directory of each audio file
+        or, if output_directory is given, all results are written into output_directory (as if the audio files were
+        stored in this directory - they must have different names).
+    :param stop_file: If this file exists, the Matlab script ends gracefully before analyzing the next audio file.
+    :param scratch_directory: Where the 'directory' output mode creates its temporary CSV directories (default:
+        Matlab's tempdir). A Matlab process killed by a watchdog can't delete its own temporary directory, thus
+        this directory should be deleted by the caller.
+    """
+    assert output_mode in ('sound', 'directory'), f"Unknown output mode '{output_mode}'"
+    assert input_mode in ('directories', 'files'), f"Unknown input mode '{input_mode}'"
+    options = {'outputMode': output_mode, 'inputMode': input_mode}
+    if output_directory is not None:
+        assert input_mode == 'files', "An output directory can be used with lists of files only"
+        options['outputDirectory'] = str(output_directory.resolve())
+    if eval_config is not None:
+        options['evalConfig'] = eval_config
+    if stop_file is not None:
+        options['stopFile'] = str(stop_file.resolve())
+    if scratch_directory is not None:
+        options['scratchDirectory'] = str(scratch_directory.resolve())
+    with open(options_file, 'w') as f:
+        json.dump(options, f)
+
+
+def write_evaluation_error(audio_file: pathlib.Path, output_mode='sound',
+                           output_directory: Optional[pathlib.Path] = None):
+    """
+    Writes an 'Evaluation Error' result for an audio file that Matlab could not analyze (e.g. killed by a watchdog),
+    where the Matlab script would have written its results (see write_options_file). Replaces the partial results
+    that a killed Matlab process may have written for this file.
+    """
+    output_directory = output_directory if output_directory is not None else audio_file.parent
+    if output_mode == 'sound':
+        with open(output_directory.joinpath(audio_file.stem + '_stats.csv'), 'w') as f:
+            f.write("Evaluation Error\n")
+    else:  # The last block of an audio file is read. Starts with a new line, in case a partial line was written
+        with open(output_directory.joinpath(TimbreToolboxResults.consolidated_file_name), 'a') as f:
+            f.write(f"\n{TimbreToolboxResults.consolidated_block_marker}{audio_file.name}\nEvaluation Error\n")
+
+
+def resume_files_list(files_list_file: pathlib.Path, timeout_error: TimbreToolboxTimeoutError, output_mode='sound',
+                      output_directory: Optional[pathlib.Path] = None):
+    """
+    After Matlab has been killed by a watchdog while it was analyzing a list of audio files ('files' input mode):
+    rewrites the list with the files that remain to be analyzed, such that a new Matlab instance can resume the
+    analysis. The file whose analysis has timed out (or the file being analyzed, if the job has timed out before
+    any file was analyzed) is skipped, and gets an 'Evaluation Error' result (see write_evaluation_error).
+
+    Matlab acknowledges file names only, which may not be unique: files are identified by their position in the
+    list, in the order Matlab processes them.
+
+    :returns: The number of remaining files
+    """
+    with open(files_list_file, 'r') as f:
+        audio_files = [pathlib.Path(line.rstrip()) for line in f if len(line.strip()) > 0]
+    if output_directory is None:  # tt_features.m groups files by directory (directories in order of appearance)
+        directories_order = {d: i for i, d in enumerate(dict.fromkeys([a.parent for a in audio_files]))}
+        audio_files = sorted(audio_files, key=lambda a: directories_order[a.parent])
+    n_processed = len(timeout_error.processed_files)
+    if [a.name for a in audio_files[:n_processed]] != timeout_error.processed_files:
+        raise RuntimeError(f"Files analyzed by Matlab don't match the list {files_list_file}")
+    if timeout_error.timed_out_file is not None or (n_processed == 0 and timeout_error.current_file is not None):
+        write_evaluation_error(audio_files[n_processed], output_mode, output_directory)
+        warnings.warn(f"{audio_files[n_processed]} could not be analyzed by Matlab (timeout)")
+        n_processed += 1
+    if n_processed == 0:
+        raise RuntimeError(f"Matlab was killed before analyzing any file of {files_list_file}") from timeout_error
+    with open(files_list_file, 'w') as f:
+        f.writelines([str(a) + "\n" for a in audio_files[n_processed:]])
+    return len(audio_files) - n_processed
+
+
+# Parameters of TimbreToolbox representations and descriptors (same values as the default evalConfig in tt_features.m)
+_representations_params = {
+    'TEE': {'CutoffFreq': 5},
+    'STFT': {'DistrType': 'pow', 'HopSize_sec': 0.0058, 'WinSize_sec': 0.0232, 'WinType': 'hamming', 'FFTSize': 1024},
+    'ERB': {'HopSize_sec': 0.0058, 'Method': 'fft', 'Exponent': 1/4},
+    'Harmonic': {'Threshold': 0.3, 'NHarms': 20, 'HopSize_sec': 0.025, 'WinSize_sec': 0.1, 'WinType': 'blackman',
+                 'FFTSize': 32768},
+}
+_descriptors_params = {
+    'TEE': {
+        'Att': {'Method': 3, 'NoiseThresh': 0.15, 'DecrThresh': 0.4},  # shared with Dec, Rel, LAT, AttSlope, DecSlope
+        'TempCent': {'Threshold': 0.15},
+        'EffDur': {'Threshold': 0.4},
+        'FreqMod': {'Method': 'fft'},  # shared with AmpMod
+        'RMSEnv': {'HopSize_sec': 0.0029, 'WinSize_sec': 0.0232},
+    },
+}
+
+
+def make_eval_config(descriptors_names: Sequence[str]):
+    """
+    Builds a TimbreToolbox evalConfig which evaluates only the given descriptors (and the descriptors they depend on).
+    Representations which don't provide any of the given descriptors are not evaluated at all.
+
+    A descriptor provided by several representations (e.g. spectral descriptors, provided by STFT, ERB and Harmonic)
+    is evaluated only by the last one, whose value is the one read from CSV files with the default evalConfig
+    (see timbretoolboxstats.get_descriptor_representation).
+
+    :param descriptors_names: e.g. ['SpecCent', 'Att'] (see timbretoolboxstats.get_descriptor_name)
+    :returns: The evalConfig, as a JSON-serializable dict
+    """
+    descriptors_names = set(descriptors_names)
+    for descr_name in list(descriptors_names):
+        descriptors_names.update(timbretoolboxstats.descriptors_dependencies.get(descr_name, []))
+    descriptors_representations = {d: timbretoolboxstats.get_descriptor_representation(d) for d in descriptors_names}
+    unknown_names = [d for d, repr_name in descriptors_representations.items() if repr_name is None]
+    if len(unknown_names) > 0:
+        raise ValueError(f"Unknown TimbreToolbox descriptors: {sorted(unknown_names)}")
+    eval_config = {'AudioSignal': {'NoDescr': {}}}
+    for repr_name, repr_descriptors in timbretoolboxstats.representations_descriptors.items():
+        repr_descriptors = [d for d in repr_descriptors if descriptors_representations.get(d) == repr_name]
+        if len(repr_descriptors) > 0:
+            eval_config[repr_name] = dict(_representations_params[repr_name])
+            for descr_name in repr_descriptors:
+                eval_config[repr_name][descr_name] = dict(_descriptors_params.get(repr_name, {}).get(descr_name, {}))
+    return eval_config
+
+
+def get_tt_cache_key(audio_hash: str, eval_config: Optional[Dict] = None):
+    """
+    Returns the FeaturesCache key of the TimbreToolbox descriptors of an audio file. The key depends on the audio
+    content, on the evalConfig, and on the tt_features.m script itself (which contains the default evalConfig).
+
+    :param audio_hash: See featurescache.audio_content_hash
+    :param eval_config: See make_eval_config (None: default evalConfig of tt_features.m)
+    """
+    return FeaturesCache.make_key(audio_hash, 'timbretoolbox', _get_tt_features_script_hash(),
+                                  {'eval_config': eval_config})
+
+
+@functools.lru_cache(maxsize=None)
+def _get_tt_features_script_hash():
+    with open(pathlib.Path(__file__).with_name('tt_features.m'), 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# Statistics fields of TimbreToolbox descriptors, and the suffix of the corresponding descriptor names
+_stats_fields_suffixes = {'value': '', 'minimum': '_min', 'maximum': '_max', 'median': '_med',
+                          'interquartile range': '_IQR'}
 
 
 class TimbreToolboxSingleDir:
     def __init__(self, audio_dir: pathlib.Path,
                  n_workers=1, max_audio_files_per_worker=2000,
-                 timbre_toolbox_path='~/Documents/MATLAB/timbretoolbox', verbose=False, json_files_suffix=''):
+                 timbre_toolbox_path='~/Documents/MATLAB/timbretoolbox', verbose=False, json_files_suffix='',
+                 scratch_dir: Optional[pathlib.Path] = None, units_per_worker=4,
+                 matlab_max_rss_mb: Optional[float] = None, matlab_max_files: Optional[int] = None,
+                 file_timeout: Optional[float] = None, job_timeout: Optional[float] = None,
+                 features_cache: Optional[Union[str, pathlib.Path, FeaturesCache]] = None):
         """ Allows to easily perform a Timbre Toolbox analysis for all .wav audio files than can be found
         in a given directory. Uses multiple Matlab instances in parallel (a single instance can use only 1 CPU).
-        Works for huge directories, which will be split into small directories with symlink to the original.
+        Works for huge directories, which will be split into chunks of files: each Matlab instance receives the
+        explicit list of the files of its chunk, and writes its results into a scratch directory.
+
+        Chunks (work units) are sized by total audio duration (read from the files' headers), and workers pull
+        units from a shared queue (longest units first) as soon as they are idle, so that chunks of long sounds
+        don't delay the whole analysis. Per-worker statistics are available in self.workers_stats after run().
 
-        JSON files (instead of raw .CSV from Matlab) will be written directly in the given audio_dir. """
+        JSON files (instead of raw .CSV from Matlab) will be written directly in the given audio_dir.
+
+        :param max_audio_files_per_worker: Maximum number of files in a chunk (a new Matlab instance is started for
+            each chunk).
+        :param scratch_dir: Where the temporary Matlab inputs and outputs are stored. Defaults to the system's
+            temporary directory (should be a local disk, not the network file system that stores the dataset).
+        :param units_per_worker: Target number of chunks per worker (more chunks: better load balancing, but more
+            Matlab instances to be started).
+        :param matlab_max_rss_mb: If the memory (RSS, in MB) used by a Matlab instance exceeds this value, the
+            instance is stopped gracefully (after its current file) and a new instance resumes the analysis of the
+            chunk from the next unprocessed file.
+        :param matlab_max_files: Maximum number of files analyzed by a Matlab instance before it is recycled
+            (same as matlab_max_rss_mb). When Matlab instances are recycled, max_audio_files_per_worker can be
+            much larger than its default value.
+        :param file_timeout: If the analysis of a single file lasts longer (seconds), Matlab is killed, the file is
+            considered as an 'Evaluation Error' and a new Matlab instance resumes the analysis from the next file.
+        :param job_timeout: Maximum duration (seconds) of a Matlab instance. If it expires, Matlab is killed and a new
+            instance resumes the analysis (if no file was analyzed by the killed instance, the file being analyzed
+            is considered as an 'Evaluation Error').
+        :param features_cache: A FeaturesCache instance, or the path to its database file. Descriptors of audio files
+            which have already been analyzed (identical audio content) are retrieved from this cache, and only the
+            other files are sent to Matlab.
+        """
 
         self.audio_dir, self.n_workers, self.timbre_toolbox_path, self.verbose, self.json_files_suffix = \
             audio_dir, n_workers, pathlib.Path(timbre_toolbox_path), verbose, json_files_suffix
+        self.matlab_max_rss_mb, self.matlab_max_files = matlab_max_rss_mb, matlab_max_files
+        self.file_timeout, self.job_timeout = file_timeout, job_timeout
 
-        # look for all files in audio_dir, separate them into new directories using symlinks
-        #    because 1 Matlab instance will process all files (or symlinks) available in a given directory
         self.wav_files = sorted([p for p in self.audio_dir.glob('*.wav') if p.is_file()])
-        # assign wav files to audio dirs - split using the appropriate chunk size (not the number of chunks);
+        # Cached descriptors (from previous analyses of the same audio content)
+        if isinstance(features_cache, (str, pathlib.Path)):
+            features_cache = FeaturesCache(features_cache)
+        self.features_cache = features_cache
+        if self.features_cache is not None:
+            self.cache_keys = [get_tt_cache_key(audio_content_hash(p)) for p in self.wav_files]
+            self.cached_descriptors_values = self.features_cache.get_many(self.cache_keys)
+        else:
+            self.cache_keys, self.cached_descriptors_values = None, [None for _ in self.wav_files]
+        self.analyzed_wav_files = [p for p, v in zip(self.wav_files, self.cached_descriptors_values) if v is None]
+        if self.verbose and self.features_cache is not None:
+            print(f"[{self.__class__.__name__}] {len(self.wav_files) - len(self.analyzed_wav_files)} files found in "
+                  f"the cache, {len(self.analyzed_wav_files)} files to be analyzed")
+
+        self.wav_durations = np.asarray([sf.info(str(p)).duration for p in self.analyzed_wav_files])  # headers only
+        # assign wav files to chunks of (approx.) the same total duration;
         # we'll usually have more chunks (of data) than workers
-        n_chunks = 1 + (len(self.wav_files) // max_audio_files_per_worker)
-        if n_chunks < n_workers:  # Small dataset (few chunks) -> use a larger number of chunks with less datapoints
-            n_chunks = n_workers
-        self.original_wav_files_split = np.array_split(np.asarray(self.wav_files), n_chunks)
-        self.original_wav_files_split = [list(a) for a in self.original_wav_files_split]
-        # Fill the temp audio dirs (inside an easy-to-remove temp directory)
-        self.main_temp_audio_dir = self.audio_dir.parent.joinpath(self.audio_dir.name + "_temp")
-        if os.path.exists(self.main_temp_audio_dir):
-            shutil.rmtree(self.main_temp_audio_dir)
-        self.main_temp_audio_dir.mkdir(exist_ok=False)
-        self.temp_split_audio_dirs = [self.main_temp_audio_dir.joinpath(f'{i:03d}') for i in range(self.n_splits())]
-        # create temporary directories and symlinks
-        # more temp dirs than workers: each directory should contain 2000 sounds maximum... to prevent the error:
+        n_chunks = max(n_workers * units_per_worker, 1 + (len(self.analyzed_wav_files) // max_audio_files_per_worker))
+        chunk_target_duration = self.wav_durations.sum() / n_chunks
+        self.original_wav_files_split, self.chunks_durations = list(), list()
+        for wav_file, duration in zip(self.analyzed_wav_files, self.wav_durations):
+            if len(self.original_wav_files_split) == 0 or self.chunks_durations[-1] >= chunk_target_duration \
+                    or len(self.original_wav_files_split[-1]) >= max_audio_files_per_worker:
+                self.original_wav_files_split.append([])
+                self.chunks_durations.append(0.0)
+            self.original_wav_files_split[-1].append(wav_file)
+            self.chunks_durations[-1] += duration
+        # more chunks than workers: each Matlab instance should process 2000 sounds maximum... to prevent the error:
         #     Exception in thread "AWT-EventQueue-0" java.lang.OutOfMemoryError: Java heap space
         #     (TimbreToolbox bug: seems to happen after approx. 13k audio files have been processed)
-        self.wav_symlinks_split = [[] for _ in self.original_wav_files_split]
-        for i, temp_audio_dir in enumerate(self.temp_split_audio_dirs):
-            temp_audio_dir.mkdir(exist_ok=False)
-            for original_wav_file in self.original_wav_files_split[i]:
-                self.wav_symlinks_split[i].append(temp_audio_dir.joinpath(original_wav_file.name))
-                os.symlink(original_wav_file, self.wav_symlinks_split[i][-1])
-
-        # Will be auto-deleted (if not killed...)
-        self.temp_matlab_arg_file_wrappers = [tempfile.NamedTemporaryFile('w+') for _ in range(self.n_splits())]
-        for i, temp_audio_dir in enumerate(self.temp_split_audio_dirs):
-            self.temp_matlab_arg_file_wrappers[i].file.write(str(temp_audio_dir) + "\n")
-            self.temp_matlab_arg_file_wrappers[i].file.flush()
+        # Each chunk has its own files list, options file and output directory (only a few files per chunk)
+        self.scratch_dir = pathlib.Path(tempfile.mkdtemp(prefix='tt_single_dir_', dir=scratch_dir))
+        self.chunks_output_dirs = [self.scratch_dir.joinpath(f'{i:03d}') for i in range(self.n_splits())]
+        self.matlab_arg_files, self.matlab_options_files, self.matlab_stop_files = list(), list(), list()
+        for i, chunk_output_dir in enumerate(self.chunks_output_dirs):
+            chunk_output_dir.mkdir(exist_ok=False)
+            self.matlab_arg_files.append(self.scratch_dir.joinpath(f'{i:03d}_files.txt'))
+            self._write_files_list(self.matlab_arg_files[-1], self.original_wav_files_split[i])
+            self.matlab_options_files.append(self.scratch_dir.joinpath(f'{i:03d}_options.json'))
+            self.matlab_stop_files.append(self.scratch_dir.joinpath(f'{i:03d}_stop'))
+            write_options_file(self.matlab_options_files[-1], output_mode='directory', input_mode='files',
+                               output_directory=chunk_output_dir, stop_file=self.matlab_stop_files[-1],
+                               scratch_directory=self.scratch_dir)
         if self.verbose:
-            print(f"[{self.__class__.__name__}] Matlab input args stored in "
-                  f"{[p.name for p in self.temp_matlab_arg_file_wrappers]}")
+            print(f"[{self.__class__.__name__}] Matlab input args stored in {self.scratch_dir}")
 
     def n_splits(self):
         return len(self.original_wav_files_split)
 
+    @staticmethod
+    def _write_files_list(files_list_file: pathlib.Path, wav_files: Sequence[pathlib.Path]):
+        with open(files_list_file, 'w') as f:
+            f.writelines([str(wav_file.resolve()) + "\n" for wav_file in wav_files])
+
     def run(self):
-        # run all processors in their own thread
-        threads_args = [(i, pathlib.Path(temp_arg_file_wrapper.name))
-                        for i, temp_arg_file_wrapper in enumerate(self.temp_matlab_arg_file_wrappers)]
+        # Shared queue of chunks: longest chunks first, such that the last chunks to be processed are short ones
+        chunks_queue = queue.Queue()
+        for chunk_index in np.argsort(-np.asarray(self.chunks_durations), kind='stable'):
+            chunks_queue.put(int(chunk_index))
+        self.workers_stats = [{'n_chunks': 0, 'n_files': 0, 'audio_duration': 0.0, 'busy_time': 0.0}
+                              for _ in range(self.n_workers)]
+        # run all workers in their own thread
+        t_start = time.monotonic()
         with multiprocessing.pool.ThreadPool(self.n_workers) as p:
-            p.map(self._run_single_dir_processor, threads_args)
-
-        # read results (CSVs in all temp sub-dirs) and store them to json
-        csv_files_path = []
-        for i in range(len(self.wav_symlinks_split)):
-            for wav_symlink in self.wav_symlinks_split[i]:
-                csv_files_path.append(wav_symlink.parent.joinpath(wav_symlink.name.replace('.wav', '_stats.csv')))
-        all_raw_descriptors_values = [TimbreToolboxResults.read_stats_csv(p) for p in csv_files_path]  # list of dicts
-        json_files_path = [self.audio_dir.joinpath(p.name.replace('_stats.csv', f'{self.json_files_suffix}.json'))
-                           for p in csv_files_path]
+            p.map(lambda worker_index: self._run_worker(worker_index, chunks_queue), range(self.n_workers))
+        total_time = time.monotonic() - t_start
+        for worker_stats in self.workers_stats:
+            worker_stats['utilization'] = worker_stats['busy_time'] / total_time if total_time > 0.0 else 0.0
+        if self.verbose:
+            print(f"[{self.__class__.__name__}] {len(self.wav_files)} files processed in {total_time:.1f}s")
+            for worker_index, worker_stats in enumerate(self.workers_stats):
+                print(f"    Worker #{worker_index}: {worker_stats['n_chunks']} chunks, {worker_stats['n_files']} "
+                      f"files ({worker_stats['audio_duration']:.1f}s of audio), busy {worker_stats['busy_time']:.1f}s "
+                      f"({100.0 * worker_stats['utilization']:.1f}% utilization)")
+
+        # read results (a consolidated CSV in each output dir; chunks contain consecutive analyzed files)
+        tt_results = TimbreToolboxResults(self.chunks_output_dirs, self.original_wav_files_split)
+        values, descr_names, evaluation_errors = tt_results.read_matrix()
+        analyzed_descriptors_values = [(dict(zip(descr_names, values[i, :].tolist())) if not evaluation_errors[i]
+                                        else None) for i in range(len(self.analyzed_wav_files))]  # list of dicts
+        # Evaluation errors are not cached (they might be caused by timeouts)
+        if self.features_cache is not None:
+            cache_keys = [k for k, v in zip(self.cache_keys, self.cached_descriptors_values) if v is None]
+            new_entries = [(k, v) for k, v in zip(cache_keys, analyzed_descriptors_values) if v is not None]
+            self.features_cache.put_many([k for k, _ in new_entries], [v for _, v in new_entries])
+        # store all results (cached and analyzed) to json
+        analyzed_descriptors_values = iter(analyzed_descriptors_values)
+        all_raw_descriptors_values = [(v if v is not None else next(analyzed_descriptors_values))
+                                      for v in self.cached_descriptors_values]
+        json_files_path = [self.audio_dir.joinpath(p.stem + f'{self.json_files_suffix}.json') for p in self.wav_files]
         for i, p in enumerate(json_files_path):
             with open(p, 'w') as f:
                 json.dump(all_raw_descriptors_values[i], f)
-        # erase temp folders (will erase all symlinks and CSVs)
-        shutil.rmtree(self.main_temp_audio_dir)
-
-    def _run_single_dir_processor(self, args):
-        proc_index, temp_arg_file = args
-        timbre_processor = TimbreToolboxProcess(
-            self.timbre_toolbox_path, temp_arg_file, self.verbose, process_index=proc_index)
-        # This launches Matlab and the script, but nothing else (no cleanup, no post-processing, etc.)
-        timbre_processor.run()
+        # erase the scratch dir (a few files per chunk, and temporary directories of killed Matlab processes)
+        shutil.rmtree(self.scratch_dir)
+
+    def _run_worker(self, worker_index: int, chunks_queue: queue.Queue):
+        """ Processes chunks from the shared queue until it is empty. """
+        worker_stats = self.workers_stats[worker_index]
+        while True:
+            try:
+                chunk_index = chunks_queue.get_nowait()
+            except queue.Empty:
+                return
+            t_start = time.monotonic()
+            self._run_single_dir_processor(chunk_index)
+            worker_stats['busy_time'] += time.monotonic() - t_start
+            worker_stats['n_chunks'] += 1
+            worker_stats['n_files'] += len(self.original_wav_files_split[chunk_index])
+            worker_stats['audio_duration'] += self.chunks_durations[chunk_index]
+
+    def _run_single_dir_processor(self, chunk_index: int):
+        remaining_wav_files = self.original_wav_files_split[chunk_index]
+        while True:
+            timbre_processor = TimbreToolboxProcess(
+                self.timbre_toolbox_path, self.matlab_arg_files[chunk_index], self.verbose, process_index=chunk_index,
+                options_file=self.matlab_options_files[chunk_index], stop_file=self.matlab_stop_files[chunk_index],
+                max_rss_mb=self.matlab_max_rss_mb, max_processed_files=self.matlab_max_files,
+                file_timeout=self.file_timeout, job_timeout=self.job_timeout)
+            # This launches Matlab and the script, but nothing else (no cleanup, no post-processing, etc.)
+            timbre_processor.run()
+            if not (timbre_processor.stop_requested or timbre_processor.killed):
+                return
+            # Matlab has been recycled or killed: a new instance resumes from the next unprocessed file (results are
+            #    appended to the consolidated CSV of the chunk)
+            processed_files = set(timbre_processor.processed_files)
+            failed_file = timbre_processor.timed_out_file
+            if timbre_processor.killed and failed_file is None and len(processed_files) == 0:
+                failed_file = timbre_processor.current_file  # Job timeout, but no progress at all
+            if failed_file is not None:
+                self._write_evaluation_error(chunk_index, failed_file)
+                processed_files.add(failed_file)
+            if len(processed_files) == 0:
+                raise RuntimeError(f"Matlab #{chunk_index} was stopped before analyzing any file")
+            remaining_wav_files = [p for p in remaining_wav_files if p.name not in processed_files]
+            if len(remaining_wav_files) == 0:
+                return
+            if self.verbose:
+                print(f"[{self.__class__.__name__}] Matlab #{chunk_index} recycled, "
+                      f"{len(remaining_wav_files)} files remaining")
+            self._write_files_list(self.matlab_arg_files[chunk_index], remaining_wav_files)
+            self.matlab_stop_files[chunk_index].unlink(missing_ok=True)
+
+    def _write_evaluation_error(self, chunk_index: int, wav_file_name: str):
+        """ Appends an 'Evaluation Error' result to the consolidated CSV of a chunk (replaces the partial results
+        that a killed Matlab process may have written for this file). """
+        write_evaluation_error(self.audio_dir.joinpath(wav_file_name), output_mode='directory',
+                               output_directory=self.chunks_output_dirs[chunk_index])
+        warnings.warn(f"{wav_file_name} could not be analyzed by Matlab #{chunk_index} (timeout)")
 
 
 if __name__ == "__main__":
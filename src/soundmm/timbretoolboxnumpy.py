@@ -0,0 +1,454 @@
+"""
+NumPy implementation of TimbreToolbox descriptors, which does not require Matlab.
+
+Descriptors are computed with the parameters of the default evalConfig from tt_features.m, and are returned with
+the same names as the descriptors read from TimbreToolbox stats CSV files (e.g. 'Att', 'RMSEnv_med').
+Values are approximations of the TimbreToolbox (Matlab) values: they have not been validated against Matlab
+results, so they should not be mixed with features computed by TimbreToolbox.
+
+Audio files are processed in batches: files with the same sampling rate and length are stacked into a 2D
+(n_files, n_samples) array, and each representation is computed for the whole batch using array operations.
+"""
+
+import pathlib
+import warnings
+from typing import Optional, Sequence, List, Dict, Union
+
+import numpy as np
+import scipy.fft
+import scipy.signal
+import soundfile as sf
+
+from . import timbretoolboxstats
+from .featurescache import FeaturesCache
+
+
+# Must be increased whenever computed values change (used to build the features cache keys)
+engine_version = '1'
+
+# Parameters from the default evalConfig of tt_features.m
+tee_params = {
+    'CutoffFreq': 5,
+    'Att': {'Method': 3, 'NoiseThresh': 0.15, 'DecrThresh': 0.4},
+    'TempCent': {'Threshold': 0.15},
+    'EffDur': {'Threshold': 0.4},
+    'FreqMod': {'Method': 'fft'},
+    'RMSEnv': {'HopSize_sec': 0.0029, 'WinSize_sec': 0.0232},
+}
+stft_params = {'DistrType': 'pow', 'HopSize_sec': 0.0058, 'WinSize_sec': 0.0232, 'WinType': 'hamming', 'FFTSize': 1024}
+harmonic_params = {'Threshold': 0.3, 'NHarms': 20, 'HopSize_sec': 0.025, 'WinSize_sec': 0.1, 'WinType': 'blackman',
+                   'FFTSize': 32768}
+# Attack estimation ('weakest effort' method): number of thresholds, and the factor applied to the mean effort
+#     beyond which an effort is considered too large
+_n_attack_thresholds = 10
+_attack_effort_factor = 3.0
+# The energy envelope is low-pass filtered at CutoffFreq, thus it is decimated to approx. this sampling rate
+_envelope_target_fs = 1000.0
+# Range of amplitude/frequency modulations searched in the sustain part of the energy envelope
+_modulation_freq_range = (1.0, 10.0)
+# Spectral roll-off: frequency below which this ratio of the spectral energy is contained
+_rolloff_threshold = 0.95
+# F0 estimation (harmonic sum of the first harmonics, for log-spaced f0 candidates), then harmonic peaks are searched
+#     around multiples of f0 (+/- a ratio of f0)
+_f0_range = (40.0, 2000.0)
+_f0_candidates_per_octave = 48
+_f0_n_scoring_harmonics = 8
+_harmonic_search_width = 0.25
+# Number of frames transformed at once by the high-resolution FFT of the Harmonic representation (limits memory usage)
+_harmonic_frames_chunk_size = 128
+
+# Descriptors that can be computed by this module, for each TimbreToolbox representation
+representations_descriptors = {
+    'TEE': ['Att', 'Dec', 'Rel', 'LAT', 'AttSlope', 'DecSlope', 'TempCent', 'EffDur', 'FreqMod', 'AmpMod', 'RMSEnv'],
+    'STFT': timbretoolboxstats.representations_descriptors['STFT'],
+    'Harmonic': ['F0', 'HarmErg', 'NoiseErg', 'InHarm', 'HarmDev', 'OddEvenRatio'],
+}
+supported_descriptors = [d for descriptors in representations_descriptors.values() for d in descriptors]
+
+
+def get_cache_key(audio_hash: str, descriptors: Optional[Sequence[str]] = None):
+    """ Builds the features cache key of the descriptors computed by this module (None: all descriptors). """
+    return FeaturesCache.make_key(audio_hash, 'timbretoolboxnumpy', engine_version,
+                                  {'descriptors': (sorted(descriptors) if descriptors is not None else None)})
+
+
+def load_audio(audio_file: Union[str, pathlib.Path]):
+    """ :returns: mono_audio, fs (channels of multichannel files are averaged) """
+    audio, fs = sf.read(str(audio_file), dtype='float64', always_2d=True)
+    return audio.mean(axis=1), fs
+
+
+def _stats(values: np.ndarray, descriptor_name: str):
+    """ Computes TimbreToolbox statistics of time series (one series per row), e.g. {'RMSEnv_med': ...}.
+    The interquartile range uses Matlab's percentiles definition. NaN values (e.g. non-harmonic frames) are
+    ignored. Statistics of empty series (e.g. sounds shorter than two frames) are NaN. """
+    if values.shape[1] == 0:
+        nan_values = np.full(values.shape[0], np.nan)
+        return {f'{descriptor_name}_{stat}': nan_values for stat in ['min', 'max', 'med', 'IQR']}
+    if np.isnan(values).any():
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)  # All-NaN series: NaN statistics
+            q1, med, q3 = np.nanpercentile(values, [25.0, 50.0, 75.0], axis=1, method='hazen')
+            min_values, max_values = np.nanmin(values, axis=1), np.nanmax(values, axis=1)
+    else:
+        q1, med, q3 = np.percentile(values, [25.0, 50.0, 75.0], axis=1, method='hazen')
+        min_values, max_values = values.min(axis=1), values.max(axis=1)
+    return {f'{descriptor_name}_min': min_values, f'{descriptor_name}_max': max_values,
+            f'{descriptor_name}_med': med, f'{descriptor_name}_IQR': q3 - q1}
+
+
+def _weakest_effort(env: np.ndarray, noise_thresh: float):
+    """
+    Estimates the start and the end of the attack of normalized (max 1.0) energy envelopes, using Peeters'
+    'weakest effort' method: the efforts are the durations required to go from one threshold to the next one. The
+    attack starts at the first threshold reached with an acceptable effort, and ends at the threshold after which
+    the effort becomes too large (or at the maximum of the envelope).
+
+    :returns: start_indices, end_indices
+    """
+    thresholds = np.linspace(noise_thresh, 1.0, _n_attack_thresholds)
+    # Index of the first envelope sample above each threshold, (n_files, n_thresholds)
+    positions = np.argmax(env[:, np.newaxis, :] >= thresholds[np.newaxis, :, np.newaxis], axis=2)
+    efforts = np.diff(positions, axis=1)
+    is_large = efforts > _attack_effort_factor * efforts.mean(axis=1, keepdims=True)
+    start_thresholds = np.argmax(~is_large, axis=1)
+    is_end = is_large & (np.arange(efforts.shape[1])[np.newaxis, :] > start_thresholds[:, np.newaxis])
+    end_thresholds = np.where(is_end.any(axis=1), np.argmax(is_end, axis=1), _n_attack_thresholds - 1)
+    rows = np.arange(env.shape[0])
+    return positions[rows, start_thresholds], positions[rows, end_thresholds]
+
+
+def _masked_linear_fit(x: np.ndarray, y: np.ndarray, mask: np.ndarray):
+    """ Least-squares fit of y = slope * x + intercept, for each row (only where mask is True).
+    :returns: slopes, intercepts (NaN if less than 2 points are available) """
+    n = mask.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_mean = np.where(mask, x, 0.0).sum(axis=1) / n
+        y_mean = np.where(mask, y, 0.0).sum(axis=1) / n
+        dx, dy = x - x_mean[:, np.newaxis], y - y_mean[:, np.newaxis]
+        slopes = np.where(mask, dx * dy, 0.0).sum(axis=1) / np.where(mask, dx ** 2, 0.0).sum(axis=1)
+    slopes[n < 2] = np.nan
+    return slopes, y_mean - slopes * x_mean
+
+
+def tee_descriptors(audio: np.ndarray, fs: int):
+    """
+    Computes the Temporal Energy Envelope (TEE) descriptors of a batch of sounds. The energy envelope is the
+    amplitude of the analytic signal, filtered by a 3rd-order low-pass Butterworth filter (causal, as in
+    TimbreToolbox) at CutoffFreq.
+
+    - Att and Dec are the start and the end of the attack (the decay starts at the end of the attack), Rel is the
+      start of the release (estimated on the time-reversed envelope). Times are given in seconds.
+    - LAT is the log10 of the attack duration, AttSlope the mean slope of the normalized envelope during the attack.
+    - DecSlope is the slope of the log-envelope, from the end of the attack until the envelope falls below
+      DecrThresh.
+    - FreqMod and AmpMod are the frequency and amplitude of the largest modulation of the sustain part of the
+      envelope (between Dec and Rel). They are NaN if the sustain is shorter than one modulation period.
+
+    :param audio: Mono audio samples, with shape (n_files, n_samples).
+    :returns: A dict of descriptor values, each value being a vector of length n_files
+    """
+    audio = np.atleast_2d(audio)
+    n_files, n_samples = audio.shape
+    # Energy envelope, normalized and decimated (no aliasing after low-pass filtering)
+    n_fft = scipy.fft.next_fast_len(n_samples)
+    env = np.abs(scipy.signal.hilbert(audio, N=n_fft, axis=1)[:, :n_samples])
+    sos = scipy.signal.butter(3, tee_params['CutoffFreq'], btype='low', fs=fs, output='sos')
+    decimation = max(1, int(fs // _envelope_target_fs))
+    env = scipy.signal.sosfilt(sos, env, axis=1)[:, ::decimation]
+    env_fs = fs / decimation
+    with np.errstate(divide='ignore', invalid='ignore'):
+        env = env / env.max(axis=1, keepdims=True)
+    env = np.nan_to_num(env, nan=0.0)
+    n_frames = env.shape[1]
+    times = np.arange(n_frames) / env_fs
+    frames = np.arange(n_frames)[np.newaxis, :]
+    rows = np.arange(n_files)
+
+    # Attack and release
+    att_params = tee_params['Att']
+    att_start, att_end = _weakest_effort(env, att_params['NoiseThresh'])
+    _, reversed_rel_start = _weakest_effort(env[:, ::-1], att_params['NoiseThresh'])
+    rel_start = np.maximum(n_frames - 1 - reversed_rel_start, att_end)
+    descriptors = {'Att': att_start / env_fs, 'Dec': att_end / env_fs, 'Rel': rel_start / env_fs}
+    att_duration = np.maximum(att_end - att_start, 1) / env_fs
+    descriptors['LAT'] = np.log10(att_duration)
+    descriptors['AttSlope'] = (env[rows, att_end] - env[rows, att_start]) / att_duration
+    # Decrease: the envelope is fitted from the end of the attack, until it falls below the decrease threshold
+    is_below = (env < att_params['DecrThresh']) & (frames >= att_end[:, np.newaxis])
+    decr_end = np.where(is_below.any(axis=1), np.argmax(is_below, axis=1), n_frames)
+    decr_mask = (frames >= att_end[:, np.newaxis]) & (frames < decr_end[:, np.newaxis]) & (env > 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):  # Filtered envelopes can be slightly negative
+        log_env = np.log(env)
+    descriptors['DecSlope'], _ = _masked_linear_fit(np.broadcast_to(times, env.shape), log_env, decr_mask)
+
+    # Temporal centroid and effective duration
+    centroid_weights = np.where(env > tee_params['TempCent']['Threshold'], env, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):  # Silent sounds: NaN centroid
+        descriptors['TempCent'] = (centroid_weights * times).sum(axis=1) / centroid_weights.sum(axis=1)
+    descriptors['EffDur'] = (env > tee_params['EffDur']['Threshold']).sum(axis=1) / env_fs
+
+    # Modulations of the sustain part: linear trend is removed, then the largest spectral peak is searched
+    sustain_mask = (frames >= att_end[:, np.newaxis]) & (frames <= rel_start[:, np.newaxis])
+    slopes, intercepts = _masked_linear_fit(np.broadcast_to(times, env.shape), env, sustain_mask)
+    sustain = np.where(sustain_mask, env - (slopes[:, np.newaxis] * times + intercepts[:, np.newaxis]), 0.0)
+    sustain = np.nan_to_num(sustain, nan=0.0)
+    min_freq, max_freq = _modulation_freq_range
+    n_fft = scipy.fft.next_fast_len(max(n_frames, int(np.ceil(10.0 * env_fs / min_freq))))
+    spectrum = np.abs(scipy.fft.rfft(sustain, n=n_fft, axis=1))
+    spectrum *= 2.0 / np.maximum(sustain_mask.sum(axis=1), 1)[:, np.newaxis]
+    freqs = scipy.fft.rfftfreq(n_fft, 1.0 / env_fs)
+    freqs_range = (freqs >= min_freq) & (freqs <= max_freq)
+    peaks = np.argmax(spectrum[:, freqs_range], axis=1)
+    is_valid = sustain_mask.sum(axis=1) / env_fs >= 1.0 / min_freq
+    descriptors['FreqMod'] = np.where(is_valid, freqs[freqs_range][peaks], np.nan)
+    descriptors['AmpMod'] = np.where(is_valid, spectrum[:, freqs_range][rows, peaks], np.nan)
+
+    # RMS energy envelope of the audio signal, computed from cumulative sums of squared samples
+    params = tee_params['RMSEnv']
+    win_size, hop_size = int(round(params['WinSize_sec'] * fs)), int(round(params['HopSize_sec'] * fs))
+    cumulated_energy = np.concatenate((np.zeros((n_files, 1)), np.cumsum(audio ** 2, axis=1)), axis=1)
+    frames_start = np.arange(0, max(n_samples - win_size, 0) + 1, hop_size)
+    frames_end = np.minimum(frames_start + win_size, n_samples)
+    frames_energy = (cumulated_energy[:, frames_end] - cumulated_energy[:, frames_start]) / win_size
+    descriptors.update(_stats(np.sqrt(np.maximum(frames_energy, 0.0)), 'RMSEnv'))
+    return descriptors
+
+
+def _frames(audio: np.ndarray, win_size: int, hop_size: int):
+    """ :returns: A (n_files, n_frames, win_size) view of the frames of a batch of audio signals (the last
+        incomplete frame is discarded, and signals shorter than a frame are zero-padded). """
+    if audio.shape[1] < win_size:
+        audio = np.pad(audio, ((0, 0), (0, win_size - audio.shape[1])))
+    return np.lib.stride_tricks.sliding_window_view(audio, win_size, axis=1)[:, ::hop_size, :]
+
+
+def _spectral_descriptors(distribution: np.ndarray, freqs: np.ndarray):
+    """
+    Computes the spectral descriptors of the frames of spectral distributions (e.g. power spectrums).
+
+    :param distribution: Non-negative spectral values, with shape (n_files, n_frames, n_bins).
+    :param freqs: Frequency of each bin (Hz).
+    :returns: A dict of time series (n_files, n_frames) for each descriptor (SpecVar: n_frames - 1)
+    """
+    eps = np.finfo(float).eps
+    frame_energy = distribution.sum(axis=2)
+    p = distribution / (frame_energy[:, :, np.newaxis] + eps)  # Normalized distribution (sums to 1)
+    descriptors = {'FrameErg': frame_energy}
+    # Statistical moments of the normalized distribution
+    centroid = (p * freqs).sum(axis=2)
+    deviation = freqs - centroid[:, :, np.newaxis]
+    spread = np.sqrt((p * deviation ** 2).sum(axis=2))
+    descriptors['SpecCent'], descriptors['SpecSpread'] = centroid, spread
+    descriptors['SpecSkew'] = (p * deviation ** 3).sum(axis=2) / (spread ** 3 + eps)
+    descriptors['SpecKurt'] = (p * deviation ** 4).sum(axis=2) / (spread ** 4 + eps)
+    # Slope of the linear regression of the normalized distribution vs. frequency
+    n_bins = len(freqs)
+    descriptors['SpecSlope'] = (n_bins * (p * freqs).sum(axis=2) - freqs.sum()) \
+        / (n_bins * (freqs ** 2).sum() - freqs.sum() ** 2)
+    # Decrease: average decrease of each bin vs. the first bin, weighted by 1/bin_index
+    bin_indices = np.arange(1, n_bins)
+    descriptors['SpecDecr'] = ((distribution[:, :, 1:] - distribution[:, :, 0:1]) / bin_indices).sum(axis=2) \
+        / (distribution[:, :, 1:].sum(axis=2) + eps)
+    rolloff_bins = np.argmax(np.cumsum(p, axis=2) >= _rolloff_threshold, axis=2)
+    descriptors['SpecRollOff'] = freqs[rolloff_bins]
+    # Spectral variation (flux): 1 - normalized correlation between successive frames
+    correlation = (distribution[:, 1:, :] * distribution[:, :-1, :]).sum(axis=2)
+    norms = np.sqrt((distribution ** 2).sum(axis=2))
+    descriptors['SpecVar'] = 1.0 - correlation / (norms[:, 1:] * norms[:, :-1] + eps)
+    # Flatness (geometric mean / arithmetic mean) and crest (max / arithmetic mean)
+    arithmetic_mean = distribution.mean(axis=2) + eps
+    descriptors['SpecFlat'] = np.exp(np.log(distribution + eps).mean(axis=2)) / arithmetic_mean
+    descriptors['SpecCrest'] = distribution.max(axis=2) / arithmetic_mean
+    return descriptors
+
+
+def stft_descriptors(audio: np.ndarray, fs: int):
+    """
+    Computes the spectral descriptors of the STFT representation (power spectrum) of a batch of sounds. All frames
+    of all sounds are transformed using a single FFT call, and descriptors are computed using array reductions.
+
+    :param audio: Mono audio samples, with shape (n_files, n_samples).
+    :returns: A dict of descriptor statistics (e.g. 'SpecCent_med'), each value being a vector of length n_files
+    """
+    audio = np.atleast_2d(audio)
+    win_size = int(round(stft_params['WinSize_sec'] * fs))
+    hop_size = int(round(stft_params['HopSize_sec'] * fs))
+    n_fft = max(stft_params['FFTSize'], int(2 ** np.ceil(np.log2(win_size))))
+    window = scipy.signal.get_window(stft_params['WinType'], win_size, fftbins=False)
+    # Amplitudes are normalized by the window's sum, such that a sine's peak has half its amplitude
+    spectrum = scipy.fft.rfft(_frames(audio, win_size, hop_size) * (window / window.sum()), n=n_fft, axis=2)
+    power = spectrum.real ** 2 + spectrum.imag ** 2
+    del spectrum
+    descriptors = dict()
+    for name, values in _spectral_descriptors(power, scipy.fft.rfftfreq(n_fft, 1.0 / fs)).items():
+        descriptors.update(_stats(values, name))
+    return descriptors
+
+
+def _estimate_f0(amplitudes: np.ndarray, bin_width: float, fs: int):
+    """ Estimates the f0 of spectrum frames (n_frames, n_bins): the f0 candidate with the largest harmonic sum
+    (amplitudes of the first harmonics, weighted by 1/harmonic_index) is selected for each frame. """
+    max_f0 = min(_f0_range[1], fs / 4.0)
+    n_candidates = int(np.ceil(np.log2(max_f0 / _f0_range[0]) * _f0_candidates_per_octave)) + 1
+    candidates = np.geomspace(_f0_range[0], max_f0, n_candidates)
+    scores = np.zeros((amplitudes.shape[0], n_candidates))
+    for h in range(1, _f0_n_scoring_harmonics + 1):
+        bins = np.round(h * candidates / bin_width).astype(int)
+        is_valid = bins < amplitudes.shape[1]
+        scores[:, is_valid] += amplitudes[:, bins[is_valid]] / h
+    return candidates[np.argmax(scores, axis=1)]
+
+
+def _pick_harmonic_peaks(amplitudes: np.ndarray, f0: np.ndarray, n_harmonics: int, bin_width: float):
+    """
+    Finds the spectral peak of each harmonic, for all frames at once: the largest bin around each multiple of f0,
+    refined by parabolic interpolation of the log-amplitudes.
+
+    :returns: freqs, peak_amplitudes, both with shape (n_frames, n_harmonics). Harmonics above the Nyquist
+        frequency have a zero amplitude.
+    """
+    n_frames, n_bins = amplitudes.shape
+    rows = np.arange(n_frames)[:, np.newaxis]
+    half_widths = np.maximum(np.round(_harmonic_search_width * f0 / bin_width).astype(int), 2)
+    offsets = np.arange(-half_widths.max(), half_widths.max() + 1)
+    log_amplitudes = np.log(amplitudes + np.finfo(float).eps)
+    freqs, peak_amplitudes = np.zeros((n_frames, n_harmonics)), np.zeros((n_frames, n_harmonics))
+    for h in range(1, n_harmonics + 1):
+        search_bins = np.round(h * f0 / bin_width).astype(int)[:, np.newaxis] + offsets[np.newaxis, :]
+        is_valid = (np.abs(offsets)[np.newaxis, :] <= half_widths[:, np.newaxis]) \
+            & (search_bins >= 1) & (search_bins < n_bins - 1)
+        search_bins = np.clip(search_bins, 1, n_bins - 2)
+        search_values = np.where(is_valid, log_amplitudes[rows, search_bins], -np.inf)
+        peak_bins = search_bins[rows[:, 0], np.argmax(search_values, axis=1)]
+        # Parabolic interpolation (vertex of the parabola through the peak bin and its 2 neighbours)
+        left, center, right = [log_amplitudes[rows[:, 0], peak_bins + k] for k in (-1, 0, 1)]
+        curvature = left - 2.0 * center + right
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = np.where(curvature < 0.0, 0.5 * (left - right) / curvature, 0.0)
+        freqs[:, h - 1] = (peak_bins + delta) * bin_width
+        peak_amplitude = np.exp(center - 0.25 * (left - right) * delta)
+        peak_amplitudes[:, h - 1] = np.where(is_valid.any(axis=1), peak_amplitude, 0.0)
+    return freqs, peak_amplitudes
+
+
+def _harmonic_frames_descriptors(frames: np.ndarray, window: np.ndarray, fs: int):
+    """ Computes the harmonic descriptors of windowed frames (n_frames, win_size), and the harmonic ratio of each
+    frame (ratio of the power of the frame that belongs to harmonics). """
+    n_fft = max(harmonic_params['FFTSize'], int(2 ** np.ceil(np.log2(len(window)))))
+    bin_width = fs / n_fft
+    # Sinusoids' amplitudes: the window's sum and the negative frequencies are compensated
+    amplitudes = 2.0 * np.abs(scipy.fft.rfft(frames * (window / window.sum()), n=n_fft, axis=1))
+    frames_power = ((frames * window) ** 2).sum(axis=1) / (window ** 2).sum()
+    f0 = _estimate_f0(amplitudes, bin_width, fs)
+    freqs, peak_amplitudes = _pick_harmonic_peaks(amplitudes, f0, harmonic_params['NHarms'], bin_width)
+    del amplitudes
+    harmonic_indices = np.arange(1, harmonic_params['NHarms'] + 1)
+    peak_energies = peak_amplitudes ** 2
+    eps = np.finfo(float).eps
+    # f0 is refined using the harmonic peaks: weighted least-squares fit of freqs = harmonic_index * f0
+    f0 = np.where(peak_energies.sum(axis=1) > 0.0,
+                  (harmonic_indices * freqs * peak_energies).sum(axis=1)
+                  / ((harmonic_indices ** 2) * peak_energies).sum(axis=1).clip(min=eps), f0)
+    descriptors = {'F0': f0, 'HarmErg': 0.5 * peak_energies.sum(axis=1)}
+    descriptors['NoiseErg'] = np.maximum(frames_power - descriptors['HarmErg'], 0.0)
+    harmonics_deviation = np.abs(freqs - harmonic_indices * f0[:, np.newaxis])
+    descriptors['InHarm'] = 2.0 / f0 * (harmonics_deviation * peak_energies).sum(axis=1) \
+        / (peak_energies.sum(axis=1) + eps)
+    # Deviation of the harmonics' amplitudes from the spectral envelope (mean of each harmonic and its neighbours)
+    neighbours_sum = np.convolve(np.ones(harmonic_params['NHarms']), np.ones(3), mode='same')
+    spectral_envelope = scipy.signal.convolve(peak_amplitudes, np.ones((1, 3)), mode='same') / neighbours_sum
+    descriptors['HarmDev'] = np.abs(peak_amplitudes - spectral_envelope).mean(axis=1)
+    descriptors['OddEvenRatio'] = peak_energies[:, 0::2].sum(axis=1) / (peak_energies[:, 1::2].sum(axis=1) + eps)
+    # Silent frames are not harmonic (their eps-floored harmonic energy would give an infinite ratio)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        harmonic_ratio = np.where(frames_power > eps, descriptors['HarmErg'] / frames_power, 0.0)
+    return descriptors, harmonic_ratio
+
+
+def harmonic_descriptors(audio: np.ndarray, fs: int):
+    """
+    Computes the descriptors of the Harmonic representation of a batch of sounds (high-resolution STFT, shared by
+    all descriptors). For each frame, f0 is estimated, then a peak is searched around each of the NHarms first
+    harmonics. All frames of all sounds are processed together (in chunks, to limit memory usage).
+
+    HarmErg is the power of the harmonic sinusoids, NoiseErg the remaining power of the frame. Frames whose
+    harmonic power ratio is lower than Threshold (e.g. silent or noisy frames) are not harmonic, and are
+    excluded from the statistics (NaN statistics if a sound has no harmonic frame).
+
+    :param audio: Mono audio samples, with shape (n_files, n_samples).
+    :returns: A dict of descriptor statistics (e.g. 'F0_med'), each value being a vector of length n_files
+    """
+    audio = np.atleast_2d(audio)
+    win_size = int(round(harmonic_params['WinSize_sec'] * fs))
+    hop_size = int(round(harmonic_params['HopSize_sec'] * fs))
+    window = scipy.signal.get_window(harmonic_params['WinType'], win_size, fftbins=False)
+    frames = _frames(audio, win_size, hop_size)
+    n_files, n_frames = frames.shape[0], frames.shape[1]
+    frames = frames.reshape(n_files * n_frames, win_size)
+    chunks_results = [_harmonic_frames_descriptors(frames[i:i + _harmonic_frames_chunk_size], window, fs)
+                      for i in range(0, frames.shape[0], _harmonic_frames_chunk_size)]
+    is_harmonic = np.concatenate([r[1] for r in chunks_results]) >= harmonic_params['Threshold']
+    descriptors = dict()
+    for name in chunks_results[0][0].keys():
+        values = np.where(is_harmonic, np.concatenate([r[0][name] for r in chunks_results]), np.nan)
+        descriptors.update(_stats(values.reshape(n_files, n_frames), name))
+    return descriptors
+
+
+# Batched computation functions of the representations
+_representations_functions = {'TEE': tee_descriptors, 'STFT': stft_descriptors, 'Harmonic': harmonic_descriptors}
+
+
+def get_supported_descriptors(descriptors: Optional[Sequence[str]] = None):
+    """ :returns: The given descriptors that can be computed by this module (all supported descriptors if None) """
+    if descriptors is None:
+        return list(supported_descriptors)
+    return [d for d in descriptors if d in supported_descriptors]
+
+
+def compute_descriptors(audio: Sequence[np.ndarray], fs: int, descriptors: Optional[Sequence[str]] = None,
+                        max_batch_size=16) -> List[Dict[str, float]]:
+    """
+    Computes TimbreToolbox descriptors of mono audio arrays. Arrays of equal length are stacked and processed as
+    batches (of at most max_batch_size arrays).
+
+    :param descriptors: The descriptors to be computed (e.g. ['Att', 'RMSEnv']), all supported descriptors if None.
+    :returns: A list of dicts of descriptor values (one dict per audio array), e.g. {'Att': ..., 'RMSEnv_med': ...}
+    """
+    descriptors = get_supported_descriptors(descriptors)
+    representations = [r for r, r_descriptors in representations_descriptors.items()
+                       if any([d in descriptors for d in r_descriptors])]
+    all_descriptors = [dict() for _ in audio]
+    lengths = np.asarray([len(a) for a in audio], dtype=int)
+    for length in np.unique(lengths):
+        same_length_indices = np.flatnonzero(lengths == length)
+        for i in range(0, len(same_length_indices), max_batch_size):
+            batch_indices = same_length_indices[i:i + max_batch_size]
+            batch = np.stack([np.asarray(audio[j], dtype=float) for j in batch_indices])
+            for representation in representations:
+                values = _representations_functions[representation](batch, fs)
+                for name, batch_values in values.items():
+                    if timbretoolboxstats.get_descriptor_name(name) in descriptors:
+                        for j, v in zip(batch_indices, batch_values.tolist()):
+                            all_descriptors[j][name] = v
+    return all_descriptors
+
+
+def compute_files_descriptors(audio_files: Sequence[Union[str, pathlib.Path]],
+                              descriptors: Optional[Sequence[str]] = None, max_batch_size=16):
+    """ Computes TimbreToolbox descriptors of audio files (see compute_descriptors). Files are grouped by sampling
+    rate and length (read from their headers), then loaded batch by batch to bound memory usage. """
+    files_info = [sf.info(str(a)) for a in audio_files]
+    all_descriptors = [dict() for _ in audio_files]
+    for fs, n_frames in sorted(set([(info.samplerate, info.frames) for info in files_info])):
+        same_shape_indices = [i for i, info in enumerate(files_info)
+                              if info.samplerate == fs and info.frames == n_frames]
+        for batch_start in range(0, len(same_shape_indices), max_batch_size):
+            indices = same_shape_indices[batch_start:batch_start + max_batch_size]
+            batch_descriptors = compute_descriptors([load_audio(audio_files[i])[0] for i in indices], fs, descriptors,
+                                                 max_batch_size=max_batch_size)
+            for i, d in zip(indices, batch_descriptors):
+                all_descriptors[i] = d
+    return all_descriptors
+
@@ -41,3 +41,43 @@ log_scale_dynamic_eps = {
     'AmpMod': 0.00047665,
     'RMSEnv_med': 0.0004319, 'RMSEnv_IQR': 0.00029309000000000003
 }
+
+# Descriptors computed by each TimbreToolbox representation. Spectral descriptors are computed by several
+#     representations (the CSV reader keeps the value from the last representation that provides a descriptor)
+_spectral_descriptors = ['FrameErg', 'SpecCent', 'SpecCrest', 'SpecDecr', 'SpecFlat', 'SpecKurt', 'SpecRollOff',
+                         'SpecSkew', 'SpecSlope', 'SpecSpread', 'SpecVar']
+representations_descriptors = {
+    'TEE': ['Att', 'Dec', 'Rel', 'LAT', 'AttSlope', 'DecSlope', 'TempCent', 'EffDur', 'FreqMod', 'AmpMod', 'RMSEnv'],
+    'STFT': _spectral_descriptors,
+    'ERB': _spectral_descriptors,
+    'Harmonic': _spectral_descriptors + ['F0', 'HarmDev', 'HarmErg', 'InHarm', 'NoiseErg', 'Noisiness',
+                                         'OddEvenRatio', 'TriStim1', 'TriStim2', 'TriStim3'],
+}
+
+# Descriptors that can't be evaluated without other descriptors (whose parameters must be given)
+descriptors_dependencies = {
+    'Dec': ['Att'], 'Rel': ['Att'], 'LAT': ['Att'], 'AttSlope': ['Att'], 'DecSlope': ['Att'],
+    'FreqMod': ['Att', 'Dec', 'Rel'],
+    'AmpMod': ['Att', 'Dec', 'Rel', 'FreqMod'],  # FreqMod's parameters are shared with AmpMod
+}
+
+
+def get_descriptor_name(feature_name: str):
+    """ Returns the TimbreToolbox descriptor name of a feature, e.g. 'SpecCent' for 'tt_SpecCent_med'. """
+    descriptor_name = feature_name.replace('tt_', '', 1)
+    for suffix in ('_min', '_max', '_med', '_IQR'):
+        if descriptor_name.endswith(suffix):
+            return descriptor_name[:-len(suffix)]
+    return descriptor_name
+
+
+def get_descriptor_representation(descriptor_name: str):
+    """
+    Returns the representation whose value of a descriptor is read from CSV files, i.e. the last representation
+    which provides it (e.g. 'Harmonic' for 'SpecCent'), or None if the descriptor is unknown.
+    """
+    descriptor_representation = None
+    for representation, descriptors in representations_descriptors.items():
+        if descriptor_name in descriptors:
+            descriptor_representation = representation
+    return descriptor_representation
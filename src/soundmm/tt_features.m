@@ -1,9 +1,42 @@
-function rc = tt_features(directories_list_file)
+function rc = tt_features(directories_list_file, options_file)
+    % directories_list_file: text file, which contains the directories to be analyzed (one directory per line).
+    %     If options.inputMode is 'files', this file contains audio files instead (one file per line). Results
+    %     are written into the directory of each audio file, or into options.outputDirectory if provided.
     disp(strcat('Script starts: ', datestr(now, 'yy/mm/dd-HH:MM:SS')));
 
     disp('Input args file: ')
     disp(directories_list_file)
 
+    % Options are provided as an optional JSON file (written by the Python package)
+    options = struct();
+    if nargin >= 2 && ~isempty(options_file)
+        disp('Options file: ')
+        disp(options_file)
+        options = jsondecode(fileread(options_file));
+    end
+    if ~isfield(options, 'outputMode')
+        options.outputMode = 'sound';  % 1 CSV file / audio file, written next to the audio file
+    end
+    % 'directory' output mode: 1 CSV file / directory, which contains a block of lines for each audio file.
+    %     Each block starts with a 'TimbreToolboxSound,<audio file name>' line, followed by the lines of the
+    %     CSV that was exported (for this audio file only) into a local scratch directory
+    consolidateOutput = strcmp(options.outputMode, 'directory');
+    if ~isfield(options, 'inputMode')
+        options.inputMode = 'directories';
+    end
+    inputFiles = strcmp(options.inputMode, 'files');
+    % Graceful stop: if options.stopFile exists, the script ends before analyzing the next audio file.
+    % Each file is acknowledged on stdout: 'tt_features: start <audio file name>' then 'tt_features: done <...>'
+    if ~isfield(options, 'stopFile')
+        options.stopFile = '';
+    end
+    stopRequested = false;
+    % Temporary CSV directories of the 'directory' output mode are created in options.scratchDirectory, which
+    % can be deleted by the caller if this script is killed
+    if ~isfield(options, 'scratchDirectory')
+        options.scratchDirectory = tempdir();
+    end
+
     % FIXME replace audio_root_path
     %sub_folders = readlines(directories_list_file)  % Matlab 2020...
     fid = fopen(directories_list_file);
@@ -16,66 +49,92 @@ function rc = tt_features(directories_list_file)
     fclose(fid);
 
 
+    if inputFiles
+        audio_files = sub_folders;
+        if isfield(options, 'outputDirectory')  % All files of the list are processed as a single group
+            sub_folders = {options.outputDirectory};
+            files_groups = {audio_files};
+        else  % Files are grouped by directory
+            files_directories = cellfun(@fileparts, audio_files, 'UniformOutput', false);
+            [sub_folders, ~, group_indices] = unique(files_directories, 'stable');
+            files_groups = arrayfun(@(g) audio_files(group_indices == g), 1:length(sub_folders), ...
+                                    'UniformOutput', false);
+        end
+    end
+
     % Process folders one by one
     for folder_index = 1 : length(sub_folders)
 
         soundsDirectory = sub_folders{folder_index};  % Get the contents of a cell
+        % Results are written into the directory of the sounds, or into the output directory for files lists
+        outputDirectory = soundsDirectory;
 
         % Parts of: https://github.com/VincentPerreault0/timbretoolbox/blob/master/doc/Full_Config_Example.m
         singleFileName = '';
-        csvDirectory = soundsDirectory;
+        if consolidateOutput
+            csvDirectory = tempname(options.scratchDirectory);  % Local scratch directory
+            mkdir(csvDirectory);
+            consolidatedFile = fullfile(outputDirectory, 'timbretoolbox_stats.csv');
+        else
+            csvDirectory = outputDirectory;
+        end
         matDirectory = '';  % soundsDirectory;
         pltDirectory = '';
 
         sndConfig = struct();
 
 
-        evalConfig = struct();
-
-        % OK if not audio signal descriptor?
-        evalConfig.AudioSignal.NoDescr = struct();
-
-        %
-        evalConfig.TEE = struct();
-        evalConfig.TEE.CutoffFreq = 5;
-
-        evalConfig.TEE.Att = struct();          % Specified to be evaluated/plotted
-        evalConfig.TEE.Att.Method = 3;          % params shared with Dec, Rel, LAT, AttSlope, DecSlope
-        evalConfig.TEE.Att.NoiseThresh = 0.15;  %                   (LAT = Log-Attack Time)
-        evalConfig.TEE.Att.DecrThresh = 0.4;
-        evalConfig.TEE.TempCent = struct();     % Specified to be evaluated/plotted
-        evalConfig.TEE.TempCent.Threshold = 0.15;
-        evalConfig.TEE.EffDur = struct();       % Specified to be evaluated/plotted
-        evalConfig.TEE.EffDur.Threshold = 0.4;
-        evalConfig.TEE.FreqMod = struct();      % Specified to be evaluated/plotted
-        evalConfig.TEE.FreqMod.Method = 'fft';  % shared with TEE.AmpMod; require Dec and Rel
-
-        evalConfig.TEE.RMSEnv = struct();       % Specified to be evaluated/plotted
-        evalConfig.TEE.RMSEnv.HopSize_sec = 0.0029;
-        evalConfig.TEE.RMSEnv.WinSize_sec = 0.0232;
-
-        evalConfig.STFT = struct();             % Specified to be evaluated/plotted
-        evalConfig.STFT.DistrType = 'pow';
-        evalConfig.STFT.HopSize_sec = 0.0058;
-        evalConfig.STFT.WinSize_sec = 0.0232;
-        evalConfig.STFT.WinType = 'hamming';
-        evalConfig.STFT.FFTSize = 1024;
-        % If no descriptors are specified in the evalConfig.STFT structure, all descriptors will be evaluated
-
-        evalConfig.ERB = struct();              % Specified to be evaluated/plotted
-        evalConfig.ERB.HopSize_sec = 0.0058;
-        evalConfig.ERB.Method = 'fft';
-        evalConfig.ERB.Exponent = 1/4;
-        % If no descriptors are specified in the evalConfig.ERB structure, all descriptors will be evaluated
-
-        evalConfig.Harmonic = struct();             % Specified to be evaluated/plotted
-        evalConfig.Harmonic.Threshold = 0.3;
-        evalConfig.Harmonic.NHarms = 20;
-        evalConfig.Harmonic.HopSize_sec = 0.025;
-        evalConfig.Harmonic.WinSize_sec = 0.1;
-        evalConfig.Harmonic.WinType = 'blackman';
-        evalConfig.Harmonic.FFTSize = 32768;
-        % If no descriptors are specified in the evalConfig.Harmonic structure, all descriptors will be evaluated
+        if isfield(options, 'evalConfig')
+            % Generated by the Python package (e.g. only a subset of representations and descriptors)
+            evalConfig = options.evalConfig;
+        else
+            evalConfig = struct();
+
+            % OK if not audio signal descriptor?
+            evalConfig.AudioSignal.NoDescr = struct();
+
+            %
+            evalConfig.TEE = struct();
+            evalConfig.TEE.CutoffFreq = 5;
+
+            evalConfig.TEE.Att = struct();          % Specified to be evaluated/plotted
+            evalConfig.TEE.Att.Method = 3;          % params shared with Dec, Rel, LAT, AttSlope, DecSlope
+            evalConfig.TEE.Att.NoiseThresh = 0.15;  %                   (LAT = Log-Attack Time)
+            evalConfig.TEE.Att.DecrThresh = 0.4;
+            evalConfig.TEE.TempCent = struct();     % Specified to be evaluated/plotted
+            evalConfig.TEE.TempCent.Threshold = 0.15;
+            evalConfig.TEE.EffDur = struct();       % Specified to be evaluated/plotted
+            evalConfig.TEE.EffDur.Threshold = 0.4;
+            evalConfig.TEE.FreqMod = struct();      % Specified to be evaluated/plotted
+            evalConfig.TEE.FreqMod.Method = 'fft';  % shared with TEE.AmpMod; require Dec and Rel
+
+            evalConfig.TEE.RMSEnv = struct();       % Specified to be evaluated/plotted
+            evalConfig.TEE.RMSEnv.HopSize_sec = 0.0029;
+            evalConfig.TEE.RMSEnv.WinSize_sec = 0.0232;
+
+            evalConfig.STFT = struct();             % Specified to be evaluated/plotted
+            evalConfig.STFT.DistrType = 'pow';
+            evalConfig.STFT.HopSize_sec = 0.0058;
+            evalConfig.STFT.WinSize_sec = 0.0232;
+            evalConfig.STFT.WinType = 'hamming';
+            evalConfig.STFT.FFTSize = 1024;
+            % If no descriptors are specified in the evalConfig.STFT structure, all descriptors will be evaluated
+
+            evalConfig.ERB = struct();              % Specified to be evaluated/plotted
+            evalConfig.ERB.HopSize_sec = 0.0058;
+            evalConfig.ERB.Method = 'fft';
+            evalConfig.ERB.Exponent = 1/4;
+            % If no descriptors are specified in the evalConfig.ERB structure, all descriptors will be evaluated
+
+            evalConfig.Harmonic = struct();             % Specified to be evaluated/plotted
+            evalConfig.Harmonic.Threshold = 0.3;
+            evalConfig.Harmonic.NHarms = 20;
+            evalConfig.Harmonic.HopSize_sec = 0.025;
+            evalConfig.Harmonic.WinSize_sec = 0.1;
+            evalConfig.Harmonic.WinType = 'blackman';
+            evalConfig.Harmonic.FFTSize = 32768;
+            % If no descriptors are specified in the evalConfig.Harmonic structure, all descriptors will be evaluated
+        end
 
         csvConfig = struct();
         csvConfig.Directory = csvDirectory;
@@ -95,16 +154,26 @@ function rc = tt_features(directories_list_file)
         if ~isdir(soundsDirectory)
             error('soundsDirectory must be a valid directory.');
         end
-        if ~isempty(singleFileName)
+        if inputFiles
+            filelist = cell2struct(files_groups{folder_index}(:)', 'name', 1);
+        elseif ~isempty(singleFileName)
             filelist.name = singleFileName;
         else
             filelist = dir(soundsDirectory);
         end
         acceptedFormats = {'wav', 'ogg', 'flac', 'au', 'aiff', 'aif', 'aifc', 'mp3', 'm4a', 'mp4'};
         for i = 1:length(filelist)
-            [~, fileName, fileExt] = fileparts(filelist(i).name);
+            [fileDirectory, fileName, fileExt] = fileparts(filelist(i).name);
+            if ~inputFiles
+                fileDirectory = soundsDirectory;
+            end
             if ~isempty(fileName) && fileName(1) ~= '.' && (any(strcmp(fileExt(2:end), acceptedFormats)) || (length(filelist) == 1 && strcmp(fileExt(2:end), 'raw')))
-                sound = SoundFile([soundsDirectory '/' fileName fileExt], sndConfig);
+                if ~isempty(options.stopFile) && exist(options.stopFile, 'file') == 2
+                    stopRequested = true;
+                    break;
+                end
+                fprintf('tt_features: start %s\n', [fileName fileExt]);
+                sound = SoundFile([fileDirectory '/' fileName fileExt], sndConfig);
                 % catch sound.Eval Error
                 sound_was_eval = false;
                 try
@@ -113,7 +182,7 @@ function rc = tt_features(directories_list_file)
                 % when timbre toolbox bugs with low-volume samples: general Error, nothing more specific....
                 % so we'll have to catch all Error
                 catch Error
-                    stats_file = strcat(soundsDirectory, '/', fileName, '_stats.csv')   % FIXME temp
+                    stats_file = strcat(csvDirectory, '/', fileName, '_stats.csv')   % FIXME temp
                     fid = fopen(stats_file, 'w');
                     warning("000000000000000000000 - sound.Eval has raised an Error - an empty .csv file will be written - 00000000000000000000000000000");
                     fprintf(fid, "Evaluation Error");
@@ -135,6 +204,16 @@ function rc = tt_features(directories_list_file)
                     end
                 end
                 clear 'sound';
+
+                if consolidateOutput  % Append the exported CSV to the directory's CSV
+                    stats_file = fullfile(csvDirectory, [fileName '_stats.csv']);
+                    fid = fopen(consolidatedFile, 'a');
+                    fprintf(fid, 'TimbreToolboxSound,%s\n', [fileName fileExt]);
+                    fprintf(fid, '%s\n', fileread(stats_file));
+                    fclose(fid);
+                    delete(stats_file);
+                end
+                fprintf('tt_features: done %s\n', [fileName fileExt]);
             end
 
             % to try to solve Exception in thread "AWT-EventQueue-0" java.lang.OutOfMemoryError: Java heap space
@@ -144,6 +223,14 @@ function rc = tt_features(directories_list_file)
             clc;
         end
 
+        if consolidateOutput
+            rmdir(csvDirectory, 's');
+        end
+
+        if stopRequested
+            disp('tt_features: stop file found, remaining audio files will not be analyzed');
+            break;
+        end
 
     end % subfolder-by-subfolder processing
 
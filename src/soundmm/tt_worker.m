@@ -0,0 +1,41 @@
+function rc = tt_worker(spool_directory)
+    % Long-lived TimbreToolbox worker: Matlab and the toolbox are initialized only once, then jobs are read
+    % from the spool directory until a 'stop' file is created in this directory.
+    % Each job is a '<job_name>.job' text file, which contains the path to a directories list file (the first
+    % argument of tt_features) and optionally, on a second line, the path to an options file.
+    % Completion is acknowledged on stdout: 'tt_worker: job <job_name> done' (or 'error').
+    disp(strcat('Worker starts: ', datestr(now, 'yy/mm/dd-HH:MM:SS')));
+    disp('Spool directory: ')
+    disp(spool_directory)
+
+    while true
+        if exist(fullfile(spool_directory, 'stop'), 'file') == 2
+            break;
+        end
+        jobs = dir(fullfile(spool_directory, '*.job'));
+        if isempty(jobs)
+            pause(0.05);
+            continue;
+        end
+        job_names = sort({jobs.name});
+        [~, job_name, ~] = fileparts(job_names{1});
+        % The job file is renamed, such that it won't be processed twice
+        running_file = fullfile(spool_directory, [job_name '.running']);
+        movefile(fullfile(spool_directory, job_names{1}), running_file);
+        job_args = strsplit(strtrim(fileread(running_file)), newline);
+
+        try
+            tt_features(job_args{:});
+            job_status = 'done';
+        catch Error
+            disp(getReport(Error));
+            job_status = 'error';
+        end
+        delete(running_file);
+        fprintf('tt_worker: job %s %s\n', job_name, job_status);
+    end
+
+    disp(strcat('Worker ends: ', datestr(now, 'yy/mm/dd-HH:MM:SS')));
+    disp('tt_worker.m   EXIT_SUCCESS');
+    rc = 0;
+end
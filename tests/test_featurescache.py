@@ -0,0 +1,66 @@
+import time
+
+from src.soundmm.featurescache import FeaturesCache, audio_content_hash
+
+
+def test_hit_and_miss(tmp_path):
+    with FeaturesCache(tmp_path / 'cache.db') as cache:
+        key = FeaturesCache.make_key('0123', 'extractor', '1.0', {'param': 1})
+        assert cache.get(key) is None
+        cache.put(key, {'a': 1.0, 'b': None})
+        assert cache.get(key) == {'a': 1.0, 'b': None}
+        assert cache.get_many([key, 'unknown']) == [{'a': 1.0, 'b': None}, None]
+    with FeaturesCache(tmp_path / 'cache.db') as cache:  # Persistent
+        assert len(cache) == 1 and cache.get(key) == {'a': 1.0, 'b': None}
+
+
+def test_key_depends_on_extractor_and_params():
+    key = FeaturesCache.make_key('0123', 'extractor', '1.0', {'param': 1, 'other': 2})
+    assert key == FeaturesCache.make_key('0123', 'extractor', '1.0', {'other': 2, 'param': 1})
+    assert key != FeaturesCache.make_key('0123', 'extractor', '1.1', {'param': 1, 'other': 2})
+    assert key != FeaturesCache.make_key('0123', 'extractor', '1.0', {'param': 0, 'other': 2})
+    assert key != FeaturesCache.make_key('4567', 'extractor', '1.0', {'param': 1, 'other': 2})
+
+
+def test_least_recently_used_eviction(tmp_path):
+    with FeaturesCache(tmp_path / 'cache.db', max_entries=2, last_access_resolution=0.0, eviction_period=1) as cache:
+        cache.put('a', {'v': 0.0})
+        time.sleep(0.01)
+        cache.put('b', {'v': 1.0})
+        time.sleep(0.01)
+        assert cache.get('a') is not None  # 'a' becomes the most recently used entry
+        time.sleep(0.01)
+        cache.put('c', {'v': 2.0})
+        assert len(cache) == 2
+        assert cache.get('b') is None
+        assert cache.get('a') == {'v': 0.0} and cache.get('c') == {'v': 2.0}
+
+
+
+def _last_accesses(cache: FeaturesCache):
+    return dict(cache._connection.execute("SELECT key, last_access FROM features").fetchall())
+
+
+def test_approximate_access_times_and_periodic_eviction(tmp_path):
+    with FeaturesCache(tmp_path / 'cache.db', max_entries=2, last_access_resolution=3600.0, eviction_period=3) as cache:
+        cache.put('a', {'v': 0.0})
+        last_accesses = _last_accesses(cache)
+        time.sleep(0.01)
+        assert cache.get('a') == {'v': 0.0}
+        assert _last_accesses(cache) == last_accesses  # Recently accessed: hits don't write
+        cache.put('b', {'v': 1.0})
+        time.sleep(0.01)
+        cache.put('c', {'v': 2.0})
+        assert len(cache) == 3  # Not checked yet
+        cache.put('d', {'v': 3.0})
+        assert len(cache) == 2 and cache.get('a') is None and cache.get('b') is None
+    with FeaturesCache(tmp_path / 'cache.db', max_entries=1, eviction_period=1000) as cache:
+        cache.put('e', {'v': 4.0})  # The first insert checks the size of the cache
+        assert len(cache) == 1 and cache.get('e') == {'v': 4.0}
+
+def test_audio_content_hash(tmp_path):
+    (tmp_path / 'a.wav').write_bytes(b'audio content')
+    (tmp_path / 'b.wav').write_bytes(b'audio content')
+    (tmp_path / 'c.wav').write_bytes(b'other content')
+    assert audio_content_hash(tmp_path / 'a.wav') == audio_content_hash(tmp_path / 'b.wav')
+    assert audio_content_hash(tmp_path / 'a.wav') != audio_content_hash(tmp_path / 'c.wav')
@@ -0,0 +1,79 @@
+import os
+import pathlib
+import shutil
+
+import pandas as pd
+
+from src.soundmm import metrics, timbretoolboxnumpy
+from src.soundmm.manifest import MorphingManifest
+
+
+data_dir = pathlib.Path(__file__).parent.parent.joinpath('examples/data/good_morphing')
+
+
+def _touch_later(audio_file: pathlib.Path):
+    """ Same content, new modification time """
+    stat = audio_file.stat()
+    os.utime(audio_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_manifest_reuse(tmp_path):
+    audio_files = [tmp_path / 'a.wav', tmp_path / 'b.wav']
+    for a in audio_files:
+        a.write_bytes(b'audio')
+    manifest = MorphingManifest(tmp_path, {'version': 1})
+    manifest.set(audio_files[0], 'ac', {'x': 1.0})
+    manifest.set(audio_files[1], 'ac', {'x': 2.0})
+    manifest.set(audio_files[1], 'tt', None)  # e.g. TimbreToolbox evaluation error
+    manifest.save(audio_files)
+
+    manifest = MorphingManifest(tmp_path, {'version': 1})
+    assert manifest.get(audio_files[0], 'ac') == {'x': 1.0}
+    assert manifest.get(audio_files[1], 'ac') == {'x': 2.0}
+    assert manifest.get(audio_files[0], 'tt') is None
+    _touch_later(audio_files[0])  # Modified files are outdated
+    assert manifest.get(audio_files[0], 'ac') is None and manifest.get(audio_files[1], 'ac') == {'x': 2.0}
+    # Other extraction parameters: nothing can be reused
+    assert MorphingManifest(tmp_path, {'version': 2}).get(audio_files[1], 'ac') is None
+
+
+def test_manifest_discards_deleted_files(tmp_path):
+    audio_files = [tmp_path / 'a.wav', tmp_path / 'b.wav']
+    for a in audio_files:
+        a.write_bytes(b'audio')
+    manifest = MorphingManifest(tmp_path, {})
+    for a in audio_files:
+        manifest.set(a, 'ac', {'x': 0.0})
+    manifest.save(audio_files[:1])
+    assert list(MorphingManifest(tmp_path, {}).files.keys()) == ['a.wav']
+
+
+def test_incremental_compute_metrics(tmp_path, monkeypatch):
+    morphing_dir = tmp_path / 'morphing'
+    morphing_dir.mkdir()
+    for audio_file in sorted(data_dir.glob('*.wav'))[:3]:
+        shutil.copy(audio_file, morphing_dir)
+    metrics_1, features_1 = metrics.compute_metrics([morphing_dir], incremental=True, tt_engine='numpy')
+    assert morphing_dir.joinpath(MorphingManifest.file_name).exists()
+
+    # Only the modified file must be analyzed again
+    analyzed_files = list()
+    extract_ac_features, compute_tt_descriptors = metrics._extract_ac_features, \
+        timbretoolboxnumpy.compute_files_descriptors
+
+    def _extract_ac_features(audio_file, *args, **kwargs):
+        analyzed_files.append(('ac', pathlib.Path(audio_file).name))
+        return extract_ac_features(audio_file, *args, **kwargs)
+
+    def _compute_tt_descriptors(audio_files, *args, **kwargs):
+        analyzed_files.extend([('tt', pathlib.Path(a).name) for a in audio_files])
+        return compute_tt_descriptors(audio_files, *args, **kwargs)
+
+    monkeypatch.setattr(metrics, '_extract_ac_features', _extract_ac_features)
+    monkeypatch.setattr(timbretoolboxnumpy, 'compute_files_descriptors', _compute_tt_descriptors)
+    modified_file = sorted(morphing_dir.glob('*.wav'))[1]
+    _touch_later(modified_file)
+    metrics_2, features_2 = metrics.compute_metrics([morphing_dir], incremental=True, tt_engine='numpy')
+    assert sorted(analyzed_files) == [('ac', modified_file.name), ('tt', modified_file.name)]
+    pd.testing.assert_frame_equal(metrics_1, metrics_2)
+    pd.testing.assert_frame_equal(features_1, features_2)
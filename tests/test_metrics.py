@@ -0,0 +1,117 @@
+import contextlib
+import os
+import pathlib
+import shutil
+import tempfile
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.soundmm import metrics, timbrefeatures
+from src.soundmm.timbretoolbox import TimbreToolboxWorkerPool
+
+
+data_dir = pathlib.Path(__file__).parent.parent.joinpath('examples/data/good_morphing')
+
+
+@pytest.fixture
+def morphing_dir(tmp_path):
+    """ A short morphing sequence (the first audio files of the good_morphing example) """
+    morphing_dir = tmp_path / 'morphing'
+    morphing_dir.mkdir()
+    for audio_file in sorted(data_dir.glob('*.wav'))[:4]:
+        shutil.copy(audio_file, morphing_dir)
+    return morphing_dir
+
+
+def test_features_subset(morphing_dir):
+    features_subset = ['ac_*', 'tt_*', '__no_high_corr__']
+    _, timbre_features = metrics.compute_metrics([morphing_dir], features_subset=features_subset, tt_engine='numpy')
+    features_names = set(timbrefeatures.parse_timbre_features_arguments(features_subset))
+    feature_cols = [c for c in timbre_features.columns if c.startswith('ac_') or c.startswith('tt_')]
+    assert len(feature_cols) > 0 and set(feature_cols) <= features_names
+    for excluded_name in ['ac_sharpness', 'tt_SpecCent_med', 'tt_HarmErg_med', 'tt_SpecCent_min']:
+        assert excluded_name not in timbre_features.columns
+    assert 'tt_SpecCent_IQR' in timbre_features.columns
+
+
+@pytest.mark.parametrize('use_worker_pool', [False, True])
+@pytest.mark.parametrize('tt_output_mode', ['sound', 'directory'])
+def test_timed_out_file_is_an_evaluation_error(morphing_dir, tmp_path, monkeypatch, use_worker_pool, tt_output_mode):
+    fake_matlab = pathlib.Path(__file__).parent.joinpath('fake_matlab', 'matlab')
+    monkeypatch.setenv('PATH', str(fake_matlab.parent) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('FAKE_MATLAB_HANG', 'audio_step01.wav')
+    temp_dir = tmp_path / 'temp'  # Temporary files of Python and of the fake Matlab
+    temp_dir.mkdir()
+    monkeypatch.setenv('TMPDIR', str(temp_dir))
+    monkeypatch.setattr(tempfile, 'tempdir', str(temp_dir))
+    monkeypatch.setattr(metrics, '_extract_ac_features', lambda audio_file: dict())  # TimbreToolbox features only
+    with contextlib.ExitStack() as exit_stack:
+        tt_worker_pool = exit_stack.enter_context(TimbreToolboxWorkerPool(
+            '/nonexistent', verbose=False, matlab_executable=str(fake_matlab), monitoring_period=0.1)) \
+            if use_worker_pool else None
+        with pytest.warns(UserWarning, match='audio_step01.wav could not be analyzed'):
+            _, timbre_features = metrics.compute_metrics(
+                [morphing_dir], timbre_toolbox_path='/nonexistent', tt_worker_pool=tt_worker_pool,
+                tt_output_mode=tt_output_mode, features_subset=['tt_*'], tt_file_timeout=0.5)
+    assert len(timbre_features) == 4
+    # NaN features of the timed-out file were replaced by the median values
+    assert timbre_features['tt_Att'].iloc[1] == timbre_features['tt_Att'].iloc[[0, 2, 3]].median()
+    assert list(temp_dir.iterdir()) == []  # No scratch directory left by the killed Matlab
+    assert [f.name for f in morphing_dir.glob('*.csv')] == []
+
+
+def _reference_morphing_metrics(postproc_df, feature_cols):
+    """ Per-morphing and per-feature loop of the original compute_metrics """
+    all_morphing_metrics = list()
+    for morphing_index in sorted(postproc_df.morphing_index.unique()):
+        morphing_features = postproc_df[postproc_df.morphing_index == morphing_index]
+        step_h = 1.0 / (len(morphing_features) - 1.0)
+        for m in metrics.metrics_names:
+            all_morphing_metrics.append({'morphing_index': morphing_index, 'metric': m})
+        for feature_name in feature_cols:
+            feature_values = morphing_features[feature_name].values
+            smoothness = np.convolve(feature_values, [1.0, -2.0, 1.0], mode='valid') / (step_h ** 2)
+            all_morphing_metrics[-2][feature_name] = np.sqrt((smoothness ** 2).mean())
+            target_linear_values = np.linspace(feature_values[0], feature_values[-1], num=feature_values.shape[0]).T
+            all_morphing_metrics[-1][feature_name] = np.sqrt(((feature_values - target_linear_values) ** 2).mean())
+    return pd.DataFrame(all_morphing_metrics)
+
+
+def test_vectorized_metrics_of_sequences_of_different_lengths():
+    rng = np.random.default_rng(0)
+    lengths, feature_cols = {0: 5, 1: 3, 2: 9}, ['ac_a', 'tt_b_med', 'tt_c']
+    postproc_df = pd.DataFrame([{'morphing_index': i, 'morphing_name': f'm{i}', 'audio_index': j}
+                                for i, length in lengths.items() for j in range(length)])
+    postproc_df = postproc_df.iloc[rng.permutation(len(postproc_df))]  # Sequences are not contiguous
+    postproc_df = postproc_df.sort_values('audio_index', kind='stable').reset_index(drop=True)
+    for c in feature_cols:
+        postproc_df[c] = rng.normal(size=len(postproc_df))
+    timbre_features = types.SimpleNamespace(postproc_df=postproc_df, feature_cols=feature_cols)
+    morphing_metrics = metrics._compute_morphing_metrics(timbre_features)
+    expected_metrics = _reference_morphing_metrics(postproc_df, feature_cols)
+    assert list(morphing_metrics.morphing_index) == list(expected_metrics.morphing_index)
+    assert list(morphing_metrics.metric) == list(expected_metrics.metric)
+    np.testing.assert_allclose(morphing_metrics[feature_cols].values, expected_metrics[feature_cols].values,
+                               rtol=1e-12, atol=1e-12)
+
+
+def test_parallel_features_equal_serial_features(morphing_dir):
+    metrics_1, features_1 = metrics.compute_metrics([morphing_dir], n_jobs=1, tt_engine='numpy')
+    metrics_2, features_2 = metrics.compute_metrics([morphing_dir], n_jobs=2, tt_engine='numpy')
+    pd.testing.assert_frame_equal(metrics_1, metrics_2)
+    pd.testing.assert_frame_equal(features_1, features_2)
+
+
+def test_numpy_tt_features_are_not_normalized_with_matlab_stats():
+    raw_df = pd.DataFrame({'morphing_index': [0, 0, 0], 'ac_brightness': [50.0, 60.0, 70.0],
+                           'tt_Att': [0.01, 0.02, 0.03], 'tt_SpecCent_med': [500.0, 1000.0, 2000.0]})
+    matlab_features = timbrefeatures.TimbreFeatures(raw_df)
+    numpy_features = timbrefeatures.TimbreFeatures(raw_df, tt_engine='numpy')
+    pd.testing.assert_series_equal(numpy_features.postproc_df['ac_brightness'],
+                                   matlab_features.postproc_df['ac_brightness'])
+    assert list(numpy_features.postproc_df['tt_Att']) == [0.01, 0.02, 0.03]
+    assert np.allclose(numpy_features.postproc_df['tt_SpecCent_med'], np.log(1.0 + raw_df['tt_SpecCent_med']))
+    assert not np.allclose(matlab_features.postproc_df['tt_Att'], raw_df['tt_Att'])
@@ -0,0 +1,311 @@
+import numpy as np
+import pytest
+
+from src.soundmm.timbral_models import timbral_util
+
+
+fs = 44100
+
+
+def _test_signals(n_signals=4, n_samples=8192):
+    """ Noise, decaying tones and silence """
+    rng = np.random.default_rng(0)
+    t = np.arange(n_samples) / fs
+    signals = [0.1 * rng.normal(size=n_samples)]
+    for i in range(1, n_signals - 1):
+        signals.append(np.sin(2.0 * np.pi * 110.0 * i * t) * np.exp(-t / (0.01 * i)))
+    signals.append(np.zeros(n_samples))
+    return np.stack(signals)
+
+
+def _reference_sample_and_hold(audio_samples, fs, decay_time=0.2, hold_time=0.01):
+    """ Per-sample implementation of sample_and_hold_envelope_calculation (timbral_models 0.4) """
+    abs_samples = abs(audio_samples)
+    envelope = []
+    decay = max(abs_samples) / (decay_time * fs)
+    hold_samples = hold_time * fs
+    hold_counter = 0
+    previous_sample = 0.0
+    for sample in abs_samples:
+        if sample >= previous_sample:
+            envelope.append(sample)
+            previous_sample = sample
+            hold_counter = 0
+        else:
+            if hold_counter < hold_samples:
+                hold_counter += 1
+                envelope.append(previous_sample)
+            else:
+                out = previous_sample - decay
+                if out > sample:
+                    envelope.append(out)
+                    previous_sample = out
+                else:
+                    envelope.append(sample)
+                    previous_sample = sample
+    return np.array(envelope)
+
+
+def _reference_specific_loudness_from_levels(P, Mod=0):
+    """ Scalar implementation of specific_loudness_from_levels, for a single frame (timbral_models 0.4) """
+    # set defaults for perceptual filters
+
+    # Centre frequencies of 1 / 3 Oct bands(FR)
+    FR = np.array([25, 31.5, 40, 50, 63, 80, 100, 125, 160, 200, 250, 315, 400, 500, 630, 800, 1000, 1250, 1600,
+                   2000, 2500, 3150, 4000, 5000, 6300, 8000, 10000, 12500])
+
+    # Ranges of 1 / 3 Oct bands for correction at low frequencies according to equal loudness contours
+    RAP = np.array([45, 55, 65, 71, 80, 90, 100, 120])
+
+    # Reduction of 1/3 Oct Band levels at low frequencies according to equal loudness contours
+    # within the eight ranges defined by RAP(DLL)
+    DLL = np.array([[-32, -24, -16, -10, -5, 0, -7, -3, 0, -2, 0],
+                    [-29, -22, -15, -10, -4, 0, -7, -2, 0, -2, 0],
+                    [-27, -19, -14, -9,  -4, 0, -6, -2, 0, -2, 0],
+                    [-25, -17, -12, -9,  -3, 0, -5, -2, 0, -2, 0],
+                    [-23, -16, -11, -7,  -3, 0, -4, -1, 0, -1, 0],
+                    [-20, -14, -10, -6,  -3, 0, -4, -1, 0, -1, 0],
+                    [-18, -12, -9,  -6,  -2, 0, -3, -1, 0, -1, 0],
+                    [-15, -10, -8,  -4,  -2, 0, -3, -1, 0, -1, 0]])
+
+    # Critical band level at absolute threshold without taking into account the
+    # transmission characteristics of the ear
+    LTQ = np.array([30, 18, 12, 8, 7, 6, 5, 4, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3])  # Threshold due to internal noise
+    # Hearing thresholds for the excitation levels (each number corresponds to a critical band 12.5kHz is not included)
+
+    # Attenuation representing transmission between freefield and our hearing system
+    A0 = np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, -0.5, -1.6, -3.2, -5.4, -5.6, -4, -1.5, 2, 5, 12])
+    # Attenuation due to transmission in the middle ear
+    # Moore et al disagrees with this being flat for low frequencies
+
+    # Level correction to convert from a free field to a diffuse field(last critical band 12.5 kHz is not included)
+    DDF = np.array([0, 0, 0.5, 0.9, 1.2, 1.6, 2.3, 2.8, 3, 2, 0, -1.4, -2, -1.9, -1, 0.5, 3, 4, 4.3, 4])
+
+    # Correction factor because using third octave band levels(rather than critical bands)
+    DCB = np.array([-0.25, -0.6, -0.8, -0.8, -0.5, 0, 0.5, 1.1, 1.5, 1.7, 1.8, 1.8, 1.7, 1.6, 1.4, 1.2, 0.8,
+                    0.5, 0, -0.5])
+
+    # Upper limits of the approximated critical bands
+    ZUP = np.array([0.9, 1.8, 2.8, 3.5, 4.4, 5.4, 6.6, 7.9, 9.2, 10.6, 12.3, 13.8, 15.2, 16.7, 18.1, 19.3, 20.6, 21.8,
+                    22.7, 23.6, 24])
+
+    # Range of specific loudness for the determination of the steepness of the upper slopes in the specific loudness
+    # - critical band rate pattern(used to plot the correct USL curve)
+    RNS = np.array([21.5, 18, 15.1, 11.5, 9, 6.1, 4.4, 3.1, 2.13, 1.36, 0.82, 0.42, 0.30, 0.22, 0.15, 0.10, 0.035, 0])
+
+    # This is used to design the right hand slope of the loudness
+    USL = np.array([[13.0, 8.2,  6.3,  5.5,  5.5,  5.5,  5.5,  5.5],
+                    [9.0,  7.5,  6.0,  5.1,  4.5,  4.5,  4.5,  4.5],
+                    [7.8,  6.7,  5.6,  4.9,  4.4,  3.9,  3.9,  3.9],
+                    [6.2,  5.4,  4.6,  4.0,  3.5,  3.2,  3.2,  3.2],
+                    [4.5,  3.8,  3.6,  3.2,  2.9,  2.7,  2.7,  2.7],
+                    [3.7,  3.0,  2.8,  2.35, 2.2,  2.2,  2.2,  2.2],
+                    [2.9,  2.3,  2.1,  1.9,  1.8,  1.7,  1.7,  1.7],
+                    [2.4,  1.7,  1.5,  1.35, 1.3,  1.3,  1.3,  1.3],
+                    [1.95, 1.45, 1.3,  1.15, 1.1,  1.1,  1.1,  1.1],
+                    [1.5,  1.2,  0.94, 0.86, 0.82, 0.82, 0.82, 0.82],
+                    [0.72, 0.67, 0.64, 0.63, 0.62, 0.62, 0.62, 0.62],
+                    [0.59, 0.53, 0.51, 0.50, 0.42, 0.42, 0.42, 0.42],
+                    [0.40, 0.33, 0.26, 0.24, 0.24, 0.22, 0.22, 0.22],
+                    [0.27, 0.21, 0.20, 0.18, 0.17, 0.17, 0.17, 0.17],
+                    [0.16, 0.15, 0.14, 0.12, 0.11, 0.11, 0.11, 0.11],
+                    [0.12, 0.11, 0.10, 0.08, 0.08, 0.08, 0.08, 0.08],
+                    [0.09, 0.08, 0.07, 0.06, 0.06, 0.06, 0.06, 0.05],
+                    [0.06, 0.05, 0.03, 0.02, 0.02, 0.02, 0.02, 0.02]])
+
+    # apply weighting factors
+    Xp = np.zeros(11)
+    Ti = np.zeros(11)
+    for i in range(11):
+        j = 0
+        while (P[i] > (RAP[j] - DLL[j, i])) & (j < 7):
+            j += 1
+        Xp[i] = P[i] + DLL[j, i]
+        Ti[i] = 10.0 ** (Xp[i] / 10.0)
+
+    # Intensity values in first three critical bands calculated
+    Gi = np.zeros(3)
+    Gi[0] = np.sum(Ti[0:6]) # Gi(1) is the first critical band (sum of two octaves(25Hz to 80Hz))
+    Gi[1] = np.sum(Ti[6:9]) # Gi(2) is the second critical band (sum of octave(100Hz to 160Hz))
+    Gi[2] = np.sum(Ti[9:11]) # Gi(3) is the third critical band (sum of two third octave bands(200Hz to 250Hz))
+
+    if np.max(Gi) > 0.0:
+        FNGi = 10 * np.log10(Gi)
+    else:
+        FNGi = -1.0 * np.inf
+    LCB = np.zeros_like(Gi)
+    for i in range(3):
+        if Gi[i] > 0:
+            LCB[i] = FNGi[i]
+        else:
+            LCB[i] = 0
+
+    # Calculate the main loudness in each critical band
+    Le = np.ones(20)
+    Lk = np.ones_like(Le)
+    Nm = np.ones(21)
+    for i in range(20):
+        Le[i] = P[i+8]
+        if i <= 2:
+            Le[i] = LCB[i]
+        Lk[i] = Le[i] - A0[i]
+        Nm[i] = 0
+        if Mod == 1:
+            Le[i] = Le[i] + DDF[i]
+        if Le[i] > LTQ[i]:
+            Le[i] = Lk[i] - DCB[i]
+            S = 0.25
+            MP1 = 0.0635 * 10.0 ** (0.025 * LTQ[i])
+            MP2 = (1 - S + S * 10 ** (0.1 * (Le[i] - LTQ[i]))) ** 0.25 - 1
+            Nm[i] = MP1 * MP2
+            if Nm[i] <= 0:
+                Nm[i] = 0
+    Nm[20] = 0
+
+    KORRY = 0.4 + 0.32 * Nm[0] ** 0.2
+    if KORRY > 1:
+        KORRY = 1
+
+    Nm[0] = Nm[0] * KORRY
+
+    # Add masking curves to the main loudness in each third octave band
+    N = 0
+    z1 = 0  # critical band rate starts at 0
+    n1 = 0  # loudness level starts at 0
+    j = 17
+    iz = 0
+    z = 0.1
+    ns = []
+
+    for i in range(21):
+        # Determines where to start on the slope
+        ig = i-1
+        if ig > 7:
+            ig = 7
+        control = 1
+        while (z1 < ZUP[i]) | (control == 1):  # ZUP is the upper limit of the approximated critical band
+            # Determines which of the slopes to use
+            if n1 < Nm[i]: # Nm is the main loudness level
+                j = 0
+                while RNS[j] > Nm[i]:  # the value of j is used below to build a slope
+                    j += 1  # j becomes the index at which Nm(i) is first greater than RNS
+
+            # The flat portions of the loudness graph
+            if n1 <= Nm[i]:
+                z2 = ZUP[i]  # z2 becomes the upper limit of the critical band
+                n2 = Nm[i]
+                N = N + n2 * (z2 - z1) # Sums the output(N_entire)
+                for k in np.arange(z, z2+0.01, 0.1):
+                    if not ns:
+                        ns.append(n2)
+                    else:
+                        if iz == len(ns):
+                            ns.append(n2)
+                        elif iz < len(ns):
+                            ns[iz] = n2
+
+                    if k < (z2 - 0.05):
+                        iz += 1
+                z = k # z becomes the last value of k
+                z = round(z * 10) * 0.1
+
+            # The sloped portions of the loudness graph
+            if n1 > Nm[i]:
+                n2 = RNS[j]
+                if n2 < Nm[i]:
+                    n2 = Nm[i]
+                dz = (n1 - n2) / USL[j, ig]  # USL = slopes
+                dz = round(dz * 10) * 0.1
+                if dz == 0:
+                    dz = 0.1
+                z2 = z1 + dz
+                if z2 > ZUP[i]:
+                    z2 = ZUP[i]
+                    dz = z2 - z1
+                    n2 = n1 - dz * USL[j, ig]  # USL = slopes
+                N = N + dz * (n1 + n2) / 2.0  # Sums the output(N_entire)
+                for k in np.arange(z, z2+0.01, 0.1):
+                    if not ns:
+                        ns.append(n1 - (k - z1) * USL[j, ig])
+                    else:
+                        if iz == len(ns):
+                            ns.append(n1 - (k - z1) * USL[j, ig])
+                        elif iz < len(ns):
+                            ns[iz] = n1 - (k - z1) * USL[j, ig]
+                    if k < (z2 - 0.05):
+                        iz += 1
+                z = k
+                z = round(z * 10) * 0.1
+            if n2 == RNS[j]:
+                j += 1
+            if j > 17:
+                j = 17
+            n1 = n2
+            z1 = z2
+            z1 = round(z1 * 10) * 0.1
+            control += 1
+
+    if N < 0:
+        N = 0
+
+    if N <= 16:
+        N = np.floor(N * 1000 + 0.5) / 1000.0
+    else:
+        N = np.floor(N * 100 + .05) / 100.0
+
+    LN = 40.0 * (N + 0.0005) ** 0.35
+
+    if LN < 3:
+        LN = 3
+
+    if N >= 1:
+        LN = 10 * np.log10(N) / np.log10(2) + 40
+
+    N_single = np.zeros(240)
+    for i in range(240):
+        N_single[i] = ns[i]
+
+    N_entire = N
+    return N_entire, N_single
+
+
+def test_specific_loudness_batch():
+    windows = _test_signals()
+    _, P, _ = timbral_util.filter_third_octaves_downsample_batch(windows, 100.0, fs, 25, 12500, 4)
+    rng = np.random.default_rng(0)
+    P_random = rng.uniform(-10.0, 110.0, size=(20, P.shape[1]))  # Covers all masking slopes
+    for Mod in [0, 1]:
+        N_entire, N_single = timbral_util.specific_loudness_batch(windows, fs=fs, Mod=Mod)
+        assert N_entire.shape == (windows.shape[0], ) and N_single.shape == (windows.shape[0], 240)
+        assert N_entire[-1] == 0.0  # Silence
+        random_N_entire, random_N_single = timbral_util.specific_loudness_from_levels(P_random, Mod=Mod)
+        for levels, window_N_entire, window_N_single in zip(np.concatenate([P, P_random]),
+                                                            np.concatenate([N_entire, random_N_entire]),
+                                                            np.concatenate([N_single, random_N_single])):
+            reference_N_entire, reference_N_single = _reference_specific_loudness_from_levels(levels, Mod)
+            assert window_N_entire == pytest.approx(reference_N_entire, rel=1e-12)
+            np.testing.assert_allclose(window_N_single, reference_N_single, rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize('use_numba', [False, True])
+@pytest.mark.parametrize('decay_time, hold_time', [(0.2, 0.01), (0.1, 0.01), (0.001, 0.0015), (0.1, 0.0)])
+def test_sample_and_hold_envelope_batch(use_numba, decay_time, hold_time):
+    if use_numba and timbral_util.numba is None:
+        pytest.skip("numba is not installed")
+    signals = _test_signals()
+    envelopes = timbral_util.sample_and_hold_envelope_batch(signals, fs, decay_time=decay_time, hold_time=hold_time,
+                                                            use_numba=use_numba)
+    for signal, envelope in zip(signals, envelopes):
+        np.testing.assert_array_equal(envelope, _reference_sample_and_hold(signal, fs, decay_time, hold_time))
+        np.testing.assert_array_equal(envelope, timbral_util.sample_and_hold_envelope_calculation(
+            signal, fs, decay_time=decay_time, hold_time=hold_time))
+
+
+def test_filter_design_registry():
+    timbral_util.clear_filter_design_cache()
+    b, a = timbral_util.butter_highpass(100.0, fs)
+    assert timbral_util.butter_highpass(100.0, fs=fs, order=2)[0] is b
+    cache_info = timbral_util.filter_design_cache_info()
+    assert (cache_info.hits, cache_info.misses) == (1, 1)
+    with pytest.raises(ValueError):
+        b[0] = 0.0  # Shared coefficients are read-only
@@ -0,0 +1,214 @@
+import json
+import os
+import pathlib
+import time
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+from src.soundmm import timbretoolbox
+from src.soundmm.timbretoolbox import TimbreToolboxResults, TimbreToolboxSingleDir, TimbreToolboxWorkerPool, \
+    make_eval_config, write_options_file
+
+
+def _stats_lines(representations):
+    """ Lines of a TimbreToolbox stats CSV file, e.g. representations = {'STFT': {'SpecCent': 1.0}} """
+    lines = list()
+    for representation, descriptors in representations.items():
+        lines += ['Representation,' + representation, 'Unit,', '']
+        for descriptor, value in descriptors.items():
+            lines += ['Descriptor,' + descriptor, 'Unit,Hz', 'Minimum,{}'.format(value - 1.0),
+                      'Maximum,{}'.format(value + 1.0), 'Median,{}'.format(value), 'Interquartile Range,0.5', '']
+    return lines
+
+
+def test_bulk_parse_of_files_with_different_descriptors_orders():
+    all_lines = [_stats_lines({'TEE': {'RMSEnv': 1.0}, 'Harmonic': {'SpecCent': 10.0, 'SpecKurt': 20.0,
+                                                                     'SpecFlat': 30.0, 'SpecCrest': 40.0}}),
+                 _stats_lines({'TEE': {'RMSEnv': 2.0}, 'Harmonic': {'SpecKurt': 21.0, 'SpecFlat': 31.0,
+                                                                     'SpecCrest': 41.0, 'SpecCent': 11.0}}),
+                 ['Evaluation Error']]
+    csv_files = ['a_stats.csv', 'b_stats.csv', 'c_stats.csv']
+    values, descr_names, evaluation_errors = TimbreToolboxResults._parse_stats_lines_bulk(all_lines, csv_files)
+    assert list(evaluation_errors) == [False, False, True]
+    assert np.all(np.isnan(values[2, :]))
+    for row, lines in enumerate(all_lines[:2]):
+        expected = TimbreToolboxResults._parse_stats_lines(lines, csv_files[row])
+        assert {n: values[row, col] for col, n in enumerate(descr_names)} == expected
+    assert values[1, descr_names.index('SpecKurt_med')] == 21.0
+
+
+def test_eval_config_evaluates_descriptors_in_the_representation_that_is_read():
+    eval_config = make_eval_config(['SpecCent', 'F0', 'Dec'])
+    assert set(eval_config.keys()) == {'AudioSignal', 'TEE', 'Harmonic'}  # STFT and ERB are not evaluated
+    assert 'SpecCent' in eval_config['Harmonic'] and 'F0' in eval_config['Harmonic']
+    assert 'Att' in eval_config['TEE'] and 'Dec' in eval_config['TEE']  # Dependencies
+
+
+
+def test_read_consolidated_stats_csv(tmp_path):
+    old_lines = _stats_lines({'TEE': {'RMSEnv': 0.0}})
+    a_lines, b_lines = _stats_lines({'TEE': {'RMSEnv': 1.0}}), _stats_lines({'TEE': {'RMSEnv': 2.0}})
+    blocks = [('a.wav', old_lines), ('b.wav', b_lines), ('c.wav', ['Evaluation Error']),
+              ('a.wav', a_lines)]  # A file analyzed again: the last block is read
+    consolidated_file = tmp_path / TimbreToolboxResults.consolidated_file_name
+    consolidated_file.write_text(''.join(['{}{}\n{}\n\n\n'.format(
+        TimbreToolboxResults.consolidated_block_marker, name, '\n'.join(lines)) for name, lines in blocks]))
+    parsed_blocks = TimbreToolboxResults.read_consolidated_stats_csv(consolidated_file)
+    assert parsed_blocks == {'a.wav': a_lines[:-1], 'b.wav': b_lines[:-1], 'c.wav': ['Evaluation Error']}
+
+    audio_files = [[tmp_path / 'b.wav', tmp_path / 'a.wav', tmp_path / 'c.wav']]
+    with pytest.warns(UserWarning, match='Evaluation Error'):
+        results = TimbreToolboxResults([tmp_path], audio_files).read()
+    assert results[0][0]['RMSEnv_med'] == 2.0 and results[0][1]['RMSEnv_med'] == 1.0 and results[0][2] is None
+    with pytest.warns(UserWarning, match='Evaluation Error'):
+        values, descr_names, evaluation_errors = TimbreToolboxResults([tmp_path], audio_files).read_matrix()
+    assert list(evaluation_errors) == [False, False, True]
+    assert list(values[:2, descr_names.index('RMSEnv_med')]) == [2.0, 1.0]
+    with pytest.raises(ValueError, match='does not contain results for d.wav'):
+        TimbreToolboxResults([tmp_path], [[tmp_path / 'd.wav']]).read()
+
+
+def test_options_file(tmp_path):
+    options_file = tmp_path / 'options.json'
+    write_options_file(options_file)
+    assert json.loads(options_file.read_text()) == {'outputMode': 'sound', 'inputMode': 'directories'}
+    eval_config = make_eval_config(['SpecCent', 'Att'])
+    write_options_file(options_file, output_mode='directory', eval_config=eval_config, input_mode='files',
+                       output_directory=tmp_path / 'out', stop_file=tmp_path / 'stop', scratch_directory=tmp_path)
+    assert json.loads(options_file.read_text()) == {
+        'outputMode': 'directory', 'inputMode': 'files', 'outputDirectory': str((tmp_path / 'out').resolve()),
+        'evalConfig': eval_config, 'stopFile': str((tmp_path / 'stop').resolve()),
+        'scratchDirectory': str(tmp_path.resolve())}
+    with pytest.raises(AssertionError):
+        write_options_file(options_file, output_directory=tmp_path / 'out')  # Lists of directories
+
+
+fake_matlab = pathlib.Path(__file__).parent.joinpath('fake_matlab', 'matlab')
+
+
+def _write_audio_files(directory: pathlib.Path, names, durations=None):
+    """ Writes silent .wav files (only their durations and sizes matter to the fake Matlab) """
+    directory.mkdir(exist_ok=True)
+    durations = durations if durations is not None else [0.1 for _ in names]
+    for name, duration in zip(names, durations):
+        sf.write(directory.joinpath(name), np.zeros(int(duration * 8000)), 8000)
+    return [directory.joinpath(name) for name in names]
+
+
+def _write_files_list(files_list_file: pathlib.Path, audio_files):
+    files_list_file.write_text(''.join([str(a) + '\n' for a in audio_files]))
+    return files_list_file
+
+
+def test_worker_pool(tmp_path, monkeypatch):
+    monkeypatch.setenv('FAKE_MATLAB_HANG', 'hang.wav')
+    audio_files = _write_audio_files(tmp_path / 'audio', ['a.wav', 'b.wav', 'hang.wav'])
+    options_file = tmp_path / 'options.json'
+    write_options_file(options_file, input_mode='files')
+    with TimbreToolboxWorkerPool('/nonexistent', verbose=False, matlab_executable=str(fake_matlab)) as pool:
+        worker = pool.workers[0]
+        # Done job
+        pool.run([_write_files_list(tmp_path / 'ab.txt', audio_files[:2])], options_file=options_file)
+        values, descr_names, evaluation_errors = \
+            TimbreToolboxResults([tmp_path / 'audio'], [audio_files[:2]]).read_matrix()
+        assert descr_names == ['Att', 'RMSEnv_min', 'RMSEnv_max', 'RMSEnv_med', 'RMSEnv_IQR']
+        assert not np.any(evaluation_errors) and not np.any(np.isnan(values))
+        # Error (the worker remains available)
+        with pytest.raises(RuntimeError):
+            pool.run([tmp_path / 'missing.txt'], options_file=options_file)
+        # Timeout: the worker is restarted
+        proc = worker.proc
+        with pytest.raises(TimeoutError):
+            pool.run([_write_files_list(tmp_path / 'hang.txt', audio_files[2:])], options_file=options_file,
+                     timeout=1.0)
+        assert proc.poll() is not None and worker.is_alive() and worker.proc is not proc
+        pool.run([_write_files_list(tmp_path / 'a.txt', audio_files[:1])], options_file=options_file, timeout=30.0)
+        proc, spool_directory = worker.proc, worker.spool_directory
+    # Clean stop
+    assert proc.returncode == 0 and not spool_directory.exists()
+
+
+@pytest.fixture
+def fake_matlab_path(monkeypatch):
+    """ TimbreToolboxProcess runs the 'matlab' command: the fake Matlab is found first in the PATH """
+    monkeypatch.setenv('PATH', str(fake_matlab.parent) + os.pathsep + os.environ['PATH'])
+
+
+def test_single_dir_chunks_by_duration(tmp_path, fake_matlab_path):
+    audio_files = _write_audio_files(tmp_path / 'audio', ['a.wav', 'b.wav', 'c.wav', 'd.wav', 'e.wav'],
+                                     [1.0, 0.25, 0.25, 0.25, 0.25])
+    tt_single_dir = TimbreToolboxSingleDir(tmp_path / 'audio', n_workers=1, units_per_worker=2, scratch_dir=tmp_path)
+    assert tt_single_dir.original_wav_files_split == [audio_files[:1], audio_files[1:]]
+    assert tt_single_dir.chunks_durations == [1.0, 1.0]
+    tt_single_dir.run()
+    assert tt_single_dir.workers_stats[0]['n_chunks'] == 2 and tt_single_dir.workers_stats[0]['n_files'] == 5
+    for a in audio_files:
+        with open(a.with_suffix('.json')) as f:
+            assert set(json.load(f).keys()) == {'Att', 'RMSEnv_min', 'RMSEnv_max', 'RMSEnv_med', 'RMSEnv_IQR'}
+    assert not tt_single_dir.scratch_dir.exists()
+
+
+def test_single_dir_resumes_after_recycling(tmp_path, fake_matlab_path, monkeypatch):
+    monkeypatch.setenv('FAKE_MATLAB_FILE_DELAY', '0.2')  # Stop files are created before the next file is analyzed
+    audio_files = _write_audio_files(tmp_path / 'audio', ['a.wav', 'b.wav', 'c.wav', 'd.wav'])
+    processed_files_by_instance = list()
+    run = timbretoolbox.TimbreToolboxProcess.run
+
+    def _run(tt_process):
+        run(tt_process)
+        processed_files_by_instance.append(tt_process.processed_files)
+
+    monkeypatch.setattr(timbretoolbox.TimbreToolboxProcess, 'run', _run)
+    tt_single_dir = TimbreToolboxSingleDir(tmp_path / 'audio', n_workers=1, units_per_worker=1, scratch_dir=tmp_path,
+                                           matlab_max_files=1)
+    tt_single_dir.run()
+    # Each Matlab instance continues from the next unprocessed file: each file is analyzed once
+    assert len(processed_files_by_instance) > 1
+    assert sum(processed_files_by_instance, []) == [a.name for a in audio_files]
+    for a in audio_files:
+        with open(a.with_suffix('.json')) as f:
+            assert json.load(f) is not None
+
+
+def _is_running(pid: int):
+    """ Zombies (killed, but not reaped by their parent) are not running """
+    try:
+        stat = pathlib.Path(f'/proc/{pid}/stat').read_text()
+    except FileNotFoundError:
+        return False
+    return stat[stat.rindex(')') + 2] != 'Z'
+
+
+def test_single_dir_hanging_file_is_an_evaluation_error(tmp_path, fake_matlab_path, monkeypatch):
+    monkeypatch.setenv('FAKE_MATLAB_HANG', 'b.wav')
+    audio_files = _write_audio_files(tmp_path / 'audio', ['a.wav', 'b.wav', 'c.wav'])
+    tt_single_dir = TimbreToolboxSingleDir(tmp_path / 'audio', n_workers=1, units_per_worker=1, scratch_dir=tmp_path,
+                                           file_timeout=1.0)
+    with pytest.warns(UserWarning, match='b.wav could not be analyzed'):
+        tt_single_dir.run()
+    results = list()
+    for a in audio_files:
+        with open(a.with_suffix('.json')) as f:
+            results.append(json.load(f))
+    assert results[0] is not None and results[1] is None and results[2] is not None
+
+
+def test_watchdog_kills_the_process_tree(tmp_path, fake_matlab_path, monkeypatch):
+    monkeypatch.setenv('FAKE_MATLAB_HANG', 'a.wav')
+    monkeypatch.setenv('FAKE_MATLAB_CHILD_PID_FILE', str(tmp_path / 'child_pid'))
+    audio_files = _write_audio_files(tmp_path / 'audio', ['a.wav'])
+    options_file = tmp_path / 'options.json'
+    write_options_file(options_file, input_mode='files')
+    tt_process = timbretoolbox.TimbreToolboxProcess(
+        pathlib.Path('/nonexistent'), _write_files_list(tmp_path / 'files.txt', audio_files), verbose=False,
+        options_file=options_file, file_timeout=0.5, monitoring_period=0.1)
+    tt_process.run()
+    assert tt_process.killed and tt_process.timed_out_file == 'a.wav'
+    child_pid = int((tmp_path / 'child_pid').read_text())
+    for _ in range(50):  # SIGKILL is asynchronous
+        if not _is_running(child_pid):
+            break
+        time.sleep(0.1)
+    assert not _is_running(child_pid)
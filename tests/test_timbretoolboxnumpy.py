@@ -0,0 +1,39 @@
+import warnings
+
+import numpy as np
+
+from src.soundmm import timbretoolboxnumpy
+
+
+fs = 44100
+
+
+def _tone(duration, f0=440.0, amplitude=0.5):
+    return amplitude * np.sin(2.0 * np.pi * f0 * np.arange(int(duration * fs)) / fs)
+
+
+def test_harmonic_descriptors_exclude_silent_frames():
+    audio = np.concatenate([_tone(0.5), np.zeros(int(1.5 * fs))])
+    descriptors = timbretoolboxnumpy.compute_descriptors([audio], fs, ['F0', 'HarmErg'])[0]
+    assert abs(descriptors['F0_med'] - 440.0) < 1.0
+    assert abs(descriptors['HarmErg_med'] - 0.5 ** 2 / 2.0) < 1e-3  # Power of the tone
+
+
+def test_harmonic_descriptors_of_silence_are_nan():
+    descriptors = timbretoolboxnumpy.compute_descriptors([np.zeros(fs)], fs, ['F0', 'HarmErg'])[0]
+    assert np.isnan(descriptors['F0_med']) and np.isnan(descriptors['HarmErg_med'])
+
+
+
+def test_silent_file_raises_no_warning():
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        descriptors = timbretoolboxnumpy.compute_descriptors([np.zeros(fs), _tone(1.0)], fs)
+    assert np.isnan(descriptors[0]['TempCent']) and np.isfinite(descriptors[1]['TempCent'])
+
+def test_short_input():
+    expected_names = set(timbretoolboxnumpy.compute_descriptors([_tone(0.5)], fs)[0].keys())
+    for n_samples in [100, 1100]:  # Shorter than an STFT frame plus a hop: no spectral variation
+        descriptors = timbretoolboxnumpy.compute_descriptors([_tone(n_samples / fs)], fs)[0]
+        assert set(descriptors.keys()) == expected_names
+        assert np.isnan(descriptors['SpecVar_med'])